@@ -0,0 +1,94 @@
+import argparse
+import itertools
+import time
+
+import numpy as np
+import torch
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.dataset import data_loader
+from src.loops.train import train_step
+from src.utils import grad_scaler
+
+
+parser = argparse.ArgumentParser(description="Compare square crops and aspect ratio buckets: "
+                                             "image area kept and train step throughput.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="sat2map",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("-d", "--data_dir", type=str, default="auto",
+                    help="Path to directory with train images (default: %(default)s).")
+parser.add_argument("--device", type=str, default="auto",
+                    help="Device to train on (default: train config device).")
+parser.add_argument("--n_batches", metavar="INT", type=int, default=20,
+                    help="Number of timed train steps (default: %(default)s).")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+data_config = config_.DataConfig()
+model_config = config_.ModelConfig()
+train_config = config_.TrainConfig()
+
+
+if args.data_dir != "auto":
+    data_config.train_images_dir = args.data_dir
+if args.device != "auto":
+    train_config.device = args.device
+device = train_config.device
+
+generator = model_config.generator.to(device)
+discriminator = model_config.discriminator.to(device)
+gen_optimizer = torch.optim.Adam(generator.parameters(), lr=train_config.gen_lr, betas=train_config.betas)
+dis_optimizer = torch.optim.Adam(discriminator.parameters(), lr=train_config.dis_lr, betas=train_config.betas)
+scaler = grad_scaler(train_config.amp_dtype)
+criterion = train_config.loss
+
+
+def synchronize():
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def measure(dataset):
+    loader = data_loader(dataset, train_config.train_batch, shuffle=True,
+                         num_workers=train_config.num_workers, pin_memory=train_config.pin_memory)
+    loader = data_config.edges_loader(loader, device)
+    # Batches are loaded in advance, only train steps are timed
+    batches = [[tensor.to(device) for tensor in batch]
+               for batch in itertools.islice(loader, args.n_batches + 1)]
+    num_pixels = 0
+
+    train_step(train_config, generator, discriminator, gen_optimizer, dis_optimizer,
+               scaler, *batches[0], criterion, False)  # Warmup
+    synchronize()
+    start = time.perf_counter()
+    for input, target in batches[1:]:
+        train_step(train_config, generator, discriminator, gen_optimizer, dis_optimizer,
+                   scaler, input, target, criterion, False)
+        num_pixels += input.numel()
+    synchronize()
+    elapsed = time.perf_counter() - start
+    return num_pixels / 1e6 / elapsed, sum(len(input) for input, _ in batches[1:]) / elapsed
+
+
+data_config.aspect_buckets = True
+bucket_dataset = data_config.train_dataset
+data_config.aspect_buckets = False
+square_dataset = data_config.train_dataset
+
+# Fraction of resized image area left after cropping
+sizes = np.array(bucket_dataset.image_sizes(), dtype=float)
+square_kept = sizes.min(axis=1) / sizes.max(axis=1)
+shapes = np.array([bucket_dataset.buckets[i] for i in bucket_dataset.bucket_ids], dtype=float)
+scales = np.maximum(shapes[:, 0] / sizes[:, 0], shapes[:, 1] / sizes[:, 1])
+bucket_kept = shapes.prod(axis=1) / (sizes.prod(axis=1) * scales ** 2)
+
+print(f"Dataset: {len(bucket_dataset)} images, buckets {bucket_dataset.buckets}")
+print("pipeline  area kept  train Mpx/s  samples/s")
+for name, dataset, kept in (("square", square_dataset, square_kept),
+                            ("buckets", bucket_dataset, bucket_kept)):
+    megapixels_per_second, samples_per_second = measure(dataset)
+    print("%-8s  %8.1f%%  %11.2f  %9.1f" % (name, 100 * kept.mean(), megapixels_per_second, samples_per_second))
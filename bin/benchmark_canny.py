@@ -0,0 +1,73 @@
+import argparse
+import time
+
+import cv2
+import torch
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.dataset import EdgesDataset
+from src.models import CannyEdgeDetector
+
+
+parser = argparse.ArgumentParser(description="Compare per-sample cv2.Canny with batched CannyEdgeDetector.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="sat2map",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("-d", "--data_dir", type=str, default="auto",
+                    help="Path to directory with input images (default: %(default)s).")
+parser.add_argument("-b", "--batch", metavar="INT", type=int, default=64,
+                    help="Batch size for batched edge detection (default: %(default)s).")
+parser.add_argument("--device", type=str, default="cpu",
+                    help="Device for batched edge detection (default: %(default)s).")
+parser.add_argument("--n_repeats", metavar="INT", type=int, default=10,
+                    help="Number of timed repeats (default: %(default)s).")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+data_config = config_.DataConfig()
+
+
+if args.data_dir != "auto":
+    data_config.valid_images_dir = args.data_dir
+
+dataset = EdgesDataset(data_config.valid_images_dir,
+                       data_config.valid_pre_transform,
+                       thresholds=data_config.thresholds)
+num_samples = min(args.batch, len(dataset))
+samples = [dataset[i] for i in range(num_samples)]
+targets = [dataset.load(i)[1] for i in range(num_samples)]
+input = torch.stack([sample[0] for sample in samples])
+target = torch.stack([sample[1] for sample in samples])
+
+# Per-sample cv2.Canny, i.e. the cost paid by a single dataloader worker
+start = time.perf_counter()
+for _ in range(args.n_repeats):
+    for image in targets:
+        cv2.Canny(image, *data_config.thresholds)
+cv2_time = (time.perf_counter() - start) / args.n_repeats
+
+# Batched detector on collated batch
+edge_detector = CannyEdgeDetector(data_config.thresholds).to(args.device)
+target = target.to(args.device)
+with torch.no_grad():
+    output = edge_detector(target)  # Warmup
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.n_repeats):
+        edge_detector(target)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    batch_time = (time.perf_counter() - start) / args.n_repeats
+
+mismatch = (output.cpu() != input).float().mean().item()
+
+print(f"Samples: {num_samples}, size {tuple(target.shape[-2:])}")
+print("cv2.Canny per worker:  %8.1f samples/s (%.2f ms/sample)" %
+      (num_samples / cv2_time, 1000 * cv2_time / num_samples))
+print("Batched on %-10s %8.1f samples/s (%.2f ms/batch)" %
+      (args.device + ":", num_samples / batch_time, 1000 * batch_time))
+print("Pixels differing from cv2: %.5f%%" % (100 * mismatch))
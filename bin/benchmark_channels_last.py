@@ -0,0 +1,95 @@
+import argparse
+import time
+
+import torch
+from torch import nn
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.models import GaussianBlur, RandomShift, RandomShiftBlur, VGGFeatures
+from src.metrics import NegativeLPIPS
+
+
+parser = argparse.ArgumentParser(description="Compare contiguous and channels last layouts of every conv component, "
+                                             "and sequential and fused discriminator preprocessing.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="anime",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("--device", type=str, default="cpu",
+                    help="Device to run on (default: %(default)s).")
+parser.add_argument("-b", "--batch", metavar="INT", type=int, default=4,
+                    help="Batch size (default: %(default)s).")
+parser.add_argument("--size", metavar="INT", type=int, default=256,
+                    help="Image size (default: %(default)s).")
+parser.add_argument("--n_repeats", metavar="INT", type=int, default=10,
+                    help="Number of timed calls (default: %(default)s).")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+model_config = config_.ModelConfig()
+model_config.compiled = False
+device = args.device
+
+
+def synchronize():
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def measure(fn, inputs, backward):
+    def call():
+        output = fn(*inputs)
+        if backward:
+            output.float().mean().backward()
+
+    with torch.set_grad_enabled(backward):
+        call()  # Warmup
+        synchronize()
+        start = time.perf_counter()
+        for _ in range(args.n_repeats):
+            call()
+        synchronize()
+    return (time.perf_counter() - start) / args.n_repeats
+
+
+def images(channels, requires_grad = False):
+    return (torch.rand(args.batch, channels, args.size, args.size, device=device) * 2 - 1) \
+        .requires_grad_(requires_grad)
+
+
+lpips = NegativeLPIPS(verbose=False)
+# name: (module, input channels, number of inputs, train mode with backward)
+components = {
+    "generator": (model_config.generator, model_config.gen_in_channels, 1, True),
+    "discriminator": (model_config.discriminator, model_config.dis_in_channels, 1, True),
+    "preprocess": (RandomShiftBlur(channels=4, kernel_size=5), 4, 1, True),
+    "vgg16": (VGGFeatures(), 3, 1, False),
+    "lpips": (lpips, 3, 2, False)
+}
+
+print("component       nchw, ms  nhwc, ms  speedup")
+for name, (module, channels, num_inputs, backward) in components.items():
+    module = module.to(device).train(backward)
+    fn = module
+    if isinstance(module, VGGFeatures):
+        # Activations are memoized by input, a fresh copy is passed every call
+        fn = lambda x, module=module: module(x.clone())
+    inputs = [images(channels, backward) for _ in range(num_inputs)]
+    nchw_time = measure(fn, inputs, backward)
+
+    module = module.to(memory_format=torch.channels_last)
+    inputs = [x.detach().to(memory_format=torch.channels_last).requires_grad_(backward) for x in inputs]
+    nhwc_time = measure(fn, inputs, backward)
+    print("%-14s %9.1f %9.1f %8.2f" % (name, 1000 * nchw_time, 1000 * nhwc_time, nchw_time / nhwc_time))
+
+sequential = nn.Sequential(RandomShift(), GaussianBlur(channels=4, kernel_size=5)).to(device)
+fused = RandomShiftBlur(channels=4, kernel_size=5).to(device)
+input = images(4, requires_grad=True)
+sequential_time = measure(sequential, [input], backward=True)
+fused_time = measure(fused, [input], backward=True)
+print()
+print("preprocess      sequential, ms  fused, ms  speedup")
+print("%-14s %15.1f %10.1f %8.2f" % ("shift+blur", 1000 * sequential_time, 1000 * fused_time,
+                                      sequential_time / fused_time))
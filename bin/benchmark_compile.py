@@ -0,0 +1,103 @@
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.models import compile_model
+
+
+parser = argparse.ArgumentParser(description="Compare compiled and eager generator and discriminator.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="sat2map",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("--device", type=str, default="cpu",
+                    help="Device to run on (default: %(default)s).")
+parser.add_argument("-b", "--batch", metavar="INT", type=int, default=4,
+                    help="Batch size (default: %(default)s).")
+parser.add_argument("--size", metavar="INT", type=int, default=256,
+                    help="Image size (default: %(default)s).")
+parser.add_argument("--n_steps", metavar="INT", type=int, default=10,
+                    help="Number of timed steps (default: %(default)s).")
+parser.add_argument("--no_cache", action="store_true",
+                    help="Do not use cached compiled artifacts.")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+model_config = config_.ModelConfig()
+model_config.compiled = False
+cache_dir = None if args.no_cache else model_config.compile_cache_dir
+device = args.device
+
+
+def synchronize():
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def step(model, input):
+    # Discriminator random shift draws from numpy
+    np.random.seed(0)
+    model.zero_grad()
+    model(input).square().mean().backward()
+
+
+def measure(model, input):
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(args.n_steps):
+        step(model, input)
+    synchronize()
+    return (time.perf_counter() - start) / args.n_steps
+
+
+def parity(eager, compiled, input):
+    # Timed steps updated batch norm statistics a different number of times
+    compiled.load_state_dict(eager.state_dict())
+    eager.eval()
+    compiled.eval()
+    with torch.no_grad():
+        output_diff = (eager(input) - compiled(input)).abs().max().item()
+    eager.train()
+    compiled.train()
+    step(eager, input)
+    step(compiled, input)
+    grad_diff = max((p1.grad - p2.grad).abs().max().item()
+                    for p1, p2 in zip(eager.parameters(), compiled.parameters()))
+    return output_diff, grad_diff
+
+
+models = {
+    "generator": (model_config.generator, model_config.gen_in_channels),
+    "discriminator": (model_config.discriminator, model_config.dis_in_channels)
+}
+
+print(f"torch {torch.__version__}")
+print("model          backend        compile, s  eager, ms/step  compiled, ms/step  max output diff  max grad diff")
+for name, (eager, in_channels) in models.items():
+    eager = eager.to(device)
+    input = torch.rand(args.batch, in_channels, args.size, args.size, device=device) * 2 - 1
+
+    synchronize()
+    start = time.perf_counter()
+    compiled = compile_model(copy.deepcopy(eager), cache_dir).to(device)
+    # Graph is built or optimized on first calls
+    step(compiled, input)
+    step(compiled, input)
+    synchronize()
+    compile_time = time.perf_counter() - start
+
+    step(eager, input)  # Warmup
+    eager_time = measure(eager, input)
+    compiled_time = measure(compiled, input)
+    output_diff, grad_diff = parity(eager, compiled, input)
+
+    scripted = any(isinstance(module, torch.jit.ScriptModule) for module in compiled.modules())
+    print("%-13s  %-13s %11.2f  %14.1f  %17.1f  %15.2e  %13.2e" %
+          (name, "TorchScript" if scripted else "torch.compile", compile_time,
+           1000 * eager_time, 1000 * compiled_time, output_diff, grad_diff))
@@ -0,0 +1,107 @@
+import argparse
+import os
+import socket
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.loops.train import train_step
+from src.utils import distributed, grad_scaler
+
+
+parser = argparse.ArgumentParser(description="Measure data parallel GAN train step throughput "
+                                             "across numbers of processes.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="anime",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("--world_sizes", metavar="INT", type=int, nargs="+", default=[1, 2, 4],
+                    help="Numbers of processes to compare (default: %(default)s).")
+parser.add_argument("--backend", type=str, default="gloo",
+                    help="Process group backend, nccl runs a process per GPU (default: %(default)s).")
+parser.add_argument("--sync_bn", action="store_true",
+                    help="Synchronize batch norm statistics over processes.")
+parser.add_argument("--size", metavar="INT", type=int, default=256,
+                    help="Image size (default: %(default)s).")
+parser.add_argument("--n_steps", metavar="INT", type=int, default=10,
+                    help="Number of timed steps (default: %(default)s).")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def worker(rank, args, world_size, port, results):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port), RANK=str(rank),
+                      WORLD_SIZE=str(world_size), LOCAL_RANK=str(rank))
+    distributed.init_distributed(args.backend)
+
+    config_ = getattr(config, args.config)
+    model_config = config_.ModelConfig()
+    model_config.sync_bn = args.sync_bn
+    train_config = config_.TrainConfig()
+    if args.backend == "nccl":
+        train_config.device = f"cuda:{rank}"
+        torch.cuda.set_device(rank)
+    else:
+        train_config.device = "cpu"
+        # Processes share the CPU cores instead of oversubscribing them
+        torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    device = train_config.device
+
+    generator = model_config.generator.to(device)
+    discriminator = model_config.discriminator.to(device)
+    distributed.broadcast_module(generator)
+    distributed.broadcast_module(discriminator)
+    gen_optimizer = torch.optim.Adam(generator.parameters(), lr=train_config.gen_lr, betas=train_config.betas)
+    dis_optimizer = torch.optim.Adam(discriminator.parameters(), lr=train_config.dis_lr, betas=train_config.betas)
+    scaler = grad_scaler(train_config.amp_dtype)
+    criterion = train_config.loss
+
+    # Batch size per process, as with `torchrun train.py`
+    input = torch.rand(train_config.train_batch, model_config.gen_in_channels,
+                       args.size, args.size, device=device) * 2 - 1
+    target = torch.rand(train_config.train_batch, model_config.gen_out_channels,
+                        args.size, args.size, device=device) * 2 - 1
+
+    def step():
+        train_step(train_config, generator, discriminator, gen_optimizer, dis_optimizer,
+                   scaler, input, target, criterion, skip_dis_step=False)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+    step()  # Warmup
+    distributed.barrier()
+    start = time.perf_counter()
+    for _ in range(args.n_steps):
+        step()
+    distributed.barrier()
+    step_time = (time.perf_counter() - start) / args.n_steps
+
+    if rank == 0:
+        results.put((step_time, world_size * train_config.train_batch / step_time))
+    if distributed.is_distributed():
+        torch.distributed.destroy_process_group()
+
+
+def main():
+    args = parser.parse_args()
+    results = mp.get_context("spawn").SimpleQueue()
+    print("processes  ms/step  samples/s  scaling efficiency")
+    base_throughput = None
+    for world_size in args.world_sizes:
+        mp.spawn(worker, (args, world_size, free_port(), results), nprocs=world_size)
+        step_time, throughput = results.get()
+        if base_throughput is None:
+            base_throughput = throughput / world_size
+        print("%-9d %8.1f  %9.1f  %18.2f" % (world_size, 1000 * step_time, throughput,
+                                             throughput / (world_size * base_throughput)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import time
+
+import torch
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.metrics import FID
+from src.utils import micro_batches
+
+
+parser = argparse.ArgumentParser(description="Measure per-epoch cost of in-loop FID evaluation.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="sat2map",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("--device", type=str, default="auto",
+                    help="Device to evaluate on (default: train config device).")
+parser.add_argument("--dims", metavar="INT", type=int, nargs="+", default=[2048, 64],
+                    help="Inception features dimensionalities to compare (default: %(default)s).")
+parser.add_argument("--n_samples", metavar="INT", type=int, default=256,
+                    help="Number of valid samples (default: %(default)s).")
+parser.add_argument("-b", "--batch", metavar="INT", type=int, default=32,
+                    help="Evaluation batch size (default: %(default)s).")
+parser.add_argument("--size", metavar="INT", type=int, default=256,
+                    help="Image size (default: %(default)s).")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+model_config = config_.ModelConfig()
+train_config = config_.TrainConfig()
+
+
+if args.device != "auto":
+    train_config.device = args.device
+device = train_config.device
+
+generator = model_config.generator.to(device).eval()
+
+input = torch.rand(args.n_samples, model_config.gen_in_channels,
+                   args.size, args.size, device=device) * 2 - 1
+target = torch.rand(args.n_samples, model_config.gen_out_channels,
+                    args.size, args.size, device=device) * 2 - 1
+
+
+def measure(fn):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.no_grad():
+        fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def generate():
+    for (batch,) in micro_batches([input], args.batch):
+        generator(batch)
+
+
+def evaluate(metric):
+    metric.reset()
+    for output, batch in micro_batches([target, target], args.batch):
+        metric.update(output, batch)
+    metric.compute()
+
+
+measure(generate)  # Warmup
+generator_time = measure(generate)
+
+print(f"Samples: {args.n_samples}, size {args.size}, device {device}")
+print("generator:          %8.2f s/epoch" % generator_time)
+print("dims  resize  first epoch, s  cached reference, s  overhead")
+for dims in args.dims:
+    for resize in (True, False):
+        metric = FID(None, dims, resize).to(device)
+        # First epoch also extracts reference features
+        first_time = measure(lambda: evaluate(metric))
+        cached_time = measure(lambda: evaluate(metric))
+        print("%4d  %-6s  %14.2f  %19.2f  %7.0f%%" %
+              (dims, "yes" if resize else "no", first_time, cached_time,
+               100 * cached_time / generator_time))
@@ -0,0 +1,73 @@
+import argparse
+import time
+
+import torch
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.models import fold_batch_norms
+
+
+parser = argparse.ArgumentParser(description="Check equivalence and compare latency of eval models "
+                                             "with and without batch norms folded into convolutions.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="sat2map",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("--device", type=str, default="cpu",
+                    help="Device to run on (default: %(default)s).")
+parser.add_argument("-b", "--batch", metavar="INT", type=int, default=1,
+                    help="Batch size (default: %(default)s).")
+parser.add_argument("--sizes", metavar="INT", type=int, nargs="+", default=[256, 512, 1024],
+                    help="Image sizes (default: %(default)s).")
+parser.add_argument("--n_repeats", metavar="INT", type=int, default=10,
+                    help="Number of timed repeats (default: %(default)s).")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+model_config = config_.ModelConfig()
+model_config.compiled = False
+device = args.device
+
+
+def synchronize():
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def measure(model, input):
+    with torch.no_grad():
+        model(input)  # Warmup
+        synchronize()
+        start = time.perf_counter()
+        for _ in range(args.n_repeats):
+            model(input)
+        synchronize()
+    return (time.perf_counter() - start) / args.n_repeats
+
+
+models = {
+    "generator": (model_config.generator, model_config.gen_in_channels),
+    "discriminator": (model_config.discriminator, model_config.dis_in_channels)
+}
+
+print("model          size  eager, ms/img  folded, ms/img  saved, ms/img  max output diff")
+for name, (model, in_channels) in models.items():
+    model = model.to(device)
+    # Non-trivial running statistics, as after training
+    with torch.no_grad():
+        for _ in range(3):
+            model(torch.rand(4, in_channels, 256, 256, device=device) * 2 - 1)
+    model.eval()
+    folded = fold_batch_norms(model)
+
+    for size in args.sizes:
+        input = torch.rand(args.batch, in_channels, size, size, device=device) * 2 - 1
+        with torch.no_grad():
+            diff = (model(input) - folded(input)).abs().max().item()
+        eager_time = measure(model, input) / args.batch
+        folded_time = measure(folded, input) / args.batch
+        print("%-13s %5d  %13.1f  %14.1f  %13.1f  %15.2e" %
+              (name, size, 1000 * eager_time, 1000 * folded_time,
+               1000 * (eager_time - folded_time), diff))
@@ -0,0 +1,110 @@
+import argparse
+import time
+
+import torch
+from torch import nn
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.loops.train import train_step
+from src.utils import grad_scaler
+
+
+parser = argparse.ArgumentParser(description="Compare GAN train step time with the previous implementation.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="sat2map",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("--device", type=str, default="auto",
+                    help="Device to train on (default: train config device).")
+parser.add_argument("--size", metavar="INT", type=int, default=256,
+                    help="Image size (default: %(default)s).")
+parser.add_argument("--n_steps", metavar="INT", type=int, default=10,
+                    help="Number of timed steps (default: %(default)s).")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+model_config = config_.ModelConfig()
+train_config = config_.TrainConfig()
+
+
+if args.device != "auto":
+    train_config.device = args.device
+device = train_config.device
+
+
+def legacy_losses(generator, discriminator, input, target, criterion,
+                  dis_loss_coef, skip_dis_step = True):
+    output = generator(input)
+    concat_output = torch.cat((output, input), 1)
+    concat_target = torch.cat((target, input), 1)
+    discriminator.requires_grad(False)
+    super_losses = {key: (coef, l(output, target)) for key, (coef, l) in criterion.items()}
+    gen_loss = sum(map(lambda x: x[0] * x[1], super_losses.values())) + dis_loss_coef * \
+               ((discriminator(concat_output) - 1) ** 2).mean()
+    concat_output = concat_output.detach()
+    if not skip_dis_step:
+        discriminator.requires_grad(True)
+    dis_loss = (discriminator(concat_output) ** 2 +
+                (discriminator(concat_target) - 1) ** 2).mean()
+    return output, super_losses, gen_loss, dis_loss
+
+
+def legacy_train_step(generator, discriminator, gen_optimizer, dis_optimizer,
+                      input, target, criterion, skip_dis_step):
+    gen_optimizer.zero_grad()
+    dis_optimizer.zero_grad()
+    output, super_losses, gen_loss, dis_loss = legacy_losses(
+        generator, discriminator, input, target,
+        criterion, train_config.dis_loss_coef, skip_dis_step
+    )
+    if train_config.gen_grad_clip_threshold is not None:
+        nn.utils.clip_grad_norm_(generator.parameters(), train_config.gen_grad_clip_threshold)
+    if train_config.dis_grad_clip_threshold is not None:
+        nn.utils.clip_grad_norm_(discriminator.parameters(), train_config.dis_grad_clip_threshold)
+    gen_loss.backward()
+    gen_optimizer.step()
+    if not skip_dis_step:
+        dis_loss.backward()
+        dis_optimizer.step()
+
+
+generator = model_config.generator.to(device)
+discriminator = model_config.discriminator.to(device)
+gen_optimizer = torch.optim.Adam(generator.parameters(), lr=train_config.gen_lr, betas=train_config.betas)
+dis_optimizer = torch.optim.Adam(discriminator.parameters(), lr=train_config.dis_lr, betas=train_config.betas)
+scaler = grad_scaler(train_config.amp_dtype)
+criterion = train_config.loss
+
+input = torch.rand(train_config.train_batch, model_config.gen_in_channels,
+                   args.size, args.size, device=device) * 2 - 1
+target = torch.rand(train_config.train_batch, model_config.gen_out_channels,
+                    args.size, args.size, device=device) * 2 - 1
+
+
+def measure(step):
+    step()  # Warmup
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.n_steps):
+        step()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.n_steps
+
+
+print("discriminator step  legacy, ms  current, ms  speedup")
+for skip_dis_step in (False, True):
+    legacy_time = measure(lambda: legacy_train_step(
+        generator, discriminator, gen_optimizer, dis_optimizer,
+        input, target, criterion, skip_dis_step
+    ))
+    current_time = measure(lambda: train_step(
+        train_config, generator, discriminator, gen_optimizer, dis_optimizer,
+        scaler, input, target, criterion, skip_dis_step
+    ))
+    print("%-18s  %10.1f  %11.1f  %6.2fx" %
+          ("skipped" if skip_dis_step else "enabled",
+           1000 * legacy_time, 1000 * current_time, legacy_time / current_time))
@@ -0,0 +1,76 @@
+import argparse
+import itertools
+import time
+
+import torch
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.dataset import DevicePrefetcher, auto_num_workers, data_loader
+
+
+parser = argparse.ArgumentParser(description="Measure train data pipeline throughput for different loader settings.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="sat2map",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("-d", "--data_dir", type=str, default="auto",
+                    help="Path to directory with train images (default: %(default)s).")
+parser.add_argument("--device", type=str, default="auto",
+                    help="Device to move batches to (default: train config device).")
+parser.add_argument("--n_batches", metavar="INT", type=int, default=50,
+                    help="Number of batches per measurement (default: %(default)s).")
+parser.add_argument("--step_ms", metavar="FLOAT", type=float, default=0.,
+                    help="Simulated training step time per batch in ms (default: %(default)s).")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+data_config = config_.DataConfig()
+train_config = config_.TrainConfig()
+
+
+if args.data_dir != "auto":
+    data_config.train_images_dir = args.data_dir
+device = train_config.device if args.device == "auto" else args.device
+
+dataset = data_config.train_dataset
+
+
+def measure(num_workers, pin_memory, prefetch_batches):
+    loader = data_loader(
+        dataset,
+        batch_size=train_config.train_batch,
+        shuffle=True,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        persistent_workers=True,
+        prefetch_factor=train_config.prefetch_factor
+    )
+    if prefetch_batches:
+        loader = DevicePrefetcher(loader, device, prefetch_batches)
+
+    # Two passes so that persistent workers are already started on the second one
+    for _ in range(2):
+        num_samples = 0
+        start = time.perf_counter()
+        for batch in itertools.islice(loader, args.n_batches):
+            if not prefetch_batches:
+                batch = [item.to(device) for item in batch]
+            num_samples += len(batch[0])
+            if args.step_ms:
+                time.sleep(args.step_ms / 1000)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+    return num_samples / elapsed
+
+
+print(f"Dataset: {len(dataset)} samples, batch {train_config.train_batch}, device {device}")
+print(f"workers  pin_memory  prefetch  samples/s")
+for num_workers in sorted({0, auto_num_workers()}):
+    for pin_memory in (False, True):
+        for prefetch_batches in (0, train_config.prefetch_batches or 2):
+            samples_per_second = measure(num_workers, pin_memory, prefetch_batches)
+            print("%7d  %10s  %8d  %9.1f" %
+                  (num_workers, pin_memory, prefetch_batches, samples_per_second))
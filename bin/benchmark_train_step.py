@@ -0,0 +1,131 @@
+import argparse
+import multiprocessing
+import time
+
+import torch
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.loops.train import train_step
+from src.models import ModelEMA
+from src.utils import grad_scaler, peak_memory, reset_peak_memory
+
+
+def set_amp(value, model_config, train_config):
+    train_config.amp_dtype = None if value == "none" else value
+
+
+def set_micro_batch(value, model_config, train_config):
+    train_config.train_micro_batch = None if value == "none" else int(value)
+
+
+def set_checkpoint_levels(value, model_config, train_config):
+    model_config.gen_checkpoint_levels = () if value == "none" else tuple(int(level) for level in value.split(","))
+
+
+# name: (device, dtype, steps between updates), None device for the train device
+EMA_MODES = {
+    "device_every1": (None, None, 1),
+    "device_every10": (None, None, 10),
+    "cpu_every10": ("cpu", None, 10),
+    "bfloat16_every10": (None, "bfloat16", 10)
+}
+
+
+def set_ema(value, model_config, train_config):
+    if value == "none":
+        train_config.ema_decay = None
+        return
+    train_config.ema_decay = train_config.ema_decay or 0.999
+    train_config.ema_device, train_config.ema_dtype, train_config.ema_every = EMA_MODES[value]
+
+
+# name: (function setting a compared value in configs, default values)
+VARIANTS = {
+    "amp": (set_amp, ["none", "bfloat16"]),
+    "micro_batch": (set_micro_batch, ["none", "4", "2", "1"]),
+    "checkpoint_levels": (set_checkpoint_levels, ["none", "0", "0,1", "0,1,2,3,4"]),
+    "ema": (set_ema, ["none"] + list(EMA_MODES))
+}
+
+
+parser = argparse.ArgumentParser(description="Compare GAN train step speed and memory across values of a setting.")
+parser.add_argument("--vary", type=str, required=True, choices=list(VARIANTS),
+                    help="Compared setting: autocast dtype, micro-batch size, "
+                         "comma-separated checkpointed UNet levels, generator weights averaging mode.")
+parser.add_argument("--values", type=str, nargs="+", default=None,
+                    help="Values of the setting to compare, none to disable (default: depends on the setting).")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="anime",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("--device", type=str, default="auto",
+                    help="Device to train on (default: train config device).")
+parser.add_argument("-b", "--batch", metavar="INT", type=int, default=None,
+                    help="Batch size (default: train config batch).")
+parser.add_argument("--size", metavar="INT", type=int, default=256,
+                    help="Image size (default: %(default)s).")
+parser.add_argument("--n_steps", metavar="INT", type=int, default=10,
+                    help="Number of timed steps (default: %(default)s).")
+
+
+def measure(args, value):
+    config_ = getattr(config, args.config)
+    model_config = config_.ModelConfig()
+    train_config = config_.TrainConfig()
+    if args.device != "auto":
+        train_config.device = args.device
+    if args.batch is not None:
+        train_config.train_batch = args.batch
+    set_value, _ = VARIANTS[args.vary]
+    set_value(value, model_config, train_config)
+    device = train_config.device
+
+    generator = model_config.generator.to(device)
+    discriminator = model_config.discriminator.to(device)
+    gen_optimizer = torch.optim.Adam(generator.parameters(), lr=train_config.gen_lr, betas=train_config.betas)
+    dis_optimizer = torch.optim.Adam(discriminator.parameters(), lr=train_config.dis_lr, betas=train_config.betas)
+    scaler = grad_scaler(train_config.amp_dtype)
+    criterion = train_config.loss
+    ema = None
+    if train_config.ema_decay is not None:
+        ema = ModelEMA(generator, train_config.ema_decay, train_config.ema_every,
+                       train_config.ema_device, train_config.ema_dtype)
+
+    input = torch.rand(train_config.train_batch, model_config.gen_in_channels,
+                       args.size, args.size, device=device) * 2 - 1
+    target = torch.rand(train_config.train_batch, model_config.gen_out_channels,
+                        args.size, args.size, device=device) * 2 - 1
+
+    def step():
+        train_step(train_config, generator, discriminator, gen_optimizer, dis_optimizer,
+                   scaler, input, target, criterion, skip_dis_step=False)
+        if ema is not None:
+            ema.update(generator)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+    step()  # Warmup
+    reset_peak_memory(device)
+
+    start = time.perf_counter()
+    for _ in range(args.n_steps):
+        step()
+    step_time = (time.perf_counter() - start) / args.n_steps
+    return step_time, train_config.train_batch / step_time, peak_memory(device)
+
+
+def main():
+    args = parser.parse_args()
+    values = args.values or VARIANTS[args.vary][1]
+    # Every value runs in a fresh process so that peak memory is not shared
+    context = multiprocessing.get_context("spawn")
+    print("%-17s ms/step  samples/s  peak memory, Mb" % args.vary)
+    for value in values:
+        with context.Pool(1) as pool:
+            step_time, throughput, memory = pool.apply(measure, (args, value))
+        print("%-17s %7.1f  %9.1f  %15.1f" % (value, 1000 * step_time, throughput, memory))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import argparse
+import os
+import socket
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.dataset.loader import DistributedEpochSampler
+from src.loops.train import train_step
+from src.models import PatchDiscriminator, SyncBatchNorm2d, UNet, convert_sync_batchnorm, init_weights
+from src.utils import distributed, grad_scaler
+
+
+parser = argparse.ArgumentParser(description="Check that data parallel training on CPU (gloo) matches "
+                                             "a single process on the concatenated batch.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="anime",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("--world_size", metavar="INT", type=int, default=2,
+                    help="Number of processes (default: %(default)s).")
+parser.add_argument("-b", "--batch", metavar="INT", type=int, default=4,
+                    help="Batch size per process (default: %(default)s).")
+parser.add_argument("--size", metavar="INT", type=int, default=32,
+                    help="Image size (default: %(default)s).")
+parser.add_argument("--rtol", type=float, default=1e-4,
+                    help="Relative tolerance (default: %(default)s).")
+parser.add_argument("--atol", type=float, default=1e-6,
+                    help="Absolute tolerance (default: %(default)s).")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_models(model_config):
+    torch.manual_seed(0)
+    # Small models, batch statistics are synchronized as with `sync_bn = True`
+    generator = UNet(model_config.gen_in_channels, model_config.gen_out_channels, 8)
+    discriminator = PatchDiscriminator(model_config.dis_in_channels, model_config.dis_out_channels, 3, 8)
+    generator.apply(init_weights)
+    discriminator.apply(init_weights)
+    return convert_sync_batchnorm(generator), convert_sync_batchnorm(discriminator)
+
+
+def run_step(args, generator, discriminator, input, target):
+    """One train step, returns losses, grads and buffers."""
+    config_ = getattr(config, args.config)
+    train_config = config_.TrainConfig()
+    train_config.device = "cpu"
+    train_config.amp_dtype = None
+    train_config.train_micro_batch = None
+
+    gen_optimizer = torch.optim.Adam(generator.parameters(), lr=train_config.gen_lr, betas=train_config.betas)
+    dis_optimizer = torch.optim.Adam(discriminator.parameters(), lr=train_config.dis_lr, betas=train_config.betas)
+    criterion = {"l1_loss": (1, nn.L1Loss())}
+    # Same random shift of discriminator inputs in every process
+    np.random.seed(0)
+    _, _, gen_loss, dis_loss = train_step(train_config, generator, discriminator, gen_optimizer, dis_optimizer,
+                                          grad_scaler(None), input, target, criterion, skip_dis_step=False)
+
+    grads = {f"generator.{name}": param.grad.clone() for name, param in generator.named_parameters()}
+    grads.update({f"discriminator.{name}": param.grad.clone() for name, param in discriminator.named_parameters()})
+    buffers = {f"generator.{name}": buffer.clone() for name, buffer in generator.named_buffers()}
+    buffers.update({f"discriminator.{name}": buffer.clone() for name, buffer in discriminator.named_buffers()})
+    return distributed.all_reduce_mean(gen_loss), distributed.all_reduce_mean(dis_loss), grads, buffers
+
+
+def max_diff(a, b) -> float:
+    return (a.double() - b.double()).abs().max().item()
+
+
+def check_close(name, value, reference, args):
+    assert torch.allclose(value.double(), reference.double(), rtol=args.rtol, atol=args.atol), \
+        f"{name} differs by {max_diff(value, reference):.3e}"
+
+
+def check_sync_batch_norm(args, rank, world_size):
+    torch.manual_seed(1)
+    input = torch.randn(args.batch * world_size, 3, 8, 8)
+    weight = torch.randn(1, 3, 8, 8)
+
+    reference = nn.BatchNorm2d(3)
+    full = input.clone().requires_grad_()
+    reference_output = reference(full)
+    (reference_output * weight).mean().backward()
+
+    sync = SyncBatchNorm2d(3)
+    local = input[rank * args.batch:(rank + 1) * args.batch].clone().requires_grad_()
+    output = sync(local)
+    (output * weight).mean().backward()
+    distributed.all_reduce_grads(sync.parameters())
+
+    part = slice(rank * args.batch, (rank + 1) * args.batch)
+    check_close("SyncBatchNorm2d output", output, reference_output[part].detach(), args)
+    # Local losses are means over `world_size` times smaller batches
+    check_close("SyncBatchNorm2d input grad", local.grad / world_size, full.grad[part], args)
+    check_close("SyncBatchNorm2d weight grad", sync.weight.grad, reference.weight.grad, args)
+    check_close("SyncBatchNorm2d bias grad", sync.bias.grad, reference.bias.grad, args)
+    check_close("SyncBatchNorm2d running mean", sync.running_mean, reference.running_mean, args)
+    check_close("SyncBatchNorm2d running var", sync.running_var, reference.running_var, args)
+
+
+def check_sampler(rank, world_size):
+    dataset = range(10 * world_size)
+    sampler = DistributedEpochSampler(dataset, shuffle=True)
+    sampler.set_epoch(3)
+    first = torch.tensor(list(sampler))
+    sampler.set_epoch(3)
+    assert torch.equal(first, torch.tensor(list(sampler))), "set_epoch does not reproduce shuffling"
+    assert not torch.equal(first, torch.tensor(list(sampler))), "shuffling does not change between epochs"
+
+    shards = [torch.zeros_like(first) for _ in range(world_size)]
+    torch.distributed.all_gather(shards, first)
+    assert sorted(torch.cat(shards).tolist()) == list(dataset), "process shards do not cover dataset"
+
+
+def worker(rank, args, port, states, input, target, reference):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port), RANK=str(rank),
+                      WORLD_SIZE=str(args.world_size), LOCAL_RANK=str(rank))
+    torch.set_num_threads(1)
+    _, world_size, _ = distributed.init_distributed("gloo")
+
+    check_sync_batch_norm(args, rank, world_size)
+    check_sampler(rank, world_size)
+
+    generator, discriminator = make_models(getattr(config, args.config).ModelConfig())
+    generator.load_state_dict(states[0])
+    discriminator.load_state_dict(states[1])
+    part = slice(rank * args.batch, (rank + 1) * args.batch)
+    gen_loss, dis_loss, grads, buffers = run_step(args, generator, discriminator, input[part], target[part])
+
+    ref_gen_loss, ref_dis_loss, ref_grads, ref_buffers = reference
+    check_close("generator loss", gen_loss, ref_gen_loss, args)
+    check_close("discriminator loss", dis_loss, ref_dis_loss, args)
+    for name, grad in grads.items():
+        check_close(f"grad of {name}", grad, ref_grads[name], args)
+    for name, buffer in buffers.items():
+        check_close(f"buffer {name}", buffer, ref_buffers[name], args)
+
+    if rank == 0:
+        print("max grad diff:   %.3e" % max(max_diff(grads[name], ref_grads[name]) for name in grads))
+        print("max buffer diff: %.3e" % max(max_diff(buffers[name], ref_buffers[name]) for name in buffers))
+    torch.distributed.destroy_process_group()
+
+
+def main():
+    args = parser.parse_args()
+    model_config = getattr(config, args.config).ModelConfig()
+
+    torch.manual_seed(2)
+    input = torch.rand(args.batch * args.world_size, model_config.gen_in_channels, args.size, args.size) * 2 - 1
+    target = torch.rand(args.batch * args.world_size, model_config.gen_out_channels, args.size, args.size) * 2 - 1
+
+    # Single process step on the concatenated batch, sync batch norms fall back to `nn.BatchNorm2d`
+    generator, discriminator = make_models(model_config)
+    # Copies, the step updates weights in place
+    states = ({key: value.clone() for key, value in generator.state_dict().items()},
+              {key: value.clone() for key, value in discriminator.state_dict().items()})
+    reference = run_step(args, generator, discriminator, input, target)
+
+    mp.spawn(worker, (args, free_port(), states, input, target, reference),
+             nprocs=args.world_size)
+    print(f"{args.world_size} gloo processes match a single process step")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+
+import torch
+from torchvision import transforms
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.utils import checkpoint
+
+
+parser = argparse.ArgumentParser(description="Export trained generator to ONNX for predict_onnx.py.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="sat2map",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("-pg", "--gen_pretrained", type=str, default="auto",
+                    help="Pretrained generator weights (default: %(default)s).")
+parser.add_argument("-o", "--output", type=str, default="auto",
+                    help="Where to save the model (default: resources/onnx/<weights>.onnx).")
+parser.add_argument("--opset", metavar="INT", type=int, default=13,
+                    help="ONNX opset version (default: %(default)s).")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+data_config = config_.DataConfig()
+model_config = config_.ModelConfig()
+train_config = config_.TrainConfig()
+
+
+def pre_transform_params(transform) -> dict:
+    """Parameters of valid pre-transform to reproduce it without torchvision."""
+    params = dict()
+    for t in getattr(transform, "transforms", [transform]):
+        if isinstance(t, transforms.Resize):
+            params["resize"] = t.size
+        elif isinstance(t, transforms.CenterCrop):
+            params["crop"] = list(t.size)
+        else:
+            raise ValueError(f"{t} is not supported by standalone inference")
+    return params
+
+
+# Export an eager model, compiled ones are not traceable
+model_config.compiled = False
+generator = model_config.generator.eval()
+
+pretrained = args.gen_pretrained if args.gen_pretrained != "auto" \
+                                 else train_config.run_name
+checkpoint.load_pretrained(pretrained, "generator", generator)
+
+output = args.output
+if output == "auto":
+    output = f"resources/onnx/{pretrained}.onnx"
+os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+
+# Size not divisible by 16, so that UNet padding is traced with dynamic amounts
+example = torch.rand(1, model_config.gen_in_channels, 250, 250) * 2 - 1
+torch.onnx.export(
+    generator, example, output,
+    input_names=["input"], output_names=["output"],
+    dynamic_axes={"input": {0: "batch", 2: "height", 3: "width"},
+                  "output": {0: "batch", 2: "height", 3: "width"}},
+    opset_version=args.opset
+)
+
+try:
+    import onnx
+except ImportError:
+    raise ImportError("Writing preprocessing metadata requires onnx, "
+                      "install it with `pip install onnx onnxruntime`")
+
+model = onnx.load(output)
+metadata = {
+    "thresholds": json.dumps(list(data_config.thresholds)),
+    "pre_transform": json.dumps(pre_transform_params(data_config.valid_pre_transform))
+}
+for key, value in metadata.items():
+    model.metadata_props.add(key=key, value=value)
+onnx.save(model, output)
+print(f"Generator {pretrained} exported to {output}")
+
+try:
+    import onnxruntime
+except ImportError:
+    exit()
+
+# Parity with torch on a size different from the traced one
+example = torch.rand(2, model_config.gen_in_channels, 256, 192) * 2 - 1
+session = onnxruntime.InferenceSession(output, providers=["CPUExecutionProvider"])
+with torch.no_grad():
+    expected = generator(example).numpy()
+actual = session.run(None, {"input": example.numpy()})[0]
+print("Max abs difference with torch: %.2e" % abs(actual - expected).max())
@@ -0,0 +1,131 @@
+import argparse
+import time
+
+import lpips
+import numpy as np
+import torch
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.dataset import data_loader
+from src.loss import VGGPerceptualLoss
+from src.metrics import VGGLPIPS
+from src.models import VGGFeatures
+from src.utils import checkpoint
+
+
+parser = argparse.ArgumentParser(description="Compare shared VGG backbone loss and LPIPS with separate networks.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="sat2map",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("-d", "--data_dir", type=str, default="auto",
+                    help="Path to directory with input images (default: %(default)s).")
+parser.add_argument("-pg", "--gen_pretrained", type=str, default="none",
+                    help="Generator weights to compare predictions, "
+                         "otherwise noisy targets are compared (default: %(default)s).")
+parser.add_argument("-b", "--batch", metavar="INT", type=int, default=16,
+                    help="Batch size (default: %(default)s).")
+parser.add_argument("--n_batches", metavar="INT", type=int, default=8,
+                    help="Number of compared batches (default: %(default)s).")
+parser.add_argument("--device", type=str, default="auto",
+                    help="Device to run on (default: train config device).")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+data_config = config_.DataConfig()
+model_config = config_.ModelConfig()
+train_config = config_.TrainConfig()
+
+
+if args.data_dir != "auto":
+    data_config.valid_images_dir = args.data_dir
+if args.device != "auto":
+    train_config.device = args.device
+device = train_config.device
+
+loader = data_loader(data_config.valid_dataset, args.batch, num_workers=0)
+loader = data_config.edges_loader(loader, device)
+
+generator = None
+if args.gen_pretrained != "none":
+    generator = model_config.generator.to(device).eval()
+    checkpoint.load_pretrained(args.gen_pretrained, "generator", generator)
+
+backbone = VGGFeatures().to(device)
+separate = {
+    "vgg_perceptual_loss": VGGPerceptualLoss(avgpool=True).to(device),
+    "lpips_alex": lpips.LPIPS(net="alex", verbose=False).to(device),
+    "lpips_vgg": lpips.LPIPS(net="vgg", verbose=False).to(device)
+}
+shared = {
+    "vgg_perceptual_loss": VGGPerceptualLoss(avgpool=True, backbone=backbone).to(device),
+    "lpips_vgg": VGGLPIPS(backbone).to(device)
+}
+
+
+def timed(fn):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    out = fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - start
+
+
+def per_sample(metric, output, target):
+    # Perceptual loss is a batch mean
+    return torch.stack([metric(o[None], t[None]).flatten()[0] for o, t in zip(output, target)])
+
+
+values = {f"separate {key}": [] for key in separate}
+values.update({f"shared {key}": [] for key in shared})
+# Loss and LPIPS pairs computed per batch
+setups = {
+    "separate VGG loss + LPIPS-Alex": (separate["vgg_perceptual_loss"], separate["lpips_alex"]),
+    "separate VGG loss + LPIPS-VGG": (separate["vgg_perceptual_loss"], separate["lpips_vgg"]),
+    "shared VGG loss + LPIPS-VGG": (shared["vgg_perceptual_loss"], shared["lpips_vgg"])
+}
+times = {key: 0 for key in setups}
+
+with torch.no_grad():
+    for i, (input, target) in enumerate(loader):
+        if i == args.n_batches:
+            break
+        input, target = input.to(device), target.to(device)
+        if generator is not None:
+            output = generator(input)
+        else:
+            noise = torch.linspace(0.05, 0.5, len(target), device=device).view(-1, 1, 1, 1)
+            output = (target + noise * torch.randn_like(target)).clip(-1, 1)
+
+        for key, metric in separate.items():
+            values[f"separate {key}"].append(per_sample(metric, output, target))
+        for key, metric in shared.items():
+            values[f"shared {key}"].append(per_sample(metric, output, target))
+
+        for key, (loss, metric) in setups.items():
+            _, batch_time = timed(lambda: (loss(output, target), metric(output, target)))
+            times[key] += batch_time
+        num_batches = i + 1
+
+values = {key: torch.cat(value).cpu().numpy() for key, value in values.items()}
+
+print("value                             mean  vs separate:  mean abs diff  max abs diff  correlation")
+for key in values:
+    reference = None
+    if key.startswith("shared"):
+        name = key.split()[1]
+        reference = values[f"separate {name}"]
+    print("%-30s %8.4f" % (key, values[key].mean()), end="")
+    if reference is not None:
+        diff = np.abs(values[key] - reference)
+        print("  %27.5f  %12.5f  %11.4f" %
+              (diff.mean(), diff.max(), np.corrcoef(values[key], reference)[0, 1]), end="")
+    print()
+print("shared lpips_vgg vs separate lpips_alex correlation: %.4f" %
+      np.corrcoef(values["shared lpips_vgg"], values["separate lpips_alex"])[0, 1])
+for key, value in times.items():
+    print("%-32s %8.1f ms/batch" % (key, 1000 * value / num_batches))
@@ -0,0 +1,40 @@
+import argparse
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.dataset import EdgesDataset, pack_edges, pack_images
+
+
+parser = argparse.ArgumentParser(description="Precompute resized images and edges into memory-mapped shards.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="sat2map",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("-d", "--data_dir", type=str, default="auto",
+                    help="Path to directory with valid input images (default: %(default)s).")
+parser.add_argument("--split", choices=["train", "valid", "all"], default="all",
+                    help="Which split to pack (default: %(default)s).")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+data_config = config_.DataConfig()
+
+
+if args.data_dir != "auto":
+    data_config.valid_images_dir = args.data_dir
+
+if args.split in ("train", "all"):
+    # Only the deterministic resize is cached, random crop & flip run on top of it
+    dataset = EdgesDataset(data_config.train_images_dir,
+                           data_config.train_resize,
+                           thresholds=data_config.thresholds)
+    pack_images(dataset, data_config.train_cache_path)
+    print(f"Packed {len(dataset)} train images to {data_config.train_cache_path}")
+
+if args.split in ("valid", "all"):
+    dataset = EdgesDataset(data_config.valid_images_dir,
+                           data_config.valid_pre_transform,
+                           thresholds=data_config.thresholds)
+    pack_edges(dataset, data_config.valid_cache_path)
+    print(f"Packed {len(dataset)} valid samples to {data_config.valid_cache_path}")
@@ -1,14 +1,16 @@
 import argparse
 import os
+import multiprocessing
 
+import cv2
+import numpy as np
 from tqdm.auto import tqdm
-from torch.utils.data import DataLoader
 
 import sys
 sys.path.append(".")
 
 from src import config
-from src.utils import save_image, split_extension
+from src.utils import split_extension
 
 
 parser = argparse.ArgumentParser(description="Apply transforms to images for correct FID measuring.")
@@ -20,30 +22,102 @@ parser.add_argument("-s", "--save_dir", type=str, default="auto",
                     help="Where to save images (default: %(default)s).")
 parser.add_argument("--unnorm", type=str, choices=["yes", "no"], default="yes",
                     help="Unnormalize images [-1; 1] -> [0, 1] when saving (default: %(default)s).")
-args = parser.parse_args()
+parser.add_argument("-j", "--n_jobs", metavar="INT", type=int, default=os.cpu_count(),
+                    help="Number of processes decoding and encoding images (default: %(default)s).")
+parser.add_argument("--overwrite", action="store_true",
+                    help="Process all images, otherwise skip images already saved.")
+parser.add_argument("--stats", action="store_true",
+                    help="Compute Inception statistics of saved images (requires pytorch-fid).")
+parser.add_argument("--stats_path", type=str, default="auto",
+                    help="Where to save Inception statistics (default: <save_dir>.npz).")
+parser.add_argument("--device", type=str, default="auto",
+                    help="Device for Inception model (default: train config device).")
+parser.add_argument("--dims", metavar="INT", type=int, default=2048,
+                    help="Inception features dimensionality (default: %(default)s).")
+parser.add_argument("--batch", metavar="INT", type=int, default=50,
+                    help="Batch size for Inception model (default: %(default)s).")
 
-config_ = getattr(config, args.config)
 
-data_config = config_.DataConfig()
-model_config = config_.ModelConfig()
-train_config = config_.TrainConfig()
+def init_worker(dataset_, unnorm_):
+    global dataset, unnorm
+    dataset = dataset_
+    unnorm = unnorm_
+    # Parallelism is provided by processes
+    cv2.setNumThreads(1)
 
 
-if args.data_dir != "auto":
-    data_config.valid_images_dir = args.data_dir
+def process(job):
+    i, path = job
+    # Edges are not needed, only the transformed target is loaded
+    target = dataset.load_target(i)
+    if not unnorm:
+        # Image is saved in [-1; 1] range clipped to [0; 1]
+        target = (np.clip(target / 127.5 - 1, 0, 1) * 255 + 0.5).astype(np.uint8)
 
-dataset = data_config.valid_dataset
-data_loader = DataLoader(
-    dataset,
-    batch_size=train_config.valid_batch,
-    shuffle=False
-)
+    # Temporary file has no image extension, so leftovers of a killed run are not scanned as images
+    _, extension = split_extension(path)
+    _, encoded = cv2.imencode(extension, np.ascontiguousarray(target[..., ::-1]))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(encoded.tobytes())
+    os.replace(tmp_path, path)
 
 
-save_dir = args.save_dir
-if save_dir == "auto":
-    save_dir = f"resources/{args.config}_fid"
-os.makedirs(save_dir, exist_ok=True)
-for name, (input, target) in tqdm(zip(dataset.ids, iter(dataset)), desc="Processing data"):
-    path = f"{save_dir}/{split_extension(os.path.basename(name))[0]}.png"
-    save_image(path, target, args.unnorm == "yes")
+def inception_stats(path, device, dims, batch_size, num_workers):
+    try:
+        from pytorch_fid.fid_score import compute_statistics_of_path
+        from pytorch_fid.inception import InceptionV3
+    except ImportError:
+        raise ImportError("Computing Inception statistics requires pytorch-fid, "
+                          "install it with `pip install pytorch-fid`")
+
+    model = InceptionV3([InceptionV3.BLOCK_INDEX_BY_DIM[dims]]).to(device)
+    return compute_statistics_of_path(path, model, batch_size, dims, device, num_workers)
+
+
+def main():
+    args = parser.parse_args()
+
+    config_ = getattr(config, args.config)
+
+    data_config = config_.DataConfig()
+    train_config = config_.TrainConfig()
+
+    if args.data_dir != "auto":
+        data_config.valid_images_dir = args.data_dir
+
+    # Reads packed valid shard if available
+    dataset = data_config.valid_dataset
+
+    save_dir = args.save_dir
+    if save_dir == "auto":
+        save_dir = f"resources/{args.config}_fid"
+    os.makedirs(save_dir, exist_ok=True)
+    # Partial writes of a killed run, also `*.tmp.png` of earlier versions
+    for name in os.listdir(save_dir):
+        if name.endswith(".tmp") or ".tmp." in name:
+            os.remove(f"{save_dir}/{name}")
+
+    paths = [f"{save_dir}/{split_extension(os.path.basename(name))[0]}.png" for name in dataset.ids]
+    jobs = [(i, path) for i, path in enumerate(paths) if args.overwrite or not os.path.exists(path)]
+    print(f"Processing {len(jobs)} of {len(paths)} images")
+
+    n_jobs = max(1, min(args.n_jobs, len(jobs)))
+    with multiprocessing.Pool(n_jobs, init_worker, (dataset, args.unnorm == "yes")) as pool:
+        for _ in tqdm(pool.imap_unordered(process, jobs, chunksize=16),
+                      total=len(jobs), desc="Processing data"):
+            pass
+
+    if args.stats:
+        stats_path = f"{save_dir}.npz" if args.stats_path == "auto" else args.stats_path
+        if os.path.exists(stats_path) and not jobs:
+            print(f"Inception statistics are up to date: {stats_path}")
+            return
+        device = train_config.device if args.device == "auto" else args.device
+        mu, sigma = inception_stats(save_dir, device, args.dims, args.batch, args.n_jobs)
+        np.savez_compressed(stats_path, mu=mu, sigma=sigma)
+        print(f"Inception statistics saved to {stats_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import io
+import itertools
+import os
+import time
+
+import torch
+
+import sys
+sys.path.append(".")
+
+from src import config
+from src.dataset import data_loader
+from src.loops import test
+from src.models import quantize_dynamic, quantize_static
+from src.utils import checkpoint
+
+
+parser = argparse.ArgumentParser(description="Quantize trained generator to int8 for CPU inference and report "
+                                             "metrics degradation and speed.")
+parser.add_argument("-c", "--config", metavar="CONFIG", type=str, default="sat2map",
+                    help="Config filename (default: %(default)s).")
+parser.add_argument("-d", "--data_dir", type=str, default="auto",
+                    help="Path to directory with input images (default: %(default)s).")
+parser.add_argument("-pg", "--gen_pretrained", type=str, default="auto",
+                    help="Pretrained generator weights (default: %(default)s).")
+parser.add_argument("--modes", type=str, nargs="+", choices=["dynamic", "static"], default=["dynamic", "static"],
+                    help="Quantization modes (default: %(default)s).")
+parser.add_argument("--backend", type=str, default=None,
+                    help="Quantized engine, fbgemm for x86 or qnnpack for ARM (default: current torch engine).")
+parser.add_argument("-b", "--batch", metavar="INT", type=int, default=8,
+                    help="Batch size (default: %(default)s).")
+parser.add_argument("--n_calibration", metavar="INT", type=int, default=8,
+                    help="Number of valid batches for static calibration (default: %(default)s).")
+parser.add_argument("--n_repeats", metavar="INT", type=int, default=10,
+                    help="Number of timed repeats (default: %(default)s).")
+parser.add_argument("-s", "--save_dir", type=str, default="resources/models",
+                    help="Where to save TorchScript int8 models (default: %(default)s).")
+args = parser.parse_args()
+
+config_ = getattr(config, args.config)
+
+data_config = config_.DataConfig()
+model_config = config_.ModelConfig()
+train_config = config_.TrainConfig()
+
+
+if args.data_dir != "auto":
+    data_config.valid_images_dir = args.data_dir
+# Quantized kernels run on CPU only
+train_config.device = "cpu"
+model_config.compiled = False
+
+generator = model_config.generator.eval()
+pretrained = args.gen_pretrained if args.gen_pretrained != "auto" \
+                                 else train_config.run_name
+checkpoint.load_pretrained(pretrained, "generator", generator)
+
+loader = data_loader(data_config.valid_dataset, args.batch, num_workers=train_config.num_workers)
+loader = data_config.edges_loader(loader, "cpu")
+
+models = {"fp32": generator}
+if "dynamic" in args.modes:
+    models["dynamic"] = quantize_dynamic(generator)
+if "static" in args.modes:
+    # Calibration batches are a part of evaluation data
+    calibration_data = (input for input, _ in itertools.islice(loader, args.n_calibration))
+    models["static"] = quantize_static(generator, calibration_data, args.backend)
+
+
+def model_size(model) -> float:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def measure(model, input) -> float:
+    with torch.no_grad():
+        model(input)  # Warmup
+        start = time.perf_counter()
+        for _ in range(args.n_repeats):
+            model(input)
+    return (time.perf_counter() - start) / args.n_repeats
+
+
+input = next(iter(loader))[0]
+metric = train_config.metric
+results = dict()
+for mode, model in models.items():
+    print(f"Evaluating {mode}")
+    results[mode] = test(model, metric, loader, device="cpu")
+    results[mode]["latency"] = 1000 * measure(model, input[:1])
+    results[mode]["throughput"] = len(input) / measure(model, input)
+    results[mode]["size"] = model_size(model)
+
+    if mode != "fp32":
+        os.makedirs(args.save_dir, exist_ok=True)
+        path = f"{args.save_dir}/{pretrained}_int8_{mode}.pt"
+        torch.jit.save(torch.jit.script(model), path)
+        print(f"Saved to {path}")
+
+keys = list(metric)
+print()
+print("mode     " + "".join("%10s  %10s  " % (key, "delta") for key in keys) +
+      "latency, ms  throughput, img/s  size, Mb")
+for mode, result in results.items():
+    print("%-8s " % mode + "".join("%10.4f  %+10.4f  " % (result[key], result[key] - results["fp32"][key])
+                                   for key in keys) +
+          "%11.1f  %17.1f  %8.1f" % (result["latency"], result["throughput"], result["size"]))
@@ -1,14 +1,19 @@
 import argparse
 import os
+import time
+import torch
 
-from torch.utils.data import DataLoader
+from torch.utils.data import Subset
+from tqdm.auto import tqdm
 
 import sys
 sys.path.append(".")
 
 from src import config
-from src.loops import predict
-from src.utils import checkpoint, save_image, split_extension
+from src.dataset import EdgesDataset, data_loader
+from src.loops import predict_batches, predict_tiled
+from src.models import fold_batch_norms
+from src.utils import ImageWriter, checkpoint, peak_memory, reset_peak_memory, split_extension
 
 
 parser = argparse.ArgumentParser(description="Process images using trained pix2pix GAN model.")
@@ -20,8 +25,22 @@ parser.add_argument("-s", "--save_dir", type=str, default="resources/predicted",
                     help="Where to save images (default: %(default)s).")
 parser.add_argument("-pg", "--gen_pretrained", type=str, default="auto",
                     help="Pretrained generator weights (default: %(default)s).")
+parser.add_argument("--ema", action="store_true",
+                    help="Use exponential moving average of generator weights.")
 parser.add_argument("--unnorm", type=str, choices=["yes", "no"], default="yes",
                     help="Unnormalize images [-1; 1] -> [0, 1] when saving (default: %(default)s).")
+parser.add_argument("--n_threads", metavar="INT", type=int, default=4,
+                    help="Number of threads encoding images (default: %(default)s).")
+parser.add_argument("--overwrite", action="store_true",
+                    help="Predict all images, otherwise skip images already saved.")
+parser.add_argument("--tiled", action="store_true",
+                    help="Predict images at native resolution by overlapping tiles instead of valid transform.")
+parser.add_argument("--tile_size", metavar="INT", type=int, default=256,
+                    help="Tile size for tiled mode (default: %(default)s).")
+parser.add_argument("--tile_overlap", metavar="INT", type=int, default=32,
+                    help="Overlap of neighbouring tiles blended together (default: %(default)s).")
+parser.add_argument("--tile_batch", metavar="INT", type=int, default=16,
+                    help="Number of tiles per generator call (default: %(default)s).")
 args = parser.parse_args()
 
 config_ = getattr(config, args.config)
@@ -34,12 +53,11 @@ train_config = config_.TrainConfig()
 if args.data_dir != "auto":
     data_config.valid_images_dir = args.data_dir
 
-dataset = data_config.valid_dataset
-predict_loader = DataLoader(
-    dataset,
-    batch_size=train_config.valid_batch,
-    shuffle=False
-)
+if args.tiled:
+    # Native resolution, memory is bounded by tiles instead of the valid transform
+    dataset = EdgesDataset(data_config.valid_images_dir, thresholds=data_config.thresholds)
+else:
+    dataset = data_config.valid_dataset
 
 
 generator = model_config.generator
@@ -47,18 +65,60 @@ generator = generator.to(train_config.device)
 
 pretrained = args.gen_pretrained if args.gen_pretrained != "auto" \
                                  else train_config.run_name
-checkpoint.load_pretrained(pretrained, "generator", generator)
-
-predicted = predict(generator, predict_loader, train_config.device)
-save_dir = f"{args.save_dir}/{pretrained}"
-
-
-def save_images(save_dir: str, images):
-    os.makedirs(save_dir, exist_ok=True)
-
-    for name, image in zip(dataset.ids, images):
-        path = f"{save_dir}/{split_extension(os.path.basename(name))[0]}.png"
-        save_image(path, image, args.unnorm == "yes")
-
-
-save_images(save_dir, predicted)
+checkpoint.load_pretrained(pretrained, "generator", generator, args.ema)
+
+save_dir = f"{args.save_dir}/{pretrained}_ema" if args.ema else f"{args.save_dir}/{pretrained}"
+os.makedirs(save_dir, exist_ok=True)
+ImageWriter.remove_temporary(save_dir)
+
+paths = [f"{save_dir}/{split_extension(os.path.basename(name))[0]}.png" for name in dataset.ids]
+indices = [i for i, path in enumerate(paths) if args.overwrite or not os.path.exists(path)]
+print(f"Predicting {len(indices)} of {len(paths)} images")
+
+predict_loader = data_loader(
+    Subset(dataset, indices),
+    batch_size=1 if args.tiled else train_config.valid_batch,
+    shuffle=False,
+    num_workers=train_config.num_workers,
+    pin_memory=train_config.pin_memory,
+    prefetch_factor=train_config.prefetch_factor
+)
+# Aspect ratio buckets reorder samples
+order = [indices[i] for batch in predict_loader.batch_sampler for i in batch]
+if not args.tiled:
+    predict_loader = data_config.edges_loader(predict_loader, train_config.device)
+
+if args.tiled:
+    if train_config.fold_bn:
+        generator = fold_batch_norms(generator)
+    # Images of different sizes come one per batch
+    predicted_batches = (
+        predict_tiled(generator, input[0], args.tile_size, args.tile_overlap,
+                      args.tile_batch, train_config.device)[None]
+        for input, _ in tqdm(predict_loader, desc="Predict")
+    )
+else:
+    predicted_batches = predict_batches(generator, predict_loader, train_config.device,
+                                        memory_budget=train_config.eval_memory_budget,
+                                        fold_bn=train_config.fold_bn)
+
+
+reset_peak_memory(train_config.device)
+paths = iter([paths[i] for i in order])
+num_pixels = 0
+start = time.perf_counter()
+# Images are encoded in background while next batches are predicted,
+# few native resolution images are kept in memory
+with ImageWriter(args.n_threads, args.unnorm == "yes",
+                 max_pending=2 * args.n_threads if args.tiled else 256) as writer:
+    for predicted in predicted_batches:
+        for image in predicted:
+            num_pixels += image.shape[-2] * image.shape[-1]
+            writer.write(next(paths), image)
+elapsed = time.perf_counter() - start
+if torch.device(train_config.device).type == "cuda":
+    print("Peak memory: %.1f Mb" % peak_memory(train_config.device))
+else:
+    print("Process peak memory: %.1f Mb" % peak_memory(train_config.device))
+if num_pixels:
+    print("Throughput: %.2f Mpx/s, %.3f s/Mpx" % (num_pixels / 1e6 / elapsed, elapsed / (num_pixels / 1e6)))
@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import onnxruntime
+from PIL import Image
+from tqdm.auto import tqdm
+
+
+parser = argparse.ArgumentParser(description="Process images using generator exported by bin/export_onnx.py. "
+                                             "Runs on CPU without torch.")
+parser.add_argument("model", type=str,
+                    help="Path to exported ONNX model.")
+parser.add_argument("-d", "--data_dir", type=str, required=True,
+                    help="Path to directory with input images.")
+parser.add_argument("-s", "--save_dir", type=str, default="resources/predicted_onnx",
+                    help="Where to save images (default: %(default)s).")
+parser.add_argument("-b", "--batch", metavar="INT", type=int, default=8,
+                    help="Batch size (default: %(default)s).")
+parser.add_argument("--unnorm", type=str, choices=["yes", "no"], default="yes",
+                    help="Unnormalize images [-1; 1] -> [0, 1] when saving (default: %(default)s).")
+parser.add_argument("--n_threads", metavar="INT", type=int, default=os.cpu_count(),
+                    help="Number of threads for ONNX Runtime and image processing (default: %(default)s).")
+parser.add_argument("--overwrite", action="store_true",
+                    help="Predict all images, otherwise skip images already saved.")
+
+
+def pre_transform(image: Image.Image, resize = None, crop = None) -> Image.Image:
+    """Resize & center crop as torchvision transforms do on PIL images."""
+    if resize is not None:
+        width, height = image.size
+        if isinstance(resize, int):
+            # Smaller edge is matched to size
+            if width <= height:
+                size = resize, int(resize * height / width)
+            else:
+                size = int(resize * width / height), resize
+        else:
+            size = resize[1], resize[0]
+        image = image.resize(size, Image.BILINEAR)
+    if crop is not None:
+        width, height = image.size
+        top = int(round((height - crop[0]) / 2.))
+        left = int(round((width - crop[1]) / 2.))
+        image = image.crop((left, top, left + crop[1], top + crop[0]))
+    return image
+
+
+def load(path: str, thresholds, params: dict) -> np.ndarray:
+    """Edges of an image normalized to [-1; 1] as generator input, 1xHxW."""
+    image = cv2.imread(path)[..., ::-1]
+    image = np.array(pre_transform(Image.fromarray(image, mode="RGB"), **params))
+    edges = 255 - cv2.Canny(image, threshold1=thresholds[0], threshold2=thresholds[1])
+    return (edges[None].astype(np.float32) / 255 - 0.5) / 0.5
+
+
+def save(path: str, image: np.ndarray, unnorm: bool):
+    if unnorm:
+        image = image / 2 + 0.5
+    image = np.moveaxis(image.clip(0, 1), 0, -1)
+    image = (image * 255 + 0.5).astype(np.uint8)
+    # Temporary file has no image extension, so leftovers of a killed run are not read as images
+    _, encoded = cv2.imencode(os.path.splitext(path)[1], np.ascontiguousarray(image[..., ::-1]))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(encoded.tobytes())
+    os.replace(tmp_path, path)
+
+
+def main():
+    args = parser.parse_args()
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = args.n_threads
+    session = onnxruntime.InferenceSession(args.model, options, providers=["CPUExecutionProvider"])
+    metadata = session.get_modelmeta().custom_metadata_map
+    thresholds = json.loads(metadata["thresholds"])
+    params = json.loads(metadata["pre_transform"])
+
+    names = sorted(name for name in os.listdir(args.data_dir)
+                   if name.lower().endswith((".png", ".jpg", ".jpeg", ".bmp")))
+    model_name = os.path.splitext(os.path.basename(args.model))[0]
+    save_dir = f"{args.save_dir}/{model_name}"
+    os.makedirs(save_dir, exist_ok=True)
+    # Partial writes of a killed run, also `*.tmp.png` of earlier versions
+    for name in os.listdir(save_dir):
+        if name.endswith(".tmp") or ".tmp." in name:
+            os.remove(f"{save_dir}/{name}")
+
+    jobs = [(f"{args.data_dir}/{name}", f"{save_dir}/{os.path.splitext(name)[0]}.png") for name in names]
+    jobs = [job for job in jobs if args.overwrite or not os.path.exists(job[1])]
+    print(f"Predicting {len(jobs)} of {len(names)} images")
+
+    def load_batch(batch):
+        return np.stack([load(path, thresholds, params) for path, _ in batch])
+
+    batches = [jobs[i:i + args.batch] for i in range(0, len(jobs), args.batch)]
+    # Decoding, edge detection and encoding run in threads while the model runs,
+    # a few batches ahead to keep memory bounded
+    with ThreadPoolExecutor(args.n_threads) as pool:
+        inputs = deque(pool.submit(load_batch, batch) for batch in batches[:2])
+        writes = deque()
+        for i, batch in enumerate(tqdm(batches, desc="Predict")):
+            input = inputs.popleft().result()
+            if i + 2 < len(batches):
+                inputs.append(pool.submit(load_batch, batches[i + 2]))
+            output = session.run(None, {"input": input})[0]
+            for (_, path), image in zip(batch, output):
+                writes.append(pool.submit(save, path, image, args.unnorm == "yes"))
+            while len(writes) > 2 * args.batch:
+                writes.popleft().result()
+        for write in writes:
+            write.result()
+
+
+if __name__ == "__main__":
+    main()
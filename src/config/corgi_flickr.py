@@ -1,16 +1,21 @@
+import hashlib
+
 import torch
 from torch import nn
 from torchvision import transforms
 from torch.utils.data import Dataset
 
 from dataclasses import dataclass
+from functools import cached_property
 from torch.nn import L1Loss
 from torchmetrics import PeakSignalNoiseRatio, StructuralSimilarityIndexMeasure
 
-from ..dataset import EdgesDataset
-from ..models import RandomShift, UNet, PatchDiscriminator, init_weights
+from ..dataset import BucketEdgesDataset, EdgesDataset, EdgesLoader, PackedEdgesDataset, \
+    bucket_shapes, is_packed
+from ..models import CannyEdgeDetector, RandomShift, UNet, PatchDiscriminator, VGGFeatures, \
+    compile_model, convert_sync_batchnorm, init_weights
 from ..loss import EdgeLoss, VGGPerceptualLoss, PreprocessWrapper
-from ..metrics import NegativeLPIPS
+from ..metrics import NegativeFID, NegativeLPIPS, NegativeVGGLPIPS
 from ..schedulers import LinearLR
 
 
@@ -19,32 +24,91 @@ class DataConfig:
     images_dir = "data/corgi_flickr"
     train_images_dir = images_dir + "/train"
     valid_images_dir = images_dir + "/valid"
-    train_pre_transform = transforms.Compose([
-        transforms.Resize(256, antialias=True),
+    train_resize = transforms.Resize(256, antialias=True)
+    train_augment = transforms.Compose([
         # SmartRandomCrop((256, 256),
         #                 kernel_size=smart_crop_kernel_size,
         #                 background_prob=smart_crop_background_prob),
         transforms.RandomCrop((256, 256)),
         transforms.RandomHorizontalFlip(p=0.5)
     ])
+    train_pre_transform = transforms.Compose([train_resize, train_augment])
     valid_pre_transform = transforms.Compose([
         transforms.Resize(256, antialias=True),
         transforms.CenterCrop((256, 256))
     ])
 
     thresholds = (100, 200)
+    # Run Canny on collated batches on device instead of per sample in workers
+    batch_edges = False
+
+    # Batch images of similar aspect ratio at a fixed pixel budget instead of square crops
+    aspect_buckets = False
+    bucket_pixels = 256 * 256
+    bucket_max_ratio = 2.
+
+    cache_dir = "resources/cache"
+
+    @property
+    def train_cache_path(self) -> str:
+        return f"{self.cache_dir}/{self.train_images_dir.strip('/').replace('/', '_')}"
+
+    @property
+    def valid_cache_path(self) -> str:
+        return f"{self.cache_dir}/{self.valid_images_dir.strip('/').replace('/', '_')}"
+
+    @property
+    def buckets(self) -> list:
+        return bucket_shapes(self.bucket_pixels, self.bucket_max_ratio)
+
+    def fid_cache_path(self, dims, resize) -> str:
+        # Reference statistics depend on valid images and their transform
+        transform = self.buckets if self.aspect_buckets else self.valid_pre_transform
+        key = hashlib.md5(repr(transform).encode()).hexdigest()[:8]
+        return f"{self.valid_cache_path}_fid{dims}{'' if resize else '_noresize'}_{key}.npz"
 
     @property
     def train_dataset(self) -> Dataset:
+        if self.aspect_buckets:
+            # Resized images keep aspect ratio, so the cache is valid for buckets
+            cache_path = self.train_cache_path if is_packed(self.train_cache_path, self.train_images_dir,
+                                                            pre_transform=repr(self.train_resize)) else None
+            return BucketEdgesDataset(self.train_images_dir,
+                                      self.buckets,
+                                      augment=True,
+                                      thresholds=self.thresholds,
+                                      cache_path=cache_path,
+                                      with_edges=not self.batch_edges)
+        if is_packed(self.train_cache_path, self.train_images_dir, pre_transform=repr(self.train_resize)):
+            return EdgesDataset(self.train_images_dir,
+                                self.train_augment,
+                                thresholds=self.thresholds,
+                                cache_path=self.train_cache_path,
+                                with_edges=not self.batch_edges)
         return EdgesDataset(self.train_images_dir,
                             self.train_pre_transform,
-                            thresholds=self.thresholds)
+                            thresholds=self.thresholds,
+                            with_edges=not self.batch_edges)
 
     @property
     def valid_dataset(self) -> Dataset:
+        if self.aspect_buckets:
+            return BucketEdgesDataset(self.valid_images_dir,
+                                      self.buckets,
+                                      thresholds=self.thresholds,
+                                      with_edges=not self.batch_edges)
+        if is_packed(self.valid_cache_path, self.valid_images_dir, thresholds=list(self.thresholds),
+                     pre_transform=repr(self.valid_pre_transform)):
+            return PackedEdgesDataset(self.valid_cache_path)
         return EdgesDataset(self.valid_images_dir,
                             self.valid_pre_transform,
-                            thresholds=self.thresholds)
+                            thresholds=self.thresholds,
+                            with_edges=not self.batch_edges)
+
+    def edges_loader(self, loader, device):
+        if not self.batch_edges:
+            return loader
+        return EdgesLoader(loader, CannyEdgeDetector(self.thresholds).to(device), device)
 
 
 @dataclass
@@ -52,17 +116,28 @@ class ModelConfig:
     gen_in_channels = 1
     gen_out_channels = 3
     gen_hidden_channels = 48
+    gen_checkpoint_levels = ()  # UNet levels recomputing activations in backward, 0 (full resolution) to 4
 
     dis_in_channels = 4
     dis_out_channels = 1
     dis_num_levels = 5
     dis_hidden_channels = 64
 
+    # torch.compile models, TorchScript on torch < 2.0
+    compiled = False
+    compile_cache_dir = "resources/cache/compiled"
+    # Batch norm statistics over batches of all processes in distributed training
+    sync_bn = False
+
     @property
     def generator(self) -> nn.Module:
         model = UNet(self.gen_in_channels, self.gen_out_channels,
-                     self.gen_hidden_channels)
+                     self.gen_hidden_channels, checkpoint_levels=self.gen_checkpoint_levels)
         model.apply(init_weights)
+        if self.sync_bn:
+            model = convert_sync_batchnorm(model)
+        if self.compiled:
+            model = compile_model(model, self.compile_cache_dir)
         return model
 
     @property
@@ -70,6 +145,10 @@ class ModelConfig:
         model = PatchDiscriminator(self.dis_in_channels, self.dis_out_channels,
                                    self.dis_num_levels, self.dis_hidden_channels)
         model.apply(init_weights)
+        if self.sync_bn:
+            model = convert_sync_batchnorm(model)
+        if self.compiled:
+            model = compile_model(model, self.compile_cache_dir)
         return model
 
 
@@ -81,32 +160,61 @@ class TrainConfig:
 
     num_epochs = 100
 
-    train_batch = 8
+    train_batch = 8  # Samples per optimizer step
+    train_micro_batch = None  # Samples per forward/backward pass, grads are accumulated; None for whole batch
+                              # Not supported with `compiled = True` on torch < 2.0 (TorchScript fallback)
     valid_batch = 512
+    eval_memory_budget = 4096  # Mb of activations per valid/predict chunk, None for whole batches
+    fold_bn = False  # Fold batch norms into convolutions for valid/test/predict
 
-    num_workers = 0
+    num_workers = "auto"
+    pin_memory = True
+    persistent_workers = True
+    prefetch_factor = 2
+    prefetch_batches = 2  # Batches moved to device in background, 0 to disable
 
     dis_loss_coef = 0.02
     min_dis_loss = 0.3
     steps_to_skip = 1
     steps_to_wait = 1
+    dis_joint_forward = True  # Real and fake samples in one discriminator batch
 
     l1_coef = 1
     edge_coef = 0
     vgg_coef = 0.03
+    vgg_cache_size = None  # Mb of valid target VGG features cached on device, None to disable
+    lpips_vgg_backbone = False  # Perceptual loss on LPIPS-VGG16 trunk and scaling, LPIPS-VGG instead of AlexNet,
+                                # both share one pass per valid batch
+
+    valid_metric_name = "lpips"  # "fid" to select checkpoints by FID
+
+    fid_dims = None  # Inception features for FID/KID over valid set (2048, or 64 on CPU), None to disable
+    fid_resize = True  # Resize to 299x299 as pytorch-fid, False is faster but not comparable
+    fid_kid = False
 
-    valid_metric_name = "lpips"
+    log_every = 10  # Train steps between logs
+    log_metric_samples = None  # Batch samples used for train metrics, None for all
 
     gen_lr = 2e-4
     dis_lr = 2e-5
 
     betas = (0.5, 0.999)
 
+    amp_dtype = None  # "bfloat16" or "float16" to train with autocast
+    channels_last = False  # NHWC batches, models, losses and metrics
+
+    ema_decay = None  # Decay of generator weights average saved for inference, e.g. 0.999, None to disable
+    ema_every = 10  # Train steps between average updates
+    ema_device = None  # "cpu" to keep the average off the training device
+    ema_dtype = None  # e.g. "bfloat16" to store the average in lower precision
+
     gen_grad_clip_threshold = None
     dis_grad_clip_threshold = 1.
 
     provide_metric_to_scheduler = False
     n_best_save = 1
+    checkpoint_keep = 1  # Last checkpoints kept on disk, None to keep all
+    checkpoint_full_every = 1  # Saves between full checkpoints, others only store changed model tensors
 
     def gen_scheduler(self, optimizer):
         return LinearLR(optimizer, start_factor=1, end_factor=0,
@@ -128,15 +236,31 @@ class TrainConfig:
         if self.vgg_coef:
             criterion["vgg_perceptual_loss"] = self.vgg_coef, PreprocessWrapper(
                 RandomShift(),
-                VGGPerceptualLoss(avgpool=True)
+                VGGPerceptualLoss(avgpool=True, cache_size=self.vgg_cache_size,
+                                  backbone=self.backbone if self.lpips_vgg_backbone else None)
             ).to(self.device)
         return criterion
 
+    @cached_property
+    def backbone(self) -> nn.Module:
+        # Single instance, so that loss and metric reuse activations
+        return VGGFeatures().to(self.device)
+
     @property
     def metric(self) -> dict:
         return {"psnr": PeakSignalNoiseRatio().to(self.device),
                 "ssim": StructuralSimilarityIndexMeasure().to(self.device),
-                "lpips": NegativeLPIPS(verbose=False).to(self.device)}
+                "lpips": NegativeVGGLPIPS(self.backbone).to(self.device) if self.lpips_vgg_backbone
+                         else NegativeLPIPS(verbose=False).to(self.device),
+                **self.fid_metric}
+
+    @property
+    def fid_metric(self) -> dict:
+        if not self.fid_dims:
+            return dict()
+        cache_path = DataConfig().fid_cache_path(self.fid_dims, self.fid_resize)
+        return {"fid": NegativeFID(cache_path, self.fid_dims, self.fid_resize,
+                                   kid=self.fid_kid).to(self.device)}
 
     @property
     def run_name(self) -> str:
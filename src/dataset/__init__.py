@@ -1,2 +1,5 @@
+from .buckets import BucketBatchSampler, BucketEdgesDataset, bucket_shapes
 from .edges import EdgesDataset
-from .loader import EpochLoader
+from .loader import DevicePrefetcher, EdgesLoader, EpochLoader, auto_num_workers, data_loader, set_epoch
+from .packed import PackedEdgesDataset, pack_edges, pack_images, is_packed
+from .shard import Shard, ShardWriter
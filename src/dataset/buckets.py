@@ -0,0 +1,182 @@
+import math
+import numpy as np
+import torch
+from collections import defaultdict
+from PIL import Image
+from torch.utils.data import Sampler, Subset
+from torchvision import transforms
+from torchvision.transforms import functional as F
+from typing import List, Sequence, Tuple
+
+from .edges import EdgesDataset
+
+
+def bucket_shapes(pixels: int = 256 * 256, max_ratio: float = 2., step: int = 32) -> List[Tuple[int, int]]:
+    """(height, width) shapes of about `pixels` area for aspect ratios up to `max_ratio`.
+
+    Sides are multiples of `step`, so that they are divisible by model strides.
+
+    """
+    shapes = set()
+    for width in range(step, int(math.sqrt(pixels * max_ratio)) + 1, step):
+        height = pixels // width // step * step
+        if height > 0 and max(height / width, width / height) <= max_ratio:
+            shapes.add((height, width))
+    return sorted(shapes, key=lambda shape: shape[1] / shape[0])
+
+
+def nearest_bucket(size: Tuple[int, int], buckets: Sequence[Tuple[int, int]]) -> int:
+    """Index of the bucket with the closest aspect ratio to (height, width) size."""
+    ratio = math.log(size[1] / size[0])
+    return min(range(len(buckets)), key=lambda i: abs(math.log(buckets[i][1] / buckets[i][0]) - ratio))
+
+
+def dataset_bucket_ids(dataset):
+    """Bucket of each sample for datasets with aspect ratio buckets, otherwise None."""
+    if isinstance(dataset, Subset):
+        bucket_ids = dataset_bucket_ids(dataset.dataset)
+        return None if bucket_ids is None else [bucket_ids[i] for i in dataset.indices]
+    return getattr(dataset, "bucket_ids", None)
+
+
+class BucketEdgesDataset(EdgesDataset):
+    """Edges dataset with images resized and cropped to the nearest aspect ratio bucket.
+
+    Images of one bucket have the same shape, so they are collated together
+    by `BucketBatchSampler`.
+
+    Args:
+        images_dir (str): path to images folder
+        buckets (list): (height, width) shapes, see `bucket_shapes`
+        augment (bool): random crop and horizontal flip, otherwise center crop
+        thresholds (tuple): Canny edge detection params
+        cache_path (str): shard written by `pack_images` to read images
+            from instead of decoding files in `images_dir`
+        with_edges (bool): extract edges, otherwise return target only
+            for edge detection on collated batches (see `EdgesLoader`)
+
+    """
+
+    def __init__(
+            self,
+            images_dir,
+            buckets,
+            augment = False,
+            thresholds = (100, 200),
+            cache_path = None,
+            with_edges = True
+    ):
+        super().__init__(images_dir, thresholds=thresholds, cache_path=cache_path, with_edges=with_edges)
+        self.buckets = list(buckets)
+        self.augment = augment
+        self.bucket_ids = [nearest_bucket(size, self.buckets) for size in self.image_sizes()]
+
+    def image_sizes(self) -> List[Tuple[int, int]]:
+        """(height, width) of images without decoding them."""
+        if self.cache is not None:
+            return [tuple(record["image"][1][:2]) for record in self.cache.records]
+        sizes = []
+        for path in self.ids:
+            # Only the header is read
+            with Image.open(path) as image:
+                width, height = image.size
+            sizes.append((height, width))
+        return sizes
+
+    def load_target(self, i):
+        """Load i-th target as uint8 HxWx3 array of its bucket shape."""
+        target = Image.fromarray(self.read(i), mode="RGB")
+        height, width = self.buckets[self.bucket_ids[i]]
+
+        # Cover bucket shape keeping aspect ratio, the rest is cropped
+        scale = max(height / target.height, width / target.width)
+        size = [max(height, round(target.height * scale)), max(width, round(target.width * scale))]
+        target = F.resize(target, size, antialias=True)
+
+        if self.augment:
+            top, left, _, _ = transforms.RandomCrop.get_params(target, (height, width))
+            target = F.crop(target, top, left, height, width)
+            if torch.rand(1) < 0.5:
+                target = F.hflip(target)
+        else:
+            target = F.center_crop(target, [height, width])
+        return np.array(target)
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler yielding batches of samples from one bucket.
+
+    Args:
+        bucket_ids (sequence): bucket of each sample
+        batch_size (int): batch size
+        shuffle (bool): shuffle samples within buckets and order of batches
+        drop_last (bool): drop incomplete batch of each bucket
+        num_replicas (int): number of processes in distributed training
+        rank (int): rank of the current process, it gets every `num_replicas`-th batch
+        seed (int): shuffling seed shared by processes in distributed training
+
+    """
+
+    def __init__(
+            self,
+            bucket_ids,
+            batch_size,
+            shuffle = False,
+            drop_last = False,
+            num_replicas = 1,
+            rank = 0,
+            seed = 0
+    ):
+        self.bucket_ids = list(bucket_ids)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def _batches(self) -> List[List[int]]:
+        generator = None
+        if self.num_replicas > 1:
+            # Same order in all processes, different in every epoch
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            self.epoch += 1
+
+        order = torch.randperm(len(self.bucket_ids), generator=generator).tolist() if self.shuffle \
+                else range(len(self.bucket_ids))
+        buckets = defaultdict(list)
+        for i in order:
+            buckets[self.bucket_ids[i]].append(i)
+
+        batches = []
+        for bucket in sorted(buckets):
+            indices = buckets[bucket]
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+            # Processes make the same number of steps
+            batches = batches[:len(batches) // self.num_replicas * self.num_replicas]
+        return batches[self.rank::self.num_replicas]
+
+    def set_epoch(self, epoch: int):
+        """Shuffling epoch in distributed training, it is advanced after every pass."""
+        self.epoch = epoch
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        counts = np.bincount(self.bucket_ids) if self.bucket_ids else np.zeros(0, dtype=int)
+        if self.drop_last:
+            num_batches = int(sum(counts // self.batch_size))
+        else:
+            num_batches = int(sum(-(-counts // self.batch_size)))
+        if self.shuffle:
+            return num_batches // self.num_replicas
+        return len(range(self.rank, num_batches, self.num_replicas))
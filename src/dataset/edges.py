@@ -5,9 +5,23 @@ from PIL import Image
 from torchvision import transforms
 from torch.utils.data import Dataset
 
+from .shard import Shard
 from .transforms import default_input_post_transform, default_target_post_transform
 
 
+def image_ids(images_dir: str) -> list:
+    """Sorted paths of images in folder, as `EdgesDataset` ids."""
+    images_dir = images_dir[:-1] if images_dir[-1] == "/" else images_dir
+    ids = [name for name in os.listdir(images_dir) if
+           name.lower().endswith('.png') or
+           name.lower().endswith('.jpg') or
+           name.lower().endswith('.jpeg') or
+           # name.lower().endswith('.gif') or
+           name.lower().endswith('.bmp')]
+    ids.sort()
+    return [images_dir + "/" + name for name in ids]
+
+
 class EdgesDataset(Dataset):
     """Edges dataset. Read images and apply transforms.
 
@@ -20,6 +34,10 @@ class EdgesDataset(Dataset):
         target_post_transform (torchvision.transforms.transform):
             target image transform after edge detection
         thresholds (tuple): Canny edge detection params
+        cache_path (str): shard written by `pack_images` to read images
+            from instead of decoding files in `images_dir`
+        with_edges (bool): extract edges, otherwise return target only
+            for edge detection on collated batches (see `EdgesLoader`)
 
     """
 
@@ -29,7 +47,9 @@ class EdgesDataset(Dataset):
             pre_transform = None,
             input_post_transform = None,
             target_post_transform = None,
-            thresholds = (100, 200)
+            thresholds = (100, 200),
+            cache_path = None,
+            with_edges = True
     ):
         self.images_dir = images_dir[:-1] if images_dir[-1] == "/" else images_dir
         self.pre_transform = transforms.Lambda(lambda x: x) if pre_transform is None else pre_transform
@@ -38,33 +58,56 @@ class EdgesDataset(Dataset):
         self.target_post_transform = default_target_post_transform() if target_post_transform is None \
                                                                      else target_post_transform
         self.thresholds = thresholds
+        self.with_edges = with_edges
 
-        self.ids = [name for name in os.listdir(self.images_dir) if
-                    name.lower().endswith('.png') or
-                    name.lower().endswith('.jpg') or
-                    name.lower().endswith('.jpeg') or
-                    # name.lower().endswith('.gif') or
-                    name.lower().endswith('.bmp')]
-        self.ids.sort()
+        self.cache = None
+        if cache_path is not None:
+            self.cache = Shard(cache_path)
+            self.ids = self.cache.meta["ids"]
+            return
 
-        self.ids = [self.images_dir + "/" + name for name in self.ids]
+        self.ids = image_ids(self.images_dir)
 
-    def __getitem__(self, i):
+    def read(self, i):
+        """Read i-th image as RGB uint8 array."""
+        if self.cache is not None:
+            return self.cache[i]["image"]
+        image = cv2.imread(self.ids[i])
+        return image[..., ::-1]
+
+    def load_target(self, i):
+        """Load i-th target as uint8 HxWx3 array before post-transforms."""
         # Load image
-        target = cv2.imread(self.ids[i])
-        target = target[..., ::-1]
+        target = self.read(i)
         # pair = cv2.cvtColor(pair, cv2.COLOR_BGR2GRAY)
 
         # Apply pre-transforms
         target = Image.fromarray(target, mode="RGB")
-        target = self.pre_transform(target)
+        return np.array(self.pre_transform(target))
+
+    def load(self, i):
+        """Load i-th sample as uint8 arrays before post-transforms.
+
+        Returns:
+            tuple of (edges HxW, target HxWx3)
+
+        """
+        target = self.load_target(i)
 
         # Extract edges
-        input = cv2.Canny(np.asarray(target),
+        input = cv2.Canny(target,
                           threshold1=self.thresholds[0],
                           threshold2=self.thresholds[1])
         input = 255 - input
 
+        return input, target
+
+    def __getitem__(self, i):
+        if not self.with_edges:
+            return self.target_post_transform(self.load_target(i))
+
+        input, target = self.load(i)
+
         # Apply post-transforms
         input = self.input_post_transform(input)
         target = self.target_post_transform(target)
@@ -1,3 +1,15 @@
+import os
+import queue
+import threading
+import torch
+import torch.distributed as dist
+
+from torch.utils.data import DataLoader, DistributedSampler
+from typing import Sequence
+
+from .buckets import BucketBatchSampler, dataset_bucket_ids
+
+
 class EpochLoader:
     """Arbitrary epoch size data loader.
 
@@ -44,3 +56,251 @@ class EpochLoader:
     @dataset.setter
     def dataset(self, value):
         self.loader.dataset = value
+
+
+class EdgesLoader:
+    """Data loader extracting edges from collated target batches.
+
+    Batches of (input, target) pairs, e.g. from packed datasets with
+    precomputed edges, are passed through unchanged.
+
+    Args:
+        loader: torch dataloader over dataset with `with_edges=False`
+        edge_detector (nn.Module): batched edge detector, e.g. `CannyEdgeDetector`
+        device (torch.device): device to run edge detection on
+
+    """
+
+    def __init__(
+            self,
+            loader,
+            edge_detector,
+            device = "cuda:0"
+    ):
+        self.loader = loader
+        self.edge_detector = edge_detector
+        self.device = device
+
+    def __iter__(self):
+        for batch in self.loader:
+            if isinstance(batch, Sequence):
+                input, target = batch
+                yield input.to(self.device), target.to(self.device)
+                continue
+
+            target = batch.to(self.device)
+            with torch.no_grad():
+                input = self.edge_detector(target)
+            yield input, target
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @dataset.setter
+    def dataset(self, value):
+        self.loader.dataset = value
+
+
+def auto_num_workers(max_workers: int = 8) -> int:
+    """Number of dataloader workers for available cores, one core is left for the main process."""
+    try:
+        num_cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        num_cores = os.cpu_count() or 1
+    return max(0, min(max_workers, num_cores - 1))
+
+
+class DistributedEpochSampler(DistributedSampler):
+    """`DistributedSampler` advancing its epoch after every pass,
+    so that shuffling changes between epochs without `set_epoch` calls.
+    Resumed training sets the epoch explicitly, see `set_epoch`.
+
+    Without shuffling samples are not padded to equal shards, e.g. for validation.
+
+    """
+
+    def __iter__(self):
+        if not self.shuffle:
+            return iter(range(self.rank, len(self.dataset), self.num_replicas))
+        indices = list(super().__iter__())
+        self.epoch += 1
+        return iter(indices)
+
+    def __len__(self):
+        if not self.shuffle:
+            return len(range(self.rank, len(self.dataset), self.num_replicas))
+        return super().__len__()
+
+
+def set_epoch(loader, epoch: int):
+    """Set shuffling epoch of distributed samplers of a (wrapped) data loader, e.g. when resuming training."""
+    while not isinstance(loader, DataLoader):
+        loader = getattr(loader, "loader", None)
+        if loader is None:
+            return
+    for sampler in (loader.sampler, loader.batch_sampler):
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+
+
+def data_loader(dataset, batch_size: int, shuffle: bool = False, num_workers = "auto",
+                pin_memory: bool = False, persistent_workers: bool = False,
+                prefetch_factor: int = 2, **kwargs) -> DataLoader:
+    """
+    Create dataloader, multiprocessing options are only set if workers are used.
+
+    Args:
+        dataset (torch.utils.data.Dataset): dataset to load
+        batch_size (int): batch size
+        shuffle (bool): reshuffle data every epoch
+        num_workers (int or str): number of worker processes or "auto"
+        pin_memory (bool): copy batches into page-locked memory, ignored without CUDA
+        persistent_workers (bool): keep workers alive between epochs
+        prefetch_factor (int): batches loaded in advance by each worker
+        **kwargs: other `DataLoader` arguments
+
+    Returns:
+        torch.utils.data.DataLoader
+
+    Datasets with aspect ratio buckets (see `BucketEdgesDataset`) are batched by `BucketBatchSampler`.
+    In distributed training every process loads its own shard of the dataset.
+
+    """
+    distributed = dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+    bucket_ids = dataset_bucket_ids(dataset)
+    if bucket_ids is not None:
+        # Samples of a batch share bucket shape
+        kwargs["batch_sampler"] = BucketBatchSampler(
+            bucket_ids, batch_size, shuffle, kwargs.pop("drop_last", False),
+            num_replicas=dist.get_world_size() if distributed else 1,
+            rank=dist.get_rank() if distributed else 0
+        )
+        batch_size, shuffle = 1, False
+    elif distributed:
+        kwargs["sampler"] = DistributedEpochSampler(dataset, shuffle=shuffle)
+        shuffle = False
+    if num_workers == "auto":
+        num_workers = auto_num_workers()
+    if num_workers > 0:
+        kwargs["persistent_workers"] = persistent_workers
+        kwargs["prefetch_factor"] = prefetch_factor
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        pin_memory=pin_memory and torch.cuda.is_available(),
+        **kwargs
+    )
+
+
+def to_device(batch, device, non_blocking: bool = False, memory_format = torch.preserve_format):
+    if isinstance(batch, torch.Tensor):
+        if batch.dim() != 4:
+            memory_format = torch.preserve_format
+        return batch.to(device, non_blocking=non_blocking, memory_format=memory_format)
+    return type(batch)(to_device(item, device, non_blocking, memory_format) for item in batch)
+
+
+def record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    else:
+        for item in batch:
+            record_stream(item, stream)
+
+
+class DevicePrefetcher:
+    """Data loader moving batches to device ahead of time in a background thread.
+
+    On CUDA devices copies run on a side stream, so they overlap with
+    computations of the current batch.
+
+    Args:
+        loader: torch dataloader object
+        device (torch.device): device to move batches to
+        num_batches (int): number of batches prepared in advance
+        memory_format (torch.memory_format): layout of image batches on device,
+            e.g. `torch.channels_last`, converted by the same copy
+
+    """
+
+    def __init__(
+            self,
+            loader,
+            device = "cuda:0",
+            num_batches = 2,
+            memory_format = torch.preserve_format
+    ):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_batches = num_batches
+        self.memory_format = memory_format
+
+    @staticmethod
+    def _put(batches: queue.Queue, stop: threading.Event, item) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, batches: queue.Queue, stop: threading.Event):
+        stream = None
+        if self.device.type == "cuda":
+            stream = torch.cuda.Stream(self.device)
+        try:
+            for batch in self.loader:
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = to_device(batch, self.device, non_blocking=True, memory_format=self.memory_format)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = to_device(batch, self.device, memory_format=self.memory_format)
+                if not self._put(batches, stop, (batch, event)):
+                    return
+        except Exception as e:
+            self._put(batches, stop, (e, None))
+            return
+        self._put(batches, stop, (None, None))
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, event = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    # Memory allocated on side stream must not be reused before consumed
+                    record_stream(batch, current_stream)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @dataset.setter
+    def dataset(self, value):
+        self.loader.dataset = value
@@ -0,0 +1,126 @@
+import numpy as np
+
+from PIL import Image
+from tqdm.auto import tqdm
+from torch.utils.data import Dataset
+
+from .edges import EdgesDataset, image_ids
+from .shard import Shard, ShardWriter
+from .transforms import default_input_post_transform, default_target_post_transform
+
+
+def pack_edges(dataset: EdgesDataset, path: str, progress: bool = True):
+    """Precompute edges and targets of deterministic dataset into a shard.
+
+    Args:
+        dataset (EdgesDataset): dataset with deterministic pre-transform
+        path (str): shard path without extension
+        progress (bool): draw progressbar
+
+    """
+    indices = range(len(dataset))
+    if progress:
+        indices = tqdm(indices, desc="Packing data")
+
+    with ShardWriter(path, ("input", "target")) as writer:
+        for i in indices:
+            input, target = dataset.load(i)
+            writer.write(input=input, target=target)
+        writer.close(ids=dataset.ids, thresholds=list(dataset.thresholds),
+                     pre_transform=repr(dataset.pre_transform))
+
+
+def pack_images(dataset: EdgesDataset, path: str, progress: bool = True):
+    """Store pre-transformed images of dataset into a shard.
+
+    Only deterministic part of the transform (e.g. resize) should be used
+    as dataset pre-transform. Random augmentations are applied on top of
+    cached images by `EdgesDataset(..., cache_path=path)`.
+
+    Args:
+        dataset (EdgesDataset): dataset with deterministic pre-transform
+        path (str): shard path without extension
+        progress (bool): draw progressbar
+
+    """
+    indices = range(len(dataset))
+    if progress:
+        indices = tqdm(indices, desc="Packing images")
+
+    with ShardWriter(path, ("image",)) as writer:
+        for i in indices:
+            image = Image.fromarray(dataset.read(i), mode="RGB")
+            writer.write(image=np.array(dataset.pre_transform(image)))
+        writer.close(ids=dataset.ids, pre_transform=repr(dataset.pre_transform))
+
+
+def is_packed(path: str, images_dir: str = None, **meta) -> bool:
+    """Check that shard exists and was packed with the given params.
+
+    Args:
+        path (str): shard path without extension
+        images_dir (str): folder the shard was packed from, its images must not
+            have been added or removed since, None to skip the check
+        **meta: expected values of shard metadata, e.g.
+            `thresholds=[100, 200], pre_transform=repr(transform)`
+
+    """
+    if not Shard.exists(path):
+        return False
+    shard_meta = Shard(path).meta
+    if images_dir is not None and shard_meta.get("ids") != image_ids(images_dir):
+        return False
+    return all(shard_meta.get(key) == value for key, value in meta.items())
+
+
+class PackedEdgesDataset(Dataset):
+    """Edges dataset read from a shard written by `pack_edges`.
+
+    Args:
+        path (str): shard path without extension
+        input_post_transform (torchvision.transforms.transform):
+            input image transform after edge detection
+        target_post_transform (torchvision.transforms.transform):
+            target image transform after edge detection
+        with_edges (bool): return stored edges, otherwise return target only
+            for edge detection on collated batches (see `EdgesLoader`)
+
+    """
+
+    def __init__(
+            self,
+            path,
+            input_post_transform = None,
+            target_post_transform = None,
+            with_edges = True
+    ):
+        self.shard = Shard(path)
+        self.input_post_transform = default_input_post_transform() if input_post_transform is None \
+                                                                   else input_post_transform
+        self.target_post_transform = default_target_post_transform() if target_post_transform is None \
+                                                                     else target_post_transform
+        self.ids = self.shard.meta["ids"]
+        self.thresholds = tuple(self.shard.meta["thresholds"])
+        self.with_edges = with_edges
+
+    def load_target(self, i):
+        return self.shard[i]["target"]
+
+    def load(self, i):
+        record = self.shard[i]
+        return record["input"], record["target"]
+
+    def __getitem__(self, i):
+        if not self.with_edges:
+            return self.target_post_transform(self.load_target(i))
+
+        input, target = self.load(i)
+
+        # Apply post-transforms
+        input = self.input_post_transform(input)
+        target = self.target_post_transform(target)
+
+        return input, target
+
+    def __len__(self):
+        return len(self.shard)
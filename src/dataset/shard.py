@@ -0,0 +1,113 @@
+import os
+import json
+import numpy as np
+
+from typing import Dict, Sequence
+
+
+class ShardWriter:
+    """Sequential writer of uint8 array records into a single binary shard.
+
+    Records are appended to `{path}.bin`, offsets and shapes go to
+    `{path}.json` index on close.
+
+    Args:
+        path (str): shard path without extension
+        fields (sequence): names of arrays stored in every record
+
+    """
+
+    def __init__(
+            self,
+            path: str,
+            fields: Sequence[str]
+    ):
+        self.path = path
+        self.fields = list(fields)
+        self.records = []
+        self.offset = 0
+
+        shard_dir = os.path.dirname(path)
+        if shard_dir:
+            os.makedirs(shard_dir, exist_ok=True)
+        self.file = open(path + ".bin.tmp", "wb")
+
+    def write(self, **arrays: np.ndarray):
+        record = dict()
+        for key in self.fields:
+            array = np.ascontiguousarray(arrays[key], dtype=np.uint8)
+            self.file.write(array.tobytes())
+            record[key] = [self.offset, list(array.shape)]
+            self.offset += array.nbytes
+        self.records += [record]
+
+    def close(self, **meta):
+        if self.file.closed:
+            return
+        self.file.close()
+        index = {"fields": self.fields, "records": self.records, "meta": meta}
+        with open(self.path + ".json.tmp", "w") as f:
+            json.dump(index, f)
+        # Index is moved last so that a partially written shard is never picked up
+        os.replace(self.path + ".bin.tmp", self.path + ".bin")
+        os.replace(self.path + ".json.tmp", self.path + ".json")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif not self.file.closed:
+            self.file.close()
+            os.remove(self.path + ".bin.tmp")
+
+
+class Shard:
+    """Memory-mapped reader of a shard written by `ShardWriter`.
+
+    Records are returned as numpy views into the mapped file without copying.
+    The file is mapped lazily, so the object can be safely sent to
+    dataloader workers.
+
+    Args:
+        path (str): shard path without extension
+
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path + ".json", "r") as f:
+            index = json.load(f)
+        self.fields = index["fields"]
+        self.records = index["records"]
+        self.meta = index["meta"]
+        self._data = None
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path + ".json") and os.path.exists(path + ".bin")
+
+    @property
+    def data(self) -> np.ndarray:
+        if self._data is None:
+            # Copy-on-write mapping gives writable views without touching the file
+            self._data = np.memmap(self.path + ".bin", dtype=np.uint8, mode="c")
+        return self._data
+
+    def __getitem__(self, i) -> Dict[str, np.ndarray]:
+        record = self.records[i]
+        out = dict()
+        for key in self.fields:
+            offset, shape = record[key]
+            size = int(np.prod(shape))
+            out[key] = self.data[offset:offset + size].reshape(shape)
+        return out
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
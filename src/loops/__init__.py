@@ -1,3 +1,3 @@
 from .train import train
 from .test import test
-from .predict import predict
+from .predict import predict, predict_batches, predict_tiled
@@ -1,43 +1,139 @@
 import torch
 
-from typing import Sequence
+from torch import Tensor
+from typing import List, Sequence
 from tqdm.auto import tqdm
 
+from ..models import fold_batch_norms
+from ..utils import micro_batch_size, micro_batches
 
-def predict(model, data_loader, device = "cuda:0", post_process = None):
+
+def predict_batches(model, data_loader, device = "cuda:0", post_process = None, memory_budget = None, fold_bn = False):
     """
-    Run model on data and collect predictions.
+    Run model on data and yield predictions batch by batch.
 
     Args:
         model (torch.nn.Module): model to be tested
         data_loader (torch.utils.data.Dataloader): dataloader with predict set
         device (torch.device): device to train on
+        post_process (callable): function of (input, prediction) applied to predictions
+        memory_budget (float): memory for activations per chunk of a batch, Mb.
+            None to process whole batches
+        fold_bn (bool): predict with a copy of the model with batch norms folded into convolutions
 
-    Returns:
-        predicted betas
+    Yields:
+        predictions on cpu or tuple of (predictions, post-processed predictions)
     """
+    micro_batch = None
 
-    preds = []
-    ppreds = []
-
+    if fold_bn:
+        model = fold_batch_norms(model)
     model.eval()
     for pair in tqdm(data_loader, desc="Predict"):
         if isinstance(pair, Sequence):
             input, target = pair
         else:
             input = pair
-        input = input.to(device)
-        with torch.no_grad():
-            pred = model(input)
 
-        preds += [pred.cpu()]
+        if micro_batch is None:
+            micro_batch = micro_batch_size(lambda x: model(x.to(device)), [input[:1]],
+                                           memory_budget, len(input))
 
-        if post_process is not None:
-            ppred = post_process(input, pred)
-            ppreds += [ppred.cpu()]
+        for input, in micro_batches([input], micro_batch):
+            input = input.to(device)
+            with torch.no_grad():
+                pred = model(input)
+
+            if post_process is not None:
+                ppred = post_process(input, pred)
+                yield pred.cpu(), ppred.cpu()
+            else:
+                yield pred.cpu()
+
+
+def predict(model, data_loader, device = "cuda:0", post_process = None, memory_budget = None, fold_bn = False):
+    """
+    Run model on data and collect predictions.
+
+    Args:
+        model (torch.nn.Module): model to be tested
+        data_loader (torch.utils.data.Dataloader): dataloader with predict set
+        device (torch.device): device to train on
+        post_process (callable): function of (input, prediction) applied to predictions
+        memory_budget (float): memory for activations per chunk of a batch, Mb.
+            None to process whole batches
+        fold_bn (bool): predict with a copy of the model with batch norms folded into convolutions
+
+    Returns:
+        predicted betas
+    """
+    batches = list(predict_batches(model, data_loader, device, post_process, memory_budget, fold_bn))
 
-    preds = torch.cat(preds, dim=0)
     if post_process is not None:
-        ppreds = torch.cat(ppreds, dim=0)
-        return preds, ppreds
-    return preds
+        preds, ppreds = zip(*batches)
+        return torch.cat(preds, dim=0), torch.cat(ppreds, dim=0)
+    return torch.cat(batches, dim=0)
+
+
+def tile_starts(size: int, tile_size: int, stride: int) -> List[int]:
+    """Tile offsets covering `size`, the last tile is aligned to the end."""
+    if size <= tile_size:
+        return [0]
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+
+def feather_window(height: int, width: int, overlap: int) -> Tensor:
+    """Tile blending weights, ramping linearly from the borders over `overlap` pixels."""
+    def ramp(size):
+        i = torch.arange(size, dtype=torch.float32)
+        return torch.minimum(i + 1, size - i).div(overlap + 1).clamp(max=1)
+
+    return ramp(height)[:, None] * ramp(width)[None]
+
+
+def predict_tiled(model, input, tile_size = 256, overlap = 32, tile_batch = 16, device = "cuda:0"):
+    """
+    Run model on an image of arbitrary size by overlapping tiles.
+
+    Tiles are processed in batches and blended with a feathered window,
+    so device memory depends on tile batch, not on image size.
+
+    Args:
+        model (torch.nn.Module): fully convolutional model
+        input (torch.Tensor): CxHxW image
+        tile_size (int): tile height and width
+        overlap (int): overlap of neighbouring tiles in pixels
+        tile_batch (int): number of tiles per model call
+        device (torch.device): device to run model on
+
+    Returns:
+        prediction of the same spatial size on cpu
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"overlap must be in [0, {tile_size}), got {overlap}")
+
+    _, height, width = input.shape
+    tile_height, tile_width = min(tile_size, height), min(tile_size, width)
+    boxes = [(top, left)
+             for top in tile_starts(height, tile_height, tile_size - overlap)
+             for left in tile_starts(width, tile_width, tile_size - overlap)]
+    window = feather_window(tile_height, tile_width, overlap)
+
+    # Blending accumulates on cpu
+    output = None
+    weight = torch.zeros(1, height, width)
+    model.eval()
+    with torch.no_grad():
+        for i in range(0, len(boxes), tile_batch):
+            batch = boxes[i:i + tile_batch]
+            tiles = torch.stack([input[:, top:top + tile_height, left:left + tile_width]
+                                 for top, left in batch])
+            pred = model(tiles.to(device)).float().cpu() * window
+            if output is None:
+                output = torch.zeros(pred.shape[1], height, width)
+
+            for (top, left), tile in zip(batch, pred):
+                output[:, top:top + tile_height, left:left + tile_width] += tile
+                weight[:, top:top + tile_height, left:left + tile_width] += window
+
+    return output / weight
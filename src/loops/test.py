@@ -1,11 +1,14 @@
 import torch
 
-from collections import defaultdict
 from tqdm.auto import tqdm
 
+from ..metrics import FID, MetricAccumulator, to_python
+from ..models import fold_batch_norms
+from ..utils import micro_batch_size, micro_batches
+
 
 def test(model, metric, test_loader,
-         device = "cuda:0", metric_name = "Metric"):
+         device = "cuda:0", metric_name = "Metric", memory_budget = None, fold_bn = False):
     """
     Run model on test data and compute metrics.
 
@@ -15,27 +18,55 @@ def test(model, metric, test_loader,
         test_loader (torch.utils.data.Dataloader): dataloader with test set
         device (torch.device): device to train on
         metric_name (str): metric name if single torch.nn.Module is provided
+        memory_budget (float): memory for activations per chunk of a batch, Mb.
+            None to process whole batches
+        fold_bn (bool): test a copy of the model with batch norms folded into convolutions
 
     Returns:
         tuple of (predictions, targets, test metrics)
     """
     if isinstance(metric, torch.nn.Module):
         metric = {metric_name: metric}
+    if fold_bn:
+        model = fold_batch_norms(model)
+
+    # Metrics over the whole test set (FID) are accumulated apart from per-batch ones
+    set_metric = {key: m for key, m in metric.items() if isinstance(m, FID)}
+    metric = {key: m for key, m in metric.items() if key not in set_metric}
+
+    def test_step(input, target):
+        input = input.to(device)
+        target = target.to(device)
+
+        output = model(input)
+
+        for m in set_metric.values():
+            m.update(output, target)
+        return {key: m(output, target) for key, m in metric.items()}
 
-    test_metrics = defaultdict(float)
+    test_metrics = MetricAccumulator()
+    micro_batch = None
     model.eval()
     with torch.no_grad():
-        for input, target in tqdm(test_loader, desc=f"Test"):
-            input = input.to(device)
-            target = target.to(device)
+        for batch in tqdm(test_loader, desc=f"Test"):
+            if micro_batch is None:
+                micro_batch = micro_batch_size(test_step, [tensor[:1] for tensor in batch],
+                                               memory_budget, len(batch[0]))
+                # Drop features of the probe run
+                for m in set_metric.values():
+                    m.reset()
 
-            output = model(input)
+            for input, target in micro_batches(batch, micro_batch):
+                # Metrics are weighted by number of samples
+                for key, value in test_step(input, target).items():
+                    test_metrics.update(key, value, len(input))
 
-            for key, m in metric.items():
-                test_metrics[key] += m(output, target).item()
+        for m in set_metric.values():
+            for key, value in m.compute().items():
+                test_metrics.update(key, value)
 
+    test_metrics = to_python(test_metrics.compute())
     for key in test_metrics:
-        test_metrics[key] /= len(test_loader)
         print("Test %s: %.3f" % (key, test_metrics[key]))
 
     return test_metrics
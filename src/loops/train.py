@@ -2,21 +2,37 @@ import torch
 import numpy as np
 import wandb
 
+from contextlib import contextmanager
 from torch import nn, Tensor
-from typing import Dict
-from collections import defaultdict
+from typing import Dict, List, Sequence
 from tqdm.auto import tqdm
 
-from ..utils import checkpoint, image_grid
+from ..dataset import set_epoch
+from ..metrics import FID, MetricAccumulator, to_python
+from ..models import ModelEMA, fold_batch_norms
+from ..utils import AsyncLogger, autocast, checkpoint, distributed, grad_scaler, image_grid, \
+    micro_batch_size, micro_batches, peak_memory, reset_peak_memory
 
 
 def get_n_best_metric(metrics, n_best):
     return np.partition(metrics[:-1], -n_best)[-n_best]
 
 
+def discriminator_loss(discriminator: nn.Module, concat_output: Tensor, concat_target: Tensor,
+                       joint_forward: bool = True) -> Tensor:
+    if joint_forward:
+        # Fake and real samples share one forward pass (and batch statistics)
+        fake, real = discriminator(torch.cat((concat_output, concat_target), 0)).chunk(2, 0)
+    else:
+        fake, real = discriminator(concat_output), discriminator(concat_target)
+    # LSGAN discriminator loss
+    return (fake ** 2 + (real - 1) ** 2).mean()  # Classify fake as 0, real as 1
+
+
 def losses(generator: nn.Module, discriminator: nn.Module,
            input: Tensor, target: Tensor, criterion: Dict,
-           dis_loss_coef: float, skip_dis_step: bool = True):
+           dis_loss_coef: float, skip_dis_step: bool = True,
+           joint_forward: bool = True):
     # Generator forward step
     output = generator(input)
 
@@ -25,28 +41,164 @@ def losses(generator: nn.Module, discriminator: nn.Module,
     concat_target = torch.cat((target, input), 1)
 
     # E step
-    discriminator.requires_grad(False)
+    discriminator.eval()
 
     # Supervised loss
     super_losses = {key: (coef, l(output, target)) for key, (coef, l) in criterion.items()}
 
     # LSGAN generator loss
-    gen_loss = sum(map(lambda x: x[0] * x[1], super_losses.values())) + dis_loss_coef * \
-               ((discriminator(concat_output) - 1) ** 2).mean()  # Classify fake as 1 (real)
+    gen_loss = sum(map(lambda x: x[0] * x[1], super_losses.values()))
+    if dis_loss_coef:
+        # Discriminator grads are not accumulated, see `train_step`
+        gen_loss = gen_loss + dis_loss_coef * \
+                   ((discriminator(concat_output) - 1) ** 2).mean()  # Classify fake as 1 (real)
 
     # D step
     concat_output = concat_output.detach()
 
     if not skip_dis_step:
-        discriminator.requires_grad(True)
+        discriminator.train()
 
-    # LSGAN discriminator loss
-    dis_loss = (discriminator(concat_output) ** 2 +
-                (discriminator(concat_target) - 1) ** 2).mean()  # Classify fake as 0, real as 1
+    # Loss of skipped step is only used for logging and skip schedule
+    with torch.set_grad_enabled(torch.is_grad_enabled() and not skip_dis_step):
+        dis_loss = discriminator_loss(discriminator, concat_output, concat_target, joint_forward)
 
     return output, super_losses, gen_loss, dis_loss
 
 
+def optimizer_params(optimizer) -> List[Tensor]:
+    return [param for group in optimizer.param_groups for param in group["params"]]
+
+
+@contextmanager
+def accumulation_momentum(modules: Sequence[nn.Module], num_micro_batches: int):
+    """
+    Batch norm momentum for `num_micro_batches` updates of running statistics per optimizer step,
+    so that they decay at the same rate per step (and per sample) as with whole batches.
+
+    Momentum of TorchScript modules is a compiled constant, so they cannot be split into micro-batches.
+
+    """
+    if num_micro_batches > 1 and any(isinstance(module, torch.jit.ScriptModule)
+                                     for model in modules for module in model.modules()):
+        raise ValueError("train_micro_batch is not supported for TorchScript compiled models, "
+                         "their batch norm momentum cannot be rescaled")
+    norms = [module for model in modules for module in model.modules()
+             if isinstance(module, nn.modules.batchnorm._BatchNorm) and module.momentum is not None]
+    momenta = [module.momentum for module in norms]
+    if num_micro_batches > 1:
+        for module, momentum in zip(norms, momenta):
+            module.momentum = 1 - (1 - momentum) ** (1 / num_micro_batches)
+    try:
+        yield
+    finally:
+        for module, momentum in zip(norms, momenta):
+            module.momentum = momentum
+
+
+def train_step(config, generator: nn.Module, discriminator: nn.Module,
+               gen_optimizer, dis_optimizer, scaler,
+               input: Tensor, target: Tensor, criterion: Dict, skip_dis_step: bool):
+    """
+    Make one optimization step of generator and discriminator.
+
+    Batch is split into micro-batches of `config.train_micro_batch` samples,
+    grads are accumulated over them before clipping and optimizer steps.
+
+    Returns:
+        tuple of (output, super_losses, gen_loss, dis_loss)
+        or None if losses are not finite
+
+    """
+    # Zero grad
+    gen_optimizer.zero_grad()
+    dis_optimizer.zero_grad()
+
+    num_samples = len(input)
+    micro_batch = config.train_micro_batch
+    num_micro_batches = 1 if micro_batch is None else -(-num_samples // micro_batch)
+
+    outputs = []
+    super_losses = dict()
+    gen_loss = dis_loss = 0
+    finite = torch.ones((), dtype=torch.bool, device=input.device)
+    with accumulation_momentum([generator, discriminator], num_micro_batches):
+        for micro_input, micro_target in micro_batches((input, target), micro_batch):
+            with autocast(config.device, config.amp_dtype):
+                micro_output, micro_super_losses, micro_gen_loss, micro_dis_loss = losses(
+                    generator, discriminator, micro_input, micro_target,
+                    criterion, config.dis_loss_coef, skip_dis_step,
+                    config.dis_joint_forward
+                )
+            # Losses are means over micro-batch, grads sum up to the ones of the whole batch
+            weight = len(micro_input) / num_samples
+
+            # Generator grads, grads w.r.t. discriminator weights are not computed
+            scaler.scale(micro_gen_loss * weight).backward(inputs=optimizer_params(gen_optimizer))
+            # Discriminator grads
+            if not skip_dis_step:
+                scaler.scale(micro_dis_loss * weight).backward()
+
+            # Checked once after accumulation, so micro-batches do not wait for the host
+            finite &= torch.isfinite(micro_gen_loss.detach()) & torch.isfinite(micro_dis_loss.detach())
+            outputs.append(micro_output.detach())
+            for key, (coef, value) in micro_super_losses.items():
+                super_losses[key] = coef, super_losses.get(key, (coef, 0))[1] + value.detach() * weight
+            gen_loss = gen_loss + micro_gen_loss.detach() * weight
+            dis_loss = dis_loss + micro_dis_loss.detach() * weight
+
+    # All processes stop together
+    if distributed.all_reduce_mean(finite.float()) < 1:
+        return None
+
+    # Generator update
+    distributed.all_reduce_grads(optimizer_params(gen_optimizer))
+    if config.gen_grad_clip_threshold is not None:
+        scaler.unscale_(gen_optimizer)
+        nn.utils.clip_grad_norm_(generator.parameters(),
+                                 config.gen_grad_clip_threshold)
+    scaler.step(gen_optimizer)
+
+    # Discriminator update
+    if not skip_dis_step:
+        distributed.all_reduce_grads(optimizer_params(dis_optimizer))
+        if config.dis_grad_clip_threshold is not None:
+            scaler.unscale_(dis_optimizer)
+            nn.utils.clip_grad_norm_(discriminator.parameters(),
+                                     config.dis_grad_clip_threshold)
+        scaler.step(dis_optimizer)
+
+    scaler.update()
+
+    output = outputs[0] if len(outputs) == 1 else torch.cat(outputs)
+    return output, super_losses, gen_loss, dis_loss
+
+
+def valid_step(config, generator: nn.Module, discriminator: nn.Module,
+               input: Tensor, target: Tensor, criterion: Dict, metric: Dict):
+    """
+    Compute losses and metrics of one validation batch.
+
+    Returns:
+        tuple of (output, super_losses, gen_loss, dis_loss, metrics)
+
+    """
+    memory_format = torch.channels_last if config.channels_last else torch.preserve_format
+    input = input.to(config.device, memory_format=memory_format)
+    target = target.to(config.device, memory_format=memory_format)
+
+    with autocast(config.device, config.amp_dtype):
+        # Losses get the float output passed to metrics, which reuse their memoized backbone activations
+        output, super_losses, gen_loss, dis_loss = losses(
+            lambda x: generator(x).float(), discriminator, input, target,
+            criterion, config.dis_loss_coef,
+            joint_forward=config.dis_joint_forward
+        )
+
+    metrics = {key: m(output, target) for key, m in metric.items()}
+    return output, super_losses, gen_loss, dis_loss, metrics
+
+
 def train(config, train_loader, valid_loader,
           generator, discriminator, gen_optimizer, dis_optimizer,
           gen_scheduler = None, dis_scheduler = None, resume = False, progress = "epochs"):
@@ -78,14 +230,41 @@ def train(config, train_loader, valid_loader,
     if isinstance(metric, nn.Module):
         metric = {config.valid_metric_name: metric}
 
+    # Metrics over the whole valid set (FID) are accumulated apart from per-batch ones
+    set_metric = {key: m for key, m in metric.items() if isinstance(m, FID)}
+    metric = {key: m for key, m in metric.items() if key not in set_metric}
+
+    # Models, losses and metrics run in NHWC layout, as the batches
+    memory_format = torch.channels_last if config.channels_last else torch.preserve_format
+    if config.channels_last:
+        modules = [generator, discriminator, *(l for _, l in criterion.values()),
+                   *metric.values(), *set_metric.values()]
+        for module in modules:
+            module.to(memory_format=memory_format)
+
+    # Loss scaling is only enabled for float16 autocast
+    scaler = grad_scaler(config.amp_dtype)
+
+    # Average of generator weights for inference, only the main process saves it
+    ema = None
+    if config.ema_decay is not None and distributed.is_main_process():
+        ema = ModelEMA(generator, config.ema_decay, config.ema_every, config.ema_device, config.ema_dtype)
+
     if resume:
         start_epoch, valid_metric_history = checkpoint.load(
             config.run_name, generator, gen_optimizer, gen_scheduler,
-            discriminator, dis_optimizer, dis_scheduler
+            discriminator, dis_optimizer, dis_scheduler, scaler, ema
         )
     else:
         start_epoch = 0
         valid_metric_history = []
+    # Processes start from the same weights
+    distributed.broadcast_module(generator)
+    distributed.broadcast_module(discriminator)
+    main_process = distributed.is_main_process()
+    # Checkpoints are serialized in background by the main process
+    writer = checkpoint.CheckpointWriter(config.checkpoint_keep, config.checkpoint_full_every) \
+             if main_process else None
 
     dis_loss = 1  # Init value for use in stepper
     skip_dis_step = False
@@ -94,24 +273,31 @@ def train(config, train_loader, valid_loader,
 
     epoch_iter = range(start_epoch + 1, config.num_epochs + 1)
     if progress == "epochs":
-        epoch_iter = tqdm(epoch_iter, desc="Epoch")
+        epoch_iter = tqdm(epoch_iter, desc="Epoch", disable=not main_process)
+
+    # Logs are accumulated on device and sent in background every `log_every` steps
+    logger = AsyncLogger()
+    train_log = MetricAccumulator()
+    train_steps = 0
+    valid_micro_batch = None
 
     for epoch in epoch_iter:
+        # Shuffling order of distributed samplers does not repeat after resume
+        set_epoch(train_loader, epoch)
+
         # Train
         generator.train()
         discriminator.train()
+        for _, l in criterion.values():
+            l.train()
 
         train_iter = train_loader
         if progress == "samples":
-            train_iter = tqdm(train_iter, desc=f"Train {epoch}/{config.num_epochs}")
+            train_iter = tqdm(train_iter, desc=f"Train {epoch}/{config.num_epochs}", disable=not main_process)
 
         for input, target in train_iter:
-            input = input.to(config.device)
-            target = target.to(config.device)
-
-            # Zero grad
-            gen_optimizer.zero_grad()
-            dis_optimizer.zero_grad()
+            input = input.to(config.device, memory_format=memory_format)
+            target = target.to(config.device, memory_format=memory_format)
 
             # Skip discriminator update if the loss is too low
             if dis_loss < config.min_dis_loss:
@@ -126,79 +312,113 @@ def train(config, train_loader, valid_loader,
                     skip_dis_step = False
                     steps_waited = 0
 
-            output, super_losses, gen_loss, dis_loss = losses(
-                generator, discriminator, input, target,
-                criterion, config.dis_loss_coef, skip_dis_step
-            )
-
-            if config.gen_grad_clip_threshold is not None:
-                nn.utils.clip_grad_norm_(generator.parameters(),
-                                         config.gen_grad_clip_threshold)
-            if config.dis_grad_clip_threshold is not None:
-                nn.utils.clip_grad_norm_(discriminator.parameters(),
-                                         config.dis_grad_clip_threshold)
-
-            if (torch.isnan(gen_loss) or torch.isinf(gen_loss) or
-                    torch.isnan(dis_loss) or torch.isinf(dis_loss)):
+            step = train_step(config, generator, discriminator,
+                              gen_optimizer, dis_optimizer, scaler,
+                              input, target, criterion, skip_dis_step)
+            if step is None:
+                logger.close()
+                if writer is not None:
+                    writer.close()
+                # Restart reads the last checkpoint in all processes
+                distributed.barrier()
                 return "gradient explosion"
-
-            # Generator update
-            gen_loss.backward()
-            gen_optimizer.step()
-
-            # Discriminator update
-            if not skip_dis_step:
-                dis_loss.backward()
-                dis_optimizer.step()
+            output, super_losses, gen_loss, dis_loss = step
+            if ema is not None:
+                ema.update(generator)
+            # Discriminator skip schedule is driven by the mean loss, so it is the same in all processes
+            dis_loss = distributed.all_reduce_mean(dis_loss)
 
             # Logger
-            log = {"train_" + key: value.item() for key, (_, value) in super_losses.items()}
-            log["train_generator_loss"] = gen_loss.item()
-            log["train_discriminator_loss"] = dis_loss.item()
-            log["discriminator_enabled"] = int(not skip_dis_step)
-            with torch.no_grad():
-                for key, m in metric.items():
-                    log["train_" + key] = m(output, target).item()
-
-            wandb.log(log)
+            for key, (_, value) in super_losses.items():
+                train_log.update("train_" + key, value)
+            train_log.update("train_generator_loss", gen_loss)
+            train_log.update("train_discriminator_loss", dis_loss)
+            train_log.update("discriminator_enabled", int(not skip_dis_step))
+
+            train_steps += 1
+            if train_steps % config.log_every == 0:
+                train_log.all_reduce()
+                log = train_log.compute()
+                train_log.reset()
+                # Metrics are only computed for logged steps, optionally on a sub-batch
+                samples = slice(config.log_metric_samples)
+                with torch.no_grad():
+                    for key, m in metric.items():
+                        log["train_" + key] = m(output[samples].float(), target[samples])
+                logger.log(log)
 
         # Valid
-        valid_log = defaultdict(float)
+        valid_log = MetricAccumulator()
         generator.eval()
         discriminator.eval()
+        # Batch norm statistics of the main process, as in saved checkpoints
+        distributed.broadcast_module(generator, buffers_only=True)
+        distributed.broadcast_module(discriminator, buffers_only=True)
+        valid_generator, valid_discriminator = generator, discriminator
+        if config.fold_bn:
+            # Deploy copies with current weights and batch norm statistics
+            valid_generator = fold_batch_norms(generator)
+            valid_discriminator = fold_batch_norms(discriminator)
+        # Loss augmentations (random shift) are off, valid pairs are the ones metrics see
+        for _, l in criterion.values():
+            l.eval()
 
         valid_iter = valid_loader
         if progress == "samples":
-            valid_iter = tqdm(valid_iter, desc=f"Valid {epoch}/{config.num_epochs}")
-
-        with torch.no_grad():
-            for input, target in valid_iter:
-                input = input.to(config.device)
-                target = target.to(config.device)
-
-                output, super_losses, gen_loss, dis_loss = losses(
-                    generator, discriminator, input, target,
-                    criterion, config.dis_loss_coef
-                )
-
-                # Logger
-                valid_log["valid_generator_loss"] += gen_loss.item()
-                valid_log["valid_discriminator_loss"] += dis_loss.item()
-                for key, (_, value) in super_losses.items():
-                    valid_log["valid_" + key] += value.item()
-                for key, m in metric.items():
-                    valid_log["valid_" + key] += m(output, target).item()
+            valid_iter = tqdm(valid_iter, desc=f"Valid {epoch}/{config.num_epochs}", disable=not main_process)
 
-        for key in valid_log:
-            valid_log[key] /= len(valid_loader)
+        for m in set_metric.values():
+            m.reset()
 
-        valid_log = dict(valid_log)
-        valid_log["image_samples"] = wandb.Image(image_grid(input, output, target, num_images=4))
+        reset_peak_memory(config.device)
+        with torch.no_grad():
+            for batch in valid_iter:
+                # Large valid batches are processed in chunks fitting into memory budget
+                if valid_micro_batch is None:
+                    valid_micro_batch = micro_batch_size(
+                        lambda input, target: valid_step(config, valid_generator, valid_discriminator,
+                                                         input, target, criterion, metric),
+                        [tensor[:1] for tensor in batch], config.eval_memory_budget, config.valid_batch
+                    )
+                    # Drop features of the probe run
+                    for m in set_metric.values():
+                        m.reset()
+
+                for input, target in micro_batches(batch, valid_micro_batch):
+                    output, super_losses, gen_loss, dis_loss, metrics = valid_step(
+                        config, valid_generator, valid_discriminator, input, target, criterion, metric
+                    )
+
+                    # Logger, metrics are weighted by number of samples
+                    num_samples = len(input)
+                    valid_log.update("valid_generator_loss", gen_loss, num_samples)
+                    valid_log.update("valid_discriminator_loss", dis_loss, num_samples)
+                    for key, (_, value) in super_losses.items():
+                        valid_log.update("valid_" + key, value, num_samples)
+                    for key, value in metrics.items():
+                        valid_log.update("valid_" + key, value, num_samples)
+                    for m in set_metric.values():
+                        m.update(output, target.to(config.device))
+
+            for m in set_metric.values():
+                for key, value in m.compute().items():
+                    valid_log.update("valid_" + key, value)
+        del valid_generator, valid_discriminator
+
+        valid_log.all_reduce()
+        valid_log = to_python(valid_log.compute())
+        if torch.device(config.device).type == "cuda":
+            valid_log["valid_peak_memory"] = peak_memory(config.device)
+        else:
+            # Not reset between epochs
+            valid_log["process_peak_memory"] = peak_memory(config.device)
+        valid_log["image_samples"] = wandb.Image(image_grid(input.to(config.device), output,
+                                                            target.to(config.device), num_images=4))
         valid_log["generator_lr"] = gen_optimizer.param_groups[0]["lr"]
         valid_log["discriminator_lr"] = dis_optimizer.param_groups[0]["lr"]
         valid_log["epoch"] = epoch
 
-        wandb.log(valid_log, commit=False)
+        logger.log(valid_log, commit=False)
 
         # Schedulers step
         valid_metric_history += [valid_log["valid_" + config.valid_metric_name]]
@@ -214,15 +434,20 @@ def train(config, train_loader, valid_loader,
             if dis_scheduler is not None:
                 dis_scheduler.step()
 
-        # Save model if higher metric is achieved
-        if (epoch <= config.n_best_save or valid_metric_history[-1] >
-                get_n_best_metric(valid_metric_history, config.n_best_save)):
-            checkpoint.save_model(config.run_name, epoch, generator)
+        if main_process:
+            # Save model if higher metric is achieved
+            if (epoch <= config.n_best_save or valid_metric_history[-1] >
+                    get_n_best_metric(valid_metric_history, config.n_best_save)):
+                writer.save_model(config.run_name, epoch, generator, ema)
 
-        # Save full checkpoint
-        checkpoint.save(config.run_name, epoch, valid_metric_history,
+            # Save full checkpoint
+            writer.save(config.run_name, epoch, valid_metric_history,
                         generator, gen_optimizer, gen_scheduler,
-                        discriminator, dis_optimizer, dis_scheduler)
+                        discriminator, dis_optimizer, dis_scheduler, scaler, ema)
+
+    logger.close()
+    if writer is not None:
+        writer.close()
 
     print("Best valid %s:  %.3f on epoch %d" %
           (config.valid_metric_name, max(valid_metric_history), np.argmax(valid_metric_history) + 1))
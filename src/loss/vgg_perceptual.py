@@ -3,17 +3,90 @@ import torchvision
 
 from torch import nn
 from torch import Tensor
-from typing import Tuple
+from typing import Hashable, List
+from collections import OrderedDict
 
 
-def norm(x: Tensor, mean: Tuple, std: Tuple):
-    return torch.stack([(x[:, i] - mean[i]) / std[i] for i in range(x.shape[1])], dim=1)
+def norm(x: Tensor, mean: Tensor, std: Tensor) -> Tensor:
+    return (x - mean.view(1, -1, 1, 1)) / std.view(1, -1, 1, 1)
+
+
+class FeatureCache:
+    """LRU store of per-sample features keyed by exact image content.
+
+    Args:
+        max_size (float): memory limit of stored features, Mb
+
+    """
+
+    def __init__(self, max_size: float):
+        self.max_size = max_size * 2 ** 20
+        self.size = 0
+        self.store = OrderedDict()
+        self.weights = None
+
+    def keys(self, x: Tensor) -> List[Hashable]:
+        # Hash of float bits, shifted or otherwise changed images get new keys
+        bits = x.detach().float().contiguous().flatten(1).view(torch.int32)
+        if self.weights is None or self.weights.shape[0] != bits.shape[1] or \
+                self.weights.device != bits.device:
+            generator = torch.Generator().manual_seed(0)
+            self.weights = torch.randint(-2 ** 62, 2 ** 62, (bits.shape[1],),
+                                         generator=generator).to(bits.device)
+        # Integer arithmetic wraps around and does not depend on reduction order
+        hashes = torch.cat([(chunk.long() * self.weights).sum(1) for chunk in bits.split(16)])
+        return [(tuple(x.shape[1:]), key) for key in hashes.tolist()]
+
+    def get(self, key: Hashable):
+        value = self.store.get(key)
+        if value is not None:
+            self.store.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Tensor):
+        if key in self.store:
+            return
+        # Copy, so that a view does not keep the whole batch alive
+        value = value.detach().clone()
+        self.store[key] = value
+        self.size += value.numel() * value.element_size()
+        while self.size > self.max_size and self.store:
+            _, evicted = self.store.popitem(last=False)
+            self.size -= evicted.numel() * evicted.element_size()
+
+    def clear(self):
+        self.store.clear()
+        self.size = 0
 
 
 class VGGPerceptualLoss(nn.Module):
-    def __init__(self, avgpool=False, unnorm=True):
+    """
+    L1 distance between VGG16 features of input and target.
+
+    Args:
+        avgpool (bool): pool features to 7x7
+        unnorm (bool): images are in [-1; 1] range, otherwise in [0; 1]
+        cache_size (float): memory for target features cached in no-grad passes, Mb.
+            Valid targets repeat every epoch, so their features are computed once.
+            None to disable
+        backbone (VGGFeatures): shared trunk to take `layer` activations from,
+            e.g. the one of LPIPS metric. Images are then scaled as in LPIPS
+            and `cache_size` is not used
+        layer (str): backbone layer, conv4_3 matches the own truncated VGG16
+
+    """
+
+    def __init__(self, avgpool=False, unnorm=True, cache_size=None, backbone=None, layer="conv4_3"):
         super().__init__()
         self.unnorm = unnorm
+        self.backbone = backbone
+        self.layer = layer
+        self.loss = nn.L1Loss()
+        self.cache = None
+
+        if backbone is not None:
+            self.pool = nn.AdaptiveAvgPool2d((7, 7)) if avgpool else nn.Identity()
+            return
 
         # Get pretrained VGG model
         self.vgg_model = torchvision.models.vgg16(pretrained=True)
@@ -27,16 +100,46 @@ class VGGPerceptualLoss(nn.Module):
         self.vgg_model.eval()
         for param in self.vgg_model.parameters():
             param.requires_grad = False
-        # L1 loss instance
-        self.loss = nn.L1Loss()
 
-        self.mean = (0.48235, 0.45882, 0.40784)
-        self.std = (0.229, 0.224, 0.225)
+        self.register_buffer("mean", torch.tensor((0.48235, 0.45882, 0.40784)), persistent=False)
+        self.register_buffer("std", torch.tensor((0.229, 0.224, 0.225)), persistent=False)
+
+        self.cache = FeatureCache(cache_size) if cache_size else None
+
+    def features(self, x: Tensor) -> Tensor:
+        return self.vgg_model(norm(x, self.mean, self.std))
+
+    def backbone_features(self, x: Tensor) -> Tensor:
+        if not self.unnorm:
+            x = x * 2 - 1
+        return self.pool(self.backbone(x)[self.layer]).flatten(1)
 
     def forward(self, input: Tensor, target: Tensor) -> Tensor:
+        if self.backbone is not None:
+            # Same tensors as passed to metrics reuse memoized activations
+            return self.loss(self.backbone_features(input), self.backbone_features(target))
+
         if self.unnorm:
             input = input / 2 + 0.5
             target = target / 2 + 0.5
-        out = self.loss(self.vgg_model(norm(input, self.mean, self.std)),
-                        self.vgg_model(norm(target, self.mean, self.std)))
-        return out
+
+        if torch.is_grad_enabled() and input.requires_grad:
+            # Separate passes, fused batch would also run VGG backward through target half
+            return self.loss(self.features(input), self.features(target))
+
+        if self.cache is None:
+            # Single forward of concatenated batch
+            input_features, target_features = self.features(torch.cat((input, target))).chunk(2)
+            return self.loss(input_features, target_features)
+
+        keys = self.cache.keys(target)
+        target_features = [self.cache.get(key) for key in keys]
+        missing = [i for i, features in enumerate(target_features) if features is None]
+
+        features = self.features(torch.cat((input, target[missing])))
+        input_features = features[:len(input)]
+        for i, features in zip(missing, features[len(input):]):
+            target_features[i] = features
+            self.cache.put(keys[i], features)
+
+        return self.loss(input_features, torch.stack(target_features))
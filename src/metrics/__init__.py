@@ -1 +1,4 @@
+from .accumulator import MetricAccumulator, to_python
+from .fid import FID, NegativeFID
 from .negative_lpips import NegativeLPIPS
+from .vgg_lpips import LPIPS_VGG_LAYERS, NegativeVGGLPIPS, VGGLPIPS
@@ -0,0 +1,66 @@
+import torch
+import torch.distributed as dist
+
+from torch import Tensor
+from typing import Dict
+from collections import defaultdict
+
+
+class MetricAccumulator:
+    """Running weighted means of scalar metrics.
+
+    Tensor values are summed on their device without synchronization,
+    python numbers are summed on host.
+
+    """
+
+    def __init__(self):
+        self.sums = dict()
+        self.weights = defaultdict(float)
+
+    def update(self, key: str, value, weight: float = 1.):
+        if isinstance(value, Tensor):
+            value = value.detach().float() * weight
+        else:
+            value = value * weight
+        if key in self.sums:
+            self.sums[key] += value
+        else:
+            self.sums[key] = value
+        self.weights[key] += weight
+
+    def compute(self) -> Dict:
+        return {key: value / self.weights[key] for key, value in self.sums.items()}
+
+    def all_reduce(self):
+        """Sum values and weights over processes in distributed training, keys must be the same."""
+        if not (dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1):
+            return
+        keys = sorted(self.sums)
+        device = next((value.device for value in self.sums.values() if isinstance(value, Tensor)), "cpu")
+        values = torch.stack([torch.as_tensor(self.sums[key], dtype=torch.float, device=device).reshape(())
+                              for key in keys] +
+                             [torch.tensor(float(self.weights[key]), device=device) for key in keys])
+        dist.all_reduce(values)
+        self.sums = dict(zip(keys, values[:len(keys)]))
+        self.weights = defaultdict(float, zip(keys, values[len(keys):].tolist()))
+
+    def reset(self):
+        self.sums = dict()
+        self.weights = defaultdict(float)
+
+    def __len__(self):
+        return len(self.sums)
+
+
+def to_python(log: Dict) -> Dict:
+    """Convert scalar tensors of a log to python numbers, synchronizes device."""
+    if not log:
+        return dict(log)
+    keys = [key for key, value in log.items() if isinstance(value, Tensor)]
+    log = dict(log)
+    if keys:
+        # Single transfer for all values
+        values = torch.stack([log[key].float().reshape(()) for key in keys]).cpu().tolist()
+        log.update(zip(keys, values))
+    return log
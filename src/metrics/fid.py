@@ -0,0 +1,191 @@
+import os
+import warnings
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from torch import nn, Tensor
+from typing import Dict
+
+from ..utils.distributed import all_gather_cat, is_distributed, is_main_process
+
+
+def frechet_distance(mu1: Tensor, sigma1: Tensor, mu2: Tensor, sigma2: Tensor) -> Tensor:
+    """Frechet distance between two gaussians, computed in float64 without scipy.
+
+    tr(sqrt(sigma1 sigma2)) is taken from eigenvalues of the symmetric matrix
+    sqrt(sigma1) sigma2 sqrt(sigma1), which share the spectrum.
+
+    """
+    eigvals, eigvecs = torch.linalg.eigh(sigma1)
+    sqrt_sigma1 = (eigvecs * eigvals.clip(min=0).sqrt()) @ eigvecs.T
+    covmean_eigvals = torch.linalg.eigvalsh(sqrt_sigma1 @ sigma2 @ sqrt_sigma1)
+    tr_covmean = covmean_eigvals.clip(min=0).sqrt().sum()
+    return (mu1 - mu2).square().sum() + sigma1.trace() + sigma2.trace() - 2 * tr_covmean
+
+
+def kernel_distance(x: Tensor, y: Tensor, num_subsets: int = 100, subset_size: int = 1000) -> Tensor:
+    """Unbiased MMD with cubic polynomial kernel averaged over random subsets."""
+    n = x.shape[1]
+    m = min(len(x), len(y), subset_size)
+    generator = torch.Generator().manual_seed(0)
+    t = 0
+    for _ in range(num_subsets):
+        xs = x[torch.randperm(len(x), generator=generator)[:m].to(x.device)]
+        ys = y[torch.randperm(len(y), generator=generator)[:m].to(y.device)]
+        a = (xs @ xs.T / n + 1) ** 3 + (ys @ ys.T / n + 1) ** 3
+        b = (xs @ ys.T / n + 1) ** 3
+        t = t + (a.sum() - a.diagonal().sum()) / (m - 1) - b.sum() * 2 / m
+    return t / num_subsets / m
+
+
+class FID(nn.Module):
+    """Frechet Inception Distance accumulated over an evaluation pass.
+
+    Unlike per-batch metrics, features of generated images are accumulated
+    with `update` and the distance is computed over the whole pass with `compute`.
+    Reference statistics are collected from targets during the first pass
+    and cached on disk, later passes only run Inception on generated images.
+    The cache is compatible with `python -m pytorch_fid` for 2048 resized features.
+
+    Args:
+        cache_path (str): reference statistics file, None to keep them in memory only
+        dims (int): Inception features dimensionality, one of 64, 192, 768, 2048.
+            Lower dims run only first Inception blocks, which is much faster on CPU
+        resize (bool): resize images to 299x299 as pytorch-fid does, disable to run faster on CPU
+        kid (bool): also compute Kernel Inception Distance, keeps features of all images
+        kid_subsets (int): number of random subsets for KID
+        kid_subset_size (int): size of random subsets for KID
+
+    """
+
+    def __init__(self, cache_path = None, dims = 2048, resize = True,
+                 kid = False, kid_subsets = 100, kid_subset_size = 1000):
+        super().__init__()
+        try:
+            from pytorch_fid.inception import InceptionV3
+        except ImportError:
+            raise ImportError("FID metric requires pytorch-fid, "
+                              "install it with `pip install pytorch-fid`")
+
+        self.cache_path = cache_path
+        self.dims = dims
+        self.kid = kid
+        self.kid_subsets = kid_subsets
+        self.kid_subset_size = kid_subset_size
+
+        self.inception = InceptionV3([InceptionV3.BLOCK_INDEX_BY_DIM[dims]],
+                                     resize_input=resize, normalize_input=False)
+        self.inception.eval()
+
+        self.reference = None
+        if cache_path is not None and os.path.exists(cache_path):
+            self.reference = dict(np.load(cache_path))
+            if self.reference["mu"].shape[0] != dims or (kid and "features" not in self.reference):
+                warnings.warn(f"Reference statistics {cache_path} do not match metric settings, recomputing")
+                self.reference = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {"output": self._empty_stats()}
+        if self.reference is None:
+            self.stats["target"] = self._empty_stats()
+
+    def _empty_stats(self) -> Dict:
+        return {"n": 0, "sum": 0, "outer": 0, "features": []}
+
+    def train(self, mode: bool = True):
+        # Inception stays in eval mode
+        super().train(mode)
+        self.inception.eval()
+        return self
+
+    def features(self, x: Tensor) -> Tensor:
+        # Quantize [-1; 1] images to uint8 levels as in saved PNGs
+        x = torch.round((x.float().clip(-1, 1) + 1) * 127.5) / 127.5 - 1
+        features = self.inception(x)[0]
+        if features.shape[2:] != (1, 1):
+            features = F.adaptive_avg_pool2d(features, output_size=(1, 1))
+        return features.flatten(1).double()
+
+    def _accumulate(self, stats: Dict, features: Tensor):
+        # Moments are summed on device, mean and covariance are computed once
+        stats["n"] += len(features)
+        stats["sum"] = stats["sum"] + features.sum(0)
+        stats["outer"] = stats["outer"] + features.T @ features
+        if self.kid:
+            stats["features"].append(features.float())
+
+    @torch.no_grad()
+    def update(self, output: Tensor, target: Tensor):
+        self._accumulate(self.stats["output"], self.features(output))
+        if "target" in self.stats:
+            self._accumulate(self.stats["target"], self.features(target))
+
+    def _all_reduce(self, stats: Dict):
+        # Moments and features of all processes in distributed validation
+        device = next(self.inception.parameters()).device
+        n = torch.tensor([stats["n"]], dtype=torch.float64, device=device)
+        moments = [torch.zeros(self.dims, dtype=torch.float64, device=device) + stats["sum"],
+                   torch.zeros(self.dims, self.dims, dtype=torch.float64, device=device) + stats["outer"]]
+        for tensor in [n] + moments:
+            torch.distributed.all_reduce(tensor)
+        stats["n"] = int(n.item())
+        stats["sum"], stats["outer"] = moments
+        if self.kid:
+            features = torch.cat(stats["features"]) if stats["features"] else \
+                       torch.zeros(0, self.dims, device=device)
+            stats["features"] = [all_gather_cat(features)]
+
+    @staticmethod
+    def _moments(stats: Dict):
+        n = stats["n"]
+        mu = stats["sum"] / n
+        sigma = (stats["outer"] - n * torch.outer(mu, mu)) / (n - 1)
+        return mu, sigma
+
+    def _save_reference(self):
+        mu, sigma = self._moments(self.stats["target"])
+        self.reference = {"mu": mu.cpu().numpy(), "sigma": sigma.cpu().numpy(),
+                          "n": np.array(self.stats["target"]["n"])}
+        if self.kid:
+            self.reference["features"] = torch.cat(self.stats["target"]["features"]).cpu().numpy()
+        if self.cache_path is not None and is_main_process():
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            base, extension = os.path.splitext(self.cache_path)
+            tmp_path = f"{base}.tmp{extension}"
+            np.savez(tmp_path, **self.reference)
+            os.replace(tmp_path, self.cache_path)
+        del self.stats["target"]
+
+    @torch.no_grad()
+    def compute(self) -> Dict[str, Tensor]:
+        """Metrics over all images passed since the last reset, in all processes."""
+        if is_distributed():
+            for stats in self.stats.values():
+                self._all_reduce(stats)
+
+        if "target" in self.stats:
+            self._save_reference()
+        elif "n" in self.reference and self.reference["n"] != self.stats["output"]["n"]:
+            warnings.warn(f"Reference statistics are computed over {self.reference['n']} images, "
+                          f"but {self.stats['output']['n']} images were generated")
+
+        device = self.stats["output"]["sum"].device
+        mu, sigma = self._moments(self.stats["output"])
+        ref_mu = torch.from_numpy(self.reference["mu"]).to(device, torch.float64)
+        ref_sigma = torch.from_numpy(self.reference["sigma"]).to(device, torch.float64)
+        metrics = {"fid": frechet_distance(mu, sigma, ref_mu, ref_sigma).float()}
+
+        if self.kid:
+            features = torch.cat(self.stats["output"]["features"])
+            ref_features = torch.from_numpy(self.reference["features"]).to(device)
+            metrics["kid"] = kernel_distance(features, ref_features,
+                                             self.kid_subsets, self.kid_subset_size)
+        return metrics
+
+
+class NegativeFID(FID):
+    def compute(self) -> Dict[str, Tensor]:
+        return {key: -value for key, value in super().compute().items()}
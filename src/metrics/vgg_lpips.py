@@ -0,0 +1,58 @@
+import os
+
+import lpips
+import torch
+import torch.nn.functional as F
+
+from torch import nn, Tensor
+
+
+LPIPS_VGG_LAYERS = ("relu1_2", "relu2_2", "relu3_3", "relu4_3", "relu5_3")
+
+
+class VGGLPIPS(nn.Module):
+    """LPIPS over activations of a `VGGFeatures` trunk, which may be shared with a loss.
+
+    Args:
+        backbone (VGGFeatures): feature extractor with `layers` among its outputs
+        layers (tuple): compared backbone layers
+        weights (str): "lpips" for calibrated linear layers of `lpips` package
+            (default layers only), None to sum channel distances as `lpips=False` baseline
+
+    """
+
+    def __init__(self, backbone, layers = LPIPS_VGG_LAYERS, weights = "lpips"):
+        super().__init__()
+        self.backbone = backbone
+        self.layers = tuple(layers)
+
+        self.lins = None
+        if weights == "lpips":
+            if self.layers != LPIPS_VGG_LAYERS:
+                raise ValueError(f"LPIPS weights are calibrated for {LPIPS_VGG_LAYERS} layers")
+            path = os.path.join(os.path.dirname(lpips.__file__), "weights", "v0.1", "vgg.pth")
+            state_dict = torch.load(path, map_location="cpu")
+            self.lins = nn.ParameterList([
+                nn.Parameter(state_dict[f"lin{i}.model.1.weight"], requires_grad=False)
+                for i in range(len(self.layers))
+            ])
+
+    def forward(self, input: Tensor, target: Tensor) -> Tensor:
+        input_features = self.backbone(input)
+        target_features = self.backbone(target)
+        out = 0
+        for i, layer in enumerate(self.layers):
+            diff = (lpips.normalize_tensor(input_features[layer]) -
+                    lpips.normalize_tensor(target_features[layer])) ** 2
+            if self.lins is not None:
+                diff = F.conv2d(diff, self.lins[i])
+            else:
+                diff = diff.sum(1, keepdim=True)
+            out = out + diff.mean((2, 3), keepdim=True)
+        return out
+
+
+class NegativeVGGLPIPS(VGGLPIPS):
+    def forward(self, *args, **kwargs):
+        out = super().forward(*args, **kwargs)
+        return -out.mean()
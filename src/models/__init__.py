@@ -1,4 +1,6 @@
 from .components import *
+from .ema import ModelEMA
 from .patch_discriminator import PatchDiscriminator
 from .unet import UNet
-from .utils import init_weights
+from .utils import compile_model, fold_batch_norms, init_weights
+from .quantization import fuse_double_convs, quantize_dynamic, quantize_static
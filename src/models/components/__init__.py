@@ -1,4 +1,8 @@
+from .canny import CannyEdgeDetector
 from .edge_detector import EdgeDetector
 from .gaussian_blur import GaussianBlur
 from .luminance_estimator import LuminanceEstimator
 from .random_shift import RandomShift
+from .shift_blur import RandomShiftBlur
+from .sync_batch_norm import SyncBatchNorm2d, convert_sync_batchnorm
+from .vgg_features import VGG16_LAYERS, VGGFeatures
@@ -0,0 +1,40 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+from .gaussian_blur import GaussianBlur
+
+
+def shifted_indices(size: int, pad: int, shift: int, device) -> Tensor:
+    """Source indices of a replicate padded signal shifted by `shift` with replicate padding."""
+    index = torch.arange(-pad, size + pad, device=device).clamp(0, size - 1)
+    return (index + shift).clamp(0, size - 1)
+
+
+class RandomShiftBlur(GaussianBlur):
+    """`RandomShift` followed by `GaussianBlur` as one gather and one depthwise convolution.
+
+    Shift and both replicate paddings are folded into a single index map,
+    so the output is the same as of the two modules in sequence.
+
+    """
+
+    def __init__(self, channels, kernel_size, distance = (0, 1, 0, 1)):
+        super().__init__(channels, kernel_size)
+        self.distance = distance  # Vertical then horizontal, as in `RandomShift`
+
+    def forward(self, x: Tensor) -> Tensor:
+        shift_y = shift_x = 0
+        if self.training:
+            shift_y = np.random.randint(-self.distance[0], self.distance[1] + 1)
+            shift_x = np.random.randint(-self.distance[2], self.distance[3] + 1)
+        pad = self.kernel_size // 2
+        rows = shifted_indices(x.size(2), pad, shift_y, x.device)
+        cols = shifted_indices(x.size(3), pad, shift_x, x.device)
+        x = x[:, :, rows[:, None], cols]
+        return F.conv2d(x, self.kernel, groups=self.channels)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.channels}, kernel_size={self.kernel_size}, " \
+               f"distance={self.distance})"
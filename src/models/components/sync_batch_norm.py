@@ -0,0 +1,93 @@
+import torch
+import torch.distributed as dist
+from torch import nn, Tensor
+from torch.autograd import Function
+
+
+class _SyncBatchNorm(Function):
+    @staticmethod
+    def forward(ctx, input, weight, bias, eps):
+        dims = [0] + list(range(2, input.dim()))
+        count = torch.full([1], input.numel() // input.shape[1], dtype=input.dtype, device=input.device)
+        local_mean = input.mean(dims)
+        local_m2 = (input - local_mean.view(1, -1, *[1] * (input.dim() - 2))).square().sum(dims)
+
+        # Centered moments of all processes, combined as in parallel variance algorithm
+        stats = torch.cat([local_mean, local_m2, count])
+        gathered = [torch.empty_like(stats) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, stats)
+        channels = input.shape[1]
+        means, m2s, counts = torch.stack(gathered).split([channels, channels, 1], dim=1)
+        total = counts.sum()
+        mean = (means * counts).sum(0) / total
+        var = (m2s + counts * (means - mean).square()).sum(0) / total
+
+        shape = [1, -1] + [1] * (input.dim() - 2)
+        invstd = torch.rsqrt(var + eps)
+        normalized = (input - mean.view(shape)) * invstd.view(shape)
+        ctx.save_for_backward(normalized, weight, invstd, total)
+        ctx.mark_non_differentiable(mean, var)
+        return normalized * weight.view(shape) + bias.view(shape), mean, var * total / (total - 1).clamp(min=1)
+
+    @staticmethod
+    def backward(ctx, grad_output, _grad_mean, _grad_var):
+        normalized, weight, invstd, total = ctx.saved_tensors
+        dims = [0] + list(range(2, grad_output.dim()))
+        shape = [1, -1] + [1] * (grad_output.dim() - 2)
+
+        grad_bias = grad_output.sum(dims)
+        grad_weight = (grad_output * normalized).sum(dims)
+        # Input grads depend on the other processes through batch statistics
+        sums = torch.cat([grad_bias, grad_weight])
+        dist.all_reduce(sums)
+        sum_dy, sum_dy_normalized = sums.chunk(2)
+
+        grad_input = (grad_output - (sum_dy.view(shape) + normalized * sum_dy_normalized.view(shape)) / total) * \
+                     (weight * invstd).view(shape)
+        return grad_input, grad_weight, grad_bias, None
+
+
+class SyncBatchNorm2d(nn.BatchNorm2d):
+    """
+    Batch norm with statistics computed over the batches of all processes in training mode.
+
+    Unlike `nn.SyncBatchNorm`, runs on any device supported by the process group backend (e.g. gloo on CPU).
+    Falls back to `nn.BatchNorm2d` outside of distributed training, state dict is the same.
+
+    """
+
+    def forward(self, input: Tensor) -> Tensor:
+        if not (self.training and self.affine and self.track_running_stats and
+                dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1):
+            return super().forward(input)
+
+        self.num_batches_tracked.add_(1)
+        momentum = 1 / self.num_batches_tracked.item() if self.momentum is None else self.momentum
+
+        if input.dtype in (torch.float16, torch.bfloat16):
+            # Float32 statistics, as batch norm under autocast
+            input = input.float()
+        output, mean, var = _SyncBatchNorm.apply(input, self.weight, self.bias, self.eps)
+        # Updated in place without bumping autograd version, as native batch norm does,
+        # since graphs of earlier eval mode calls may hold the statistics
+        self.running_mean.data.lerp_(mean.to(self.running_mean.dtype), momentum)
+        self.running_var.data.lerp_(var.to(self.running_var.dtype), momentum)
+        return output
+
+
+def convert_sync_batchnorm(module: nn.Module) -> nn.Module:
+    """Replace `nn.BatchNorm2d` layers with `SyncBatchNorm2d` keeping their weights and statistics."""
+    if type(module) is nn.BatchNorm2d:
+        sync = SyncBatchNorm2d(module.num_features, module.eps, module.momentum,
+                               module.affine, module.track_running_stats)
+        # Parameters and buffers are shared, as in `nn.SyncBatchNorm.convert_sync_batchnorm`
+        if module.affine:
+            sync.weight = module.weight
+            sync.bias = module.bias
+        sync.running_mean = module.running_mean
+        sync.running_var = module.running_var
+        sync.num_batches_tracked = module.num_batches_tracked
+        return sync.train(module.training)
+    for name, child in module.named_children():
+        setattr(module, name, convert_sync_batchnorm(child))
+    return module
@@ -0,0 +1,86 @@
+import weakref
+
+import torch
+import torchvision
+from torch import nn, Tensor
+from typing import Dict
+
+
+# Layer indices in torchvision VGG16 `features`
+VGG16_LAYERS = {
+    "relu1_2": 3,
+    "relu2_2": 8,
+    "relu3_3": 15,
+    "conv4_3": 21,
+    "relu4_3": 22,
+    "relu5_3": 29
+}
+
+
+class VGGFeatures(nn.Module):
+    """Frozen pretrained VGG16 trunk returning activations of named layers.
+
+    Takes images in [-1; 1] range and scales them as LPIPS does.
+    Activations of the last no-grad inputs are memoized until the inputs are freed,
+    so a perceptual loss and LPIPS metric sharing an instance run the trunk
+    once per validation batch. Train steps run with grads and are not memoized.
+    Activations memoized under autocast are cast to the input dtype when reused outside of it.
+
+    Args:
+        layers (iterable): layer names from `VGG16_LAYERS`
+        memo_size (int): number of memoized inputs, e.g. output and target
+
+    """
+
+    def __init__(self, layers = tuple(VGG16_LAYERS), memo_size = 2):
+        super().__init__()
+        self.layers = {VGG16_LAYERS[name]: name for name in layers}
+        self.memo_size = memo_size
+        self.memo = dict()
+
+        features = torchvision.models.vgg16(pretrained=True).features
+        features = features[:max(self.layers) + 1]
+        # Activations are returned, in-place ReLU would overwrite conv outputs
+        for module in features:
+            if isinstance(module, nn.ReLU):
+                module.inplace = False
+        self.features = features.eval()
+        for param in self.parameters():
+            param.requires_grad = False
+
+        self.register_buffer("shift", torch.tensor([-.030, -.088, -.188]).view(1, -1, 1, 1),
+                             persistent=False)
+        self.register_buffer("scale", torch.tensor([.458, .448, .450]).view(1, -1, 1, 1),
+                             persistent=False)
+
+    @staticmethod
+    def memo_key(x: Tensor):
+        # Autocast state is not a part of the key, a loss under autocast shares activations with metrics
+        return x.data_ptr(), x.shape, x.stride(), x.dtype, x._version
+
+    def forward(self, x: Tensor) -> Dict[str, Tensor]:
+        memoize = not torch.is_grad_enabled()
+        if memoize:
+            key = self.memo_key(x)
+            if key in self.memo:
+                activations = self.memo[key]
+                autocast = torch.is_autocast_enabled() if x.device.type == "cuda" \
+                    else torch.is_autocast_cpu_enabled()
+                if not autocast:
+                    activations = {name: h.to(x.dtype) for name, h in activations.items()}
+                return activations
+
+        activations = dict()
+        h = (x - self.shift) / self.scale
+        for i, module in enumerate(self.features):
+            h = module(h)
+            if i in self.layers:
+                activations[self.layers[i]] = h
+
+        if memoize:
+            while len(self.memo) >= self.memo_size:
+                self.memo.pop(next(iter(self.memo)))
+            self.memo[key] = activations
+            # Entry is dropped with the input, its memory may be reused by another tensor
+            weakref.finalize(x, self.memo.pop, key, None)
+        return activations
@@ -0,0 +1,71 @@
+import torch
+
+from torch import nn, Tensor
+from typing import Dict
+
+
+class ModelEMA:
+    """
+    Exponential moving average of model weights, kept apart from the model.
+
+    Floating point parameters are averaged by fused multi-tensor ops every `every` steps,
+    with decay raised to the power of `every`, so that the averaging horizon in steps is the same.
+    Buffers (batch norm statistics) are copied. The average is a state dict of the model,
+    e.g. for `load_state_dict` of an inference copy.
+
+    Args:
+        model (nn.Module): averaged model
+        decay (float): decay per step
+        every (int): steps between updates, larger values amortize the cost of updates
+            and keep low precision averages from rounding the updates away
+        device (torch.device): device to keep the average on, e.g. "cpu" to save device memory,
+            None for the model device
+        dtype (str or torch.dtype): dtype of the averaged floating point tensors, None for the model dtype
+
+    """
+
+    def __init__(self, model: nn.Module, decay: float = 0.999, every: int = 1,
+                 device = None, dtype = None):
+        if isinstance(dtype, str):
+            dtype = getattr(torch, dtype)
+        self.decay = decay
+        self.every = every
+        self.device = device
+        self.dtype = dtype
+        self.num_steps = 0
+
+        self.param_names = [name for name, param in model.named_parameters() if param.is_floating_point()]
+        self.state = {key: self._convert(value) for key, value in model.state_dict().items()}
+
+    def _convert(self, tensor: Tensor) -> Tensor:
+        dtype = self.dtype if self.dtype is not None and tensor.is_floating_point() else tensor.dtype
+        return tensor.detach().to(self.device or tensor.device, dtype, copy=True)
+
+    @torch.no_grad()
+    def update(self, model: nn.Module):
+        """Count a step of the model, the average is updated on every `every`-th step."""
+        self.num_steps += 1
+        if self.num_steps % self.every:
+            return
+
+        params = dict(model.named_parameters())
+        averages = [self.state[name] for name in self.param_names]
+        values = [params[name].detach() for name in self.param_names]
+        if values and (values[0].device != averages[0].device or values[0].dtype != averages[0].dtype):
+            values = [value.to(average.device, average.dtype, non_blocking=True)
+                      for value, average in zip(values, averages)]
+
+        weight = 1 - self.decay ** self.every
+        torch._foreach_mul_(averages, 1 - weight)
+        torch._foreach_add_(averages, values, alpha=weight)
+
+        for name, buffer in model.named_buffers():
+            if name in self.state:
+                self.state[name].copy_(buffer)
+
+    def state_dict(self) -> Dict[str, Tensor]:
+        return self.state
+
+    def load_state_dict(self, state_dict: Dict[str, Tensor]):
+        for key, value in state_dict.items():
+            self.state[key].copy_(value)
@@ -1,6 +1,6 @@
 from torch import nn, Tensor
 
-from .components import RandomShift, GaussianBlur
+from .components import RandomShiftBlur
 
 
 class PatchDiscriminator(nn.Module):
@@ -22,10 +22,8 @@ class PatchDiscriminator(nn.Module):
                 features += [nn.BatchNorm2d(channels[i + 1])]
 
         self.features = nn.Sequential(*features)
-        self.preprocess = nn.Sequential(
-            RandomShift(),
-            GaussianBlur(channels=4, kernel_size=5)
-        )
+        # Random shift and gaussian blur in one padded convolution
+        self.preprocess = RandomShiftBlur(channels=4, kernel_size=5)
 
     def forward(self, x: Tensor) -> Tensor:
         x = self.preprocess(x)
@@ -0,0 +1,60 @@
+import copy
+
+import torch
+import torch.ao.nn.quantized.dynamic as nnqd
+import torch.ao.quantization as tq
+from torch import nn
+from typing import Iterable
+
+from .unet import DoubleConv
+
+
+def fuse_double_convs(model: nn.Module, relu: bool = True) -> nn.Module:
+    """Fuse conv => BN (=> ReLU) of `DoubleConv` blocks in place, model must be in eval mode."""
+    groups = [["0", "1", "2"], ["3", "4", "5"]] if relu else [["0", "1"], ["3", "4"]]
+    for module in model.modules():
+        if isinstance(module, DoubleConv):
+            tq.fuse_modules(module.double_conv, groups, inplace=True)
+    return model
+
+
+def quantize_dynamic(model: nn.Module) -> nn.Module:
+    """
+    Int8 copy of the model with weights quantized ahead of time
+    and activations quantized on the fly per batch.
+
+    Unlike `torch.ao.quantization.quantize_dynamic` defaults, convolutions are quantized.
+    BN is folded into convolutions, ReLU stays in float.
+
+    """
+    model = fuse_double_convs(copy.deepcopy(model).cpu().eval(), relu=False)
+    return tq.quantize_dynamic(model, {nn.Conv2d: tq.default_dynamic_qconfig}, dtype=torch.qint8,
+                               mapping={nn.Conv2d: nnqd.Conv2d})
+
+
+def quantize_static(model: nn.Module, calibration_data: Iterable, backend: str = None) -> nn.Module:
+    """
+    Int8 copy of the model with weights and activations quantized ahead of time.
+
+    Activation ranges are observed on calibration data.
+    Conv/BN/ReLU blocks are fused into single int8 convolutions.
+
+    Args:
+        model (nn.Module): float model
+        calibration_data (iterable): input batches
+        backend (str): quantized engine, e.g. "fbgemm" for x86 or "qnnpack" for ARM,
+            current `torch.backends.quantized.engine` by default
+
+    """
+    backend = backend or torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+
+    model = tq.QuantWrapper(fuse_double_convs(copy.deepcopy(model).cpu().eval()))
+    model.qconfig = tq.get_default_qconfig(backend)
+    tq.prepare(model, inplace=True)
+
+    with torch.no_grad():
+        for input in calibration_data:
+            model(input.cpu())
+
+    return tq.convert(model, inplace=True)
@@ -2,6 +2,44 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from contextlib import contextmanager
+from torch.utils.checkpoint import checkpoint
+
+
+@contextmanager
+def frozen_buffers(module):
+    """Buffers (batch norm running statistics) are restored on exit, batch statistics are still used in training mode."""
+    buffers = [(buffer, buffer.clone()) for buffer in module.buffers()]
+    try:
+        yield
+    finally:
+        # Updated in place without bumping autograd version, as native batch norm does
+        for buffer, saved in buffers:
+            buffer.data.copy_(saved)
+
+
+def checkpoint_block(block, *inputs):
+    """
+    Run block without keeping its intermediate activations, they are recomputed in backward.
+
+    Non-reentrant checkpointing replays in-place ops (ReLU) on the recomputed tensors,
+    and batch norm running statistics are only updated by the forward pass, not by recomputation
+    (also for TorchScript blocks, whose batch norm momentum is a constant).
+
+    """
+    recompute = False
+
+    def run(*inputs):
+        nonlocal recompute
+        if not recompute:
+            recompute = True
+            return block(*inputs)
+        with frozen_buffers(block):
+            return block(*inputs)
+
+    return checkpoint(run, *inputs, use_reentrant=False)
+
+
 class DoubleConv(nn.Module):
     """(convolution => [BN] => ReLU) * 2"""
 
@@ -49,20 +87,24 @@ class Up(nn.Module):
         else:
             self.up = nn.ConvTranspose2d(in_channels , in_channels // 2, kernel_size=2, stride=2)
             self.conv = DoubleConv(in_channels, out_channels)
+        # Plain torch.cat in float mode, quantized cat after static quantization
+        self.skip_cat = nn.quantized.FloatFunctional()
 
 
     def forward(self, x1, x2):
         x1 = self.up(x1)
-        # input is CHW
-        diffY = torch.tensor([x2.size()[2] - x1.size()[2]])
-        diffX = torch.tensor([x2.size()[3] - x1.size()[3]])
-
-        x1 = F.pad(x1, [diffX // 2, diffX - diffX // 2,
-                        diffY // 2, diffY - diffY // 2])
+        # input is CHW, sizes are python ints, so no tensors are created
+        diffY = x2.size(2) - x1.size(2)
+        diffX = x2.size(3) - x1.size(3)
+
+        # Sizes divisible by 16 need no padding
+        if diffX != 0 or diffY != 0:
+            x1 = F.pad(x1, [diffX // 2, diffX - diffX // 2,
+                            diffY // 2, diffY - diffY // 2])
         # if you have padding issues, see
         # https://github.com/HaiyongJiang/U-Net-Pytorch-Unstructured-Buggy/commit/0e854509c2cea854e247a9c615f175f76fbb2e3a
         # https://github.com/xiaopeng-liao/Pytorch-UNet/commit/8ebac70e633bac59fc22bb5195e513d5832fb3bd
-        x = torch.cat([x2, x1], dim=1)
+        x = self.skip_cat.cat([x2, x1], dim=1)
         return self.conv(x)
 
 
@@ -75,12 +117,15 @@ class OutConv(nn.Module):
         return self.conv(x)
 
 class UNet(nn.Module):
-    def __init__(self, n_channels, n_classes, base_factor=32, bilinear=True):
+    def __init__(self, n_channels, n_classes, base_factor=32, bilinear=True, checkpoint_levels=()):
         super(UNet, self).__init__()
         self.n_channels = n_channels
         self.n_classes = n_classes
         self.bilinear = bilinear
         self.base_factor = base_factor
+        # Levels whose encoder and decoder blocks recompute activations in backward,
+        # from 0 (`inc`, `up4`, full resolution) to 4 (`down4`)
+        self.checkpoint_levels = set(checkpoint_levels)
 
         self.inc = DoubleConv(n_channels, base_factor)
         self.down1 = Down(base_factor, 2 * base_factor)
@@ -94,15 +139,20 @@ class UNet(nn.Module):
         self.up4 = Up(2 * base_factor, base_factor, bilinear)
         self.outc = OutConv(base_factor, n_classes)
 
+    def block(self, level, module, *inputs):
+        if level in self.checkpoint_levels and self.training and torch.is_grad_enabled():
+            return checkpoint_block(module, *inputs)
+        return module(*inputs)
+
     def forward(self, x):
-        x1 = self.inc(x)
-        x2 = self.down1(x1)
-        x3 = self.down2(x2)
-        x4 = self.down3(x3)
-        x5 = self.down4(x4)
-        x = self.up1(x5, x4)
-        x = self.up2(x, x3)
-        x = self.up3(x, x2)
-        x = self.up4(x, x1)
+        x1 = self.block(0, self.inc, x)
+        x2 = self.block(1, self.down1, x1)
+        x3 = self.block(2, self.down2, x2)
+        x4 = self.block(3, self.down3, x3)
+        x5 = self.block(4, self.down4, x4)
+        x = self.block(3, self.up1, x5, x4)
+        x = self.block(2, self.up2, x, x3)
+        x = self.block(1, self.up3, x, x2)
+        x = self.block(0, self.up4, x, x1)
         logits = self.outc(x)
         return logits
@@ -1,4 +1,11 @@
+import copy
+import hashlib
+import inspect
+import os
+
+import torch
 from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 def init_weights(module):
@@ -8,3 +15,107 @@ def init_weights(module):
     elif "BatchNorm" in name:
         nn.init.normal_(module.weight.data, 1.0, 0.02)
         nn.init.constant_(module.bias.data, 0.0)
+
+
+def script_key(model: nn.Module) -> str:
+    """Hash of module structure and source code for cached TorchScript artifacts."""
+    sources = sorted({inspect.getsource(type(module)) for module in model.modules()})
+    key = "\n".join([torch.__version__, repr(model)] + sources)
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def script_model(model: nn.Module, cache_dir: str = None) -> nn.Module:
+    """
+    TorchScript model, or its scriptable children if the model itself is not scriptable
+    (e.g. calls numpy). Scripted modules keep state dict keys of the original ones.
+
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = f"{cache_dir}/{type(model).__name__}_{script_key(model)}.pt"
+        if os.path.exists(cache_path):
+            scripted = torch.jit.load(cache_path, map_location="cpu")
+            # Artifact only provides the graph, weights are the current ones
+            scripted.load_state_dict(model.state_dict())
+            return scripted.train(model.training)
+
+    try:
+        scripted = torch.jit.script(model)
+        # Non-persistent buffers become persistent, which breaks checkpoints
+        if scripted.state_dict().keys() != model.state_dict().keys():
+            scripted = None
+    except Exception:
+        scripted = None
+
+    if scripted is None:
+        for name, child in model.named_children():
+            setattr(model, name, script_model(child, cache_dir))
+        return model
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        torch.jit.save(scripted, tmp_path)
+        os.replace(tmp_path, cache_path)
+    return scripted
+
+
+def compile_model(model: nn.Module, cache_dir: str = None) -> nn.Module:
+    """
+    Graph-compiled model, `torch.compile` if available, otherwise TorchScript.
+
+    Parameters, state dict keys and methods of the model are kept.
+
+    Args:
+        model (nn.Module): model to compile, weights may be loaded afterwards
+        cache_dir (str): directory to cache compiled artifacts between runs
+
+    """
+    if hasattr(torch, "compile"):
+        if cache_dir is not None:
+            # Inductor kernels and graphs are reused by later runs
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(f"{cache_dir}/inductor"))
+            os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+        try:
+            # Compiling forward keeps the module itself, unlike `torch.compile(model)`
+            model.forward = torch.compile(model.forward)
+            return model
+        except RuntimeError:
+            # Unsupported platform, e.g. python 3.11 with torch 2.0
+            pass
+    return script_model(model, cache_dir)
+
+
+def fold_batch_norms(model: nn.Module) -> nn.Module:
+    """
+    Deploy copy of the model in eval mode with batch norms folded into preceding convolutions.
+
+    Folded batch norms are replaced by `nn.Identity`. TorchScript parts are frozen,
+    which folds their batch norms, compiled forward is dropped.
+    The original model is not modified and keeps training.
+
+    """
+    if isinstance(model, torch.jit.ScriptModule):
+        return torch.jit.freeze(copy.deepcopy(model).eval())
+
+    model = copy.deepcopy(model).eval()
+    # Compiled forward is bound to the original model
+    model.__dict__.pop("forward", None)
+    _fold_batch_norms(model)
+    return model
+
+
+def _fold_batch_norms(module: nn.Module):
+    for name, child in module.named_children():
+        if isinstance(child, torch.jit.ScriptModule):
+            setattr(module, name, torch.jit.freeze(child))
+        else:
+            _fold_batch_norms(child)
+
+    if isinstance(module, nn.Sequential):
+        for i in range(len(module) - 1):
+            conv, bn = module[i], module[i + 1]
+            if isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)) and \
+                    isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats:
+                module[i] = fuse_conv_bn_eval(conv, bn, transpose=isinstance(conv, nn.ConvTranspose2d))
+                module[i + 1] = nn.Identity()
@@ -1,5 +1,9 @@
-from . import checkpoint
+from . import checkpoint, distributed
+from .amp import autocast, grad_scaler
+from .async_logger import AsyncLogger
 from .image_grid import image_grid
+from .image_writer import ImageWriter
+from .memory import activation_memory, micro_batch_size, micro_batches, peak_memory, reset_peak_memory
 from .random import set_random_seed
 from .save_image import save_image
 from .split_extension import split_extension
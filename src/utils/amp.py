@@ -0,0 +1,22 @@
+import torch
+
+
+def autocast(device, dtype = None):
+    """
+    Autocast context for mixed precision, disabled if dtype is None.
+
+    Args:
+        device (torch.device): device the computations run on
+        dtype (str or torch.dtype): "bfloat16" or "float16"
+
+    """
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype)
+    return torch.autocast(torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+
+def grad_scaler(dtype = None) -> torch.cuda.amp.GradScaler:
+    """Loss scaler, only float16 needs scaling. Disabled scaler is a no-op."""
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype)
+    return torch.cuda.amp.GradScaler(enabled=dtype == torch.float16)
@@ -0,0 +1,53 @@
+import queue
+import threading
+import wandb
+
+from typing import Dict
+
+from ..metrics import to_python
+
+
+class AsyncLogger:
+    """Send logs to wandb from a background thread.
+
+    Tensors in logs are converted to numbers in the background thread,
+    so the training loop does not wait for the device or the logging backend.
+    Logs are sent in the same order as they were passed.
+
+    Args:
+        log_fn (callable): logging function, `wandb.log` by default
+        max_queue (int): max number of pending logs, `log` blocks when exceeded
+
+    """
+
+    def __init__(self, log_fn = None, max_queue = 100):
+        self.log_fn = log_fn
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self._consume, daemon=True)
+        self.thread.start()
+
+    def _consume(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            log, kwargs = item
+            try:
+                log_fn = wandb.log if self.log_fn is None else self.log_fn
+                log_fn(to_python(log), **kwargs)
+            except Exception as e:
+                self.error = e
+
+    def log(self, log: Dict, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((log, kwargs))
+
+    def close(self):
+        """Wait for pending logs to be sent."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -1,14 +1,23 @@
+import copy
 import os
+import queue
+import re
+import shutil
+import threading
 import torch
 
 from torch import nn
-from typing import Sequence
+from typing import Dict, Sequence
 
 
-def save(run_name: str, epoch: int, valid_metric_history: Sequence,
-         generator, gen_optimizer, gen_scheduler,
-         discriminator, dis_optimizer, dis_scheduler):
-    checkpoint = {
+# Model state dicts, delta checkpoints only store their changed tensors
+MODEL_KEYS = ("generator", "discriminator", "generator_ema")
+
+
+def collect(epoch: int, valid_metric_history: Sequence,
+            generator, gen_optimizer, gen_scheduler,
+            discriminator, dis_optimizer, dis_scheduler, scaler = None, ema = None) -> Dict:
+    return {
         "epoch": epoch,
         "valid_metric_history": valid_metric_history,
         "generator": generator.state_dict(),
@@ -18,17 +27,197 @@ def save(run_name: str, epoch: int, valid_metric_history: Sequence,
         "gen_scheduler": None if gen_scheduler is None
                               else gen_scheduler.state_dict(),
         "dis_scheduler": None if dis_scheduler is None
-                              else dis_scheduler.state_dict()
+                              else dis_scheduler.state_dict(),
+        "scaler": None if scaler is None
+                       else scaler.state_dict(),
+        "generator_ema": None if ema is None
+                              else ema.state_dict()
     }
-    checkpoint_path = f"resources/chkpoints/{run_name}.chk"
-    checkpoint_dir = os.path.dirname(checkpoint_path)
+
+
+def snapshot(state):
+    """Copy of nested state with tensors on CPU. CUDA tensors are copied to pinned memory asynchronously."""
+    if isinstance(state, torch.Tensor):
+        if state.device.type == "cuda":
+            return torch.empty(state.shape, dtype=state.dtype, pin_memory=True) \
+                        .copy_(state.detach(), non_blocking=True)
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        # Shallow copy keeps the type and state dict metadata
+        result = copy.copy(state)
+        for key, value in state.items():
+            result[key] = snapshot(value)
+        return result
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return copy.deepcopy(state)
+
+
+def delta(state_dict: Dict, base: Dict) -> Dict:
+    """Tensors of state dict differing from the base."""
+    changed = copy.copy(state_dict)
+    for key, value in state_dict.items():
+        if key in base and base[key].dtype == value.dtype and torch.equal(base[key], value):
+            del changed[key]
+    return changed
+
+
+def atomic_save(obj, path: str):
+    """Write to a temporary file and rename it, so the file at path is always complete."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def link_latest(path: str, latest_path: str):
+    tmp_path = f"{latest_path}.tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        # No second copy on disk
+        os.link(path, tmp_path)
+    except OSError:
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, latest_path)
+
+
+def rotate(checkpoint_dir: str, run_name: str, keep: int):
+    """Remove all but `keep` last checkpoints of the run and the full checkpoints they are deltas of."""
+    pattern = re.compile(re.escape(run_name) + r"_epoch(\d+)(?:_delta(\d+))?\.chk")
+    files = []
+    for name in os.listdir(checkpoint_dir):
+        match = pattern.fullmatch(name)
+        if match is not None:
+            files.append((int(match[1]), match[2], name))
+    files.sort(key=lambda file: file[0], reverse=True)
+
+    kept = {name for _, _, name in files[:keep]}
+    kept |= {f"{run_name}_epoch{base}.chk" for _, base, _ in files[:keep] if base is not None}
+    for _, _, name in files:
+        if name not in kept:
+            os.remove(f"{checkpoint_dir}/{name}")
+
+
+def write_checkpoint(run_name: str, name: str, checkpoint: Dict, keep: int = None):
+    checkpoint_dir = "resources/chkpoints"
     os.makedirs(checkpoint_dir, exist_ok=True)
-    torch.save(checkpoint, checkpoint_path)
+    atomic_save(checkpoint, f"{checkpoint_dir}/{name}")
+    # Last checkpoint is the one `read` loads
+    link_latest(f"{checkpoint_dir}/{name}", f"{checkpoint_dir}/{run_name}.chk")
+    if keep is not None:
+        rotate(checkpoint_dir, run_name, keep)
+
+
+def write_model(run_name: str, epoch: int, state_dict: Dict, ema_state_dict: Dict = None):
+    model_path = f"resources/models/{run_name}_epoch{epoch}.pth"
+    model_dir = os.path.dirname(model_path)
+    os.makedirs(model_dir, exist_ok=True)
+    atomic_save(state_dict, model_path)
+    if ema_state_dict is not None:
+        atomic_save(ema_state_dict, f"resources/models/{run_name}_epoch{epoch}_ema.pth")
+
+
+def save(run_name: str, epoch: int, valid_metric_history: Sequence,
+         generator, gen_optimizer, gen_scheduler,
+         discriminator, dis_optimizer, dis_scheduler, scaler = None, ema = None):
+    checkpoint = collect(epoch, valid_metric_history,
+                         generator, gen_optimizer, gen_scheduler,
+                         discriminator, dis_optimizer, dis_scheduler, scaler, ema)
+    write_checkpoint(run_name, f"{run_name}_epoch{epoch}.chk", checkpoint, keep=1)
+
+
+class CheckpointWriter:
+    """Save checkpoints and models from a background thread.
+
+    State dicts are copied to CPU when a save is requested, asynchronously from CUDA devices,
+    and serialized in the background thread, so training does not wait for the disk.
+    Files are written atomically, the last checkpoint is complete even if the process crashes mid-write.
+
+    Args:
+        keep (int): number of last checkpoints kept on disk, None to keep all
+        full_every (int): saves between full checkpoints, others only store tensors of models
+            changed since the last full one (e.g. frozen ones are not rewritten),
+            whose models are kept in memory to compare with
+        max_pending (int): max number of saves waiting to be written, `save` blocks when exceeded
+
+    """
+
+    def __init__(self, keep = 1, full_every = 1, max_pending = 1):
+        self.keep = keep
+        self.full_every = full_every
+        self.num_saves = 0
+        self.base = None  # (epoch, model state dicts) of the last full checkpoint
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._consume, daemon=True)
+        self.thread.start()
+
+    def _consume(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            write_fn, args, event = item
+            try:
+                if event is not None:
+                    # Device to host copies are done
+                    event.synchronize()
+                write_fn(*args)
+            except Exception as e:
+                self.error = e
+
+    def _submit(self, write_fn, *args):
+        if self.error is not None:
+            raise self.error
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((write_fn, args, event))
+
+    def _write_checkpoint(self, run_name: str, epoch: int, checkpoint: Dict):
+        full = self.base is None or self.num_saves % self.full_every == 0
+        self.num_saves += 1
+        if full:
+            self.base = epoch, {key: checkpoint[key] for key in MODEL_KEYS
+                                if checkpoint.get(key) is not None}
+            name = f"{run_name}_epoch{epoch}.chk"
+        else:
+            base_epoch, base_models = self.base
+            for key, base_state_dict in base_models.items():
+                if checkpoint.get(key) is not None:
+                    checkpoint[key] = delta(checkpoint[key], base_state_dict)
+            checkpoint["delta_base"] = f"{run_name}_epoch{base_epoch}.chk"
+            name = f"{run_name}_epoch{epoch}_delta{base_epoch}.chk"
+        write_checkpoint(run_name, name, checkpoint, self.keep)
+
+    def save(self, run_name: str, epoch: int, valid_metric_history: Sequence,
+             generator, gen_optimizer, gen_scheduler,
+             discriminator, dis_optimizer, dis_scheduler, scaler = None, ema = None):
+        checkpoint = collect(epoch, list(valid_metric_history),
+                             generator, gen_optimizer, gen_scheduler,
+                             discriminator, dis_optimizer, dis_scheduler, scaler, ema)
+        self._submit(self._write_checkpoint, run_name, epoch, snapshot(checkpoint))
+
+    def save_model(self, run_name: str, epoch: int, model: nn.Module, ema = None):
+        self._submit(write_model, run_name, epoch, snapshot(model.state_dict()),
+                     None if ema is None else snapshot(ema.state_dict()))
+
+    def close(self):
+        """Wait for pending saves to be written."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
 
 
 def load(run_name: str,
          generator, gen_optimizer, gen_scheduler,
-         discriminator, dis_optimizer, dis_scheduler):
+         discriminator, dis_optimizer, dis_scheduler, scaler = None, ema = None):
     checkpoint = read(run_name)
     generator.load_state_dict(checkpoint['generator'])
     discriminator.load_state_dict(checkpoint['discriminator'])
@@ -38,18 +227,31 @@ def load(run_name: str,
         gen_scheduler.load_state_dict(checkpoint['gen_scheduler'])
     if dis_scheduler is not None:
         dis_scheduler.load_state_dict(checkpoint['dis_scheduler'])
+    if scaler is not None and checkpoint.get('scaler') is not None:
+        scaler.load_state_dict(checkpoint['scaler'])
+    if ema is not None:
+        # Checkpoints without average restart it from the generator
+        ema.load_state_dict(checkpoint['generator'] if checkpoint.get('generator_ema') is None
+                            else checkpoint['generator_ema'])
     return checkpoint["epoch"], checkpoint["valid_metric_history"]
 
 
 def read(run_name: str):
-    return torch.load(f"resources/chkpoints/{run_name}.chk")
+    checkpoint = torch.load(f"resources/chkpoints/{run_name}.chk")
+    base_name = checkpoint.pop("delta_base", None)
+    if base_name is not None:
+        # Unchanged model tensors are stored by the full checkpoint
+        base = torch.load(f"resources/chkpoints/{base_name}")
+        for key in MODEL_KEYS:
+            if checkpoint.get(key) is not None and base.get(key) is not None:
+                state_dict = copy.copy(base[key])
+                state_dict.update(checkpoint[key])
+                checkpoint[key] = state_dict
+    return checkpoint
 
 
-def save_model(run_name: str, epoch: int, model: nn.Module):
-    model_path = f"resources/models/{run_name}_epoch{epoch}.pth"
-    model_dir = os.path.dirname(model_path)
-    os.makedirs(model_dir, exist_ok=True)
-    torch.save(model.state_dict(), model_path)
+def save_model(run_name: str, epoch: int, model: nn.Module, ema = None):
+    write_model(run_name, epoch, model.state_dict(), None if ema is None else ema.state_dict())
 
 
 def load_model(filename: str, model: nn.Module):
@@ -57,12 +259,23 @@ def load_model(filename: str, model: nn.Module):
     model.load_state_dict(torch.load(model_path))
 
 
-def load_pretrained(filename: str, key: str, model: nn.Module):
+def load_pretrained(filename: str, key: str, model: nn.Module, ema: bool = False):
+    """Load weights from a saved model or a checkpoint, `ema` selects the averaged weights."""
     try:
-        load_model(filename, model)
+        load_model(f"{filename}_ema" if ema else filename, model)
+        return
     except FileNotFoundError:
+        if ema and os.path.exists(f"resources/models/{filename}.pth"):
+            raise FileNotFoundError(f"Model {filename} has no averaged weights (trained without `ema_decay`)")
+    try:
         checkpoint = read(filename)
-        model.load_state_dict(checkpoint[key])
+    except FileNotFoundError:
+        if ema:
+            raise FileNotFoundError(f"Neither averaged model {filename}_ema nor checkpoint {filename} found")
+        raise
+    if ema and checkpoint.get(f"{key}_ema") is None:
+        raise KeyError(f"Checkpoint {filename} has no averaged weights (trained without `ema_decay`)")
+    model.load_state_dict(checkpoint[f"{key}_ema" if ema else key])
 
 
 def store_id(run_name: str, id: str):
@@ -0,0 +1,100 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+from torch import nn, Tensor
+from typing import Iterable, Tuple
+
+
+def init_distributed(backend: str = None) -> Tuple[int, int, int]:
+    """
+    Join process group of a `torchrun` launch, no-op for a single process.
+
+    Args:
+        backend (str): "nccl" or "gloo", by default nccl if CUDA is available
+
+    Returns:
+        tuple of (rank, world size, local rank)
+
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if world_size > 1 and not is_distributed():
+        backend = backend or ("nccl" if torch.cuda.is_available() else "gloo")
+        dist.init_process_group(backend)
+    return get_rank(), get_world_size(), local_rank
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def all_reduce_mean(tensor: Tensor) -> Tensor:
+    """Mean of a tensor over processes, the tensor itself is not modified."""
+    if not is_distributed():
+        return tensor
+    tensor = tensor.detach().clone()
+    dist.all_reduce(tensor)
+    return tensor / get_world_size()
+
+
+def all_reduce_grads(params: Iterable[Tensor]):
+    """Average gradients over processes in place, one flat buffer per dtype."""
+    if not is_distributed():
+        return
+    grads = dict()
+    for param in params:
+        if param.grad is not None:
+            grads.setdefault(param.grad.dtype, []).append(param.grad)
+    for tensors in grads.values():
+        flat = torch.cat([grad.reshape(-1) for grad in tensors])
+        dist.all_reduce(flat)
+        flat /= get_world_size()
+        offset = 0
+        for grad in tensors:
+            grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+            offset += grad.numel()
+
+
+def all_gather_cat(tensor: Tensor) -> Tensor:
+    """Concatenation of tensors of all processes along the first dim, sizes may differ."""
+    if not is_distributed():
+        return tensor
+    size = torch.tensor([len(tensor)], device=tensor.device)
+    sizes = [torch.zeros_like(size) for _ in range(get_world_size())]
+    dist.all_gather(sizes, size)
+    sizes = [int(s) for s in sizes]
+
+    padded = tensor.new_zeros((max(sizes),) + tensor.shape[1:])
+    padded[:len(tensor)] = tensor
+    gathered = [torch.empty_like(padded) for _ in sizes]
+    dist.all_gather(gathered, padded)
+    return torch.cat([t[:s] for t, s in zip(gathered, sizes)])
+
+
+@torch.no_grad()
+def broadcast_module(module: nn.Module, buffers_only: bool = False):
+    """Copy parameters and buffers of rank 0 to other processes."""
+    if not is_distributed():
+        return
+    tensors = list(module.buffers()) if buffers_only else list(module.state_dict().values())
+    for tensor in tensors:
+        dist.broadcast(tensor, 0)
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
@@ -0,0 +1,62 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from torch import Tensor
+
+from .save_image import encode_image
+from .split_extension import split_extension
+
+
+class ImageWriter:
+    """Encode and save images in a thread pool.
+
+    Images are written to a temporary `<path>.tmp` file first and then renamed,
+    so an existing file is always complete. Temporary files have no image extension,
+    leftovers of a killed run are not read as images and are removed by `remove_temporary`.
+
+    Args:
+        num_threads (int): number of encoding threads
+        unnorm (bool): unnormalize images [-1; 1] -> [0, 1] when saving
+        max_pending (int): max number of images waiting to be saved,
+            `write` blocks when exceeded
+
+    """
+
+    def __init__(self, num_threads = 4, unnorm = True, max_pending = 256):
+        self.unnorm = unnorm
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(num_threads)
+        self.pending = deque()
+
+    @staticmethod
+    def remove_temporary(save_dir: str):
+        """Remove partial writes of a killed run, also `*.tmp.png` of earlier versions."""
+        for name in os.listdir(save_dir):
+            if name.endswith(".tmp") or ".tmp." in name:
+                os.remove(f"{save_dir}/{name}")
+
+    def _save(self, path: str, image: Tensor):
+        _, extension = split_extension(path)
+        encoded = encode_image(image, extension, self.unnorm)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(encoded)
+        os.replace(tmp_path, path)
+
+    def write(self, path: str, image: Tensor):
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(self._save, path, image))
+
+    def close(self):
+        """Wait for all images to be saved."""
+        while self.pending:
+            self.pending.popleft().result()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
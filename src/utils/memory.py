@@ -0,0 +1,116 @@
+import resource
+import torch
+import warnings
+
+from torch import Tensor
+from typing import Callable, Iterator, Sequence
+
+
+def _tensors(output):
+    if isinstance(output, Tensor):
+        yield output
+    elif isinstance(output, (tuple, list)):
+        for item in output:
+            yield from _tensors(item)
+    elif isinstance(output, dict):
+        for item in output.values():
+            yield from _tensors(item)
+
+
+def activation_memory(fn: Callable, *args) -> int:
+    """
+    Estimate memory needed to run `fn(*args)` without grads.
+
+    All outputs of leaf modules are summed up, which gives an upper bound
+    since most of them are freed before the computation ends.
+
+    Submodules of TorchScript modules (`compiled = True` on torch < 2.0) run without
+    Python hooks. Then the peak memory allocated by the call is measured on CUDA,
+    on CPU it cannot be measured and None is returned.
+
+    Returns:
+        int: number of bytes or None
+
+    """
+    total = 0
+    scripted = False
+
+    def hook(module, input, output):
+        nonlocal total, scripted
+        if isinstance(module, torch.jit.ScriptModule):
+            scripted = True
+        elif next(module.children(), None) is None:
+            total += sum(t.numel() * t.element_size() for t in _tensors(output))
+
+    handle = torch.nn.modules.module.register_module_forward_hook(hook)
+    try:
+        with torch.no_grad():
+            fn(*args)
+    finally:
+        handle.remove()
+    if not scripted and total > 0:
+        return total
+
+    if not torch.cuda.is_available():
+        return None
+    torch.cuda.synchronize()
+    allocated = torch.cuda.memory_allocated()
+    torch.cuda.reset_peak_memory_stats()
+    with torch.no_grad():
+        fn(*args)
+    torch.cuda.synchronize()
+    return torch.cuda.max_memory_allocated() - allocated
+
+
+def micro_batch_size(fn: Callable, sample: Sequence[Tensor], memory_budget = None,
+                     max_size: int = None) -> int:
+    """
+    Largest micro-batch for `fn` fitting into memory budget.
+
+    Args:
+        fn (callable): computation run on micro-batches
+        sample (sequence of tensors): batch of one sample to probe `fn` with
+        memory_budget (float): memory for activations, Mb. None for no limit
+        max_size (int): upper bound for micro-batch size
+
+    Returns:
+        int: micro-batch size or `max_size` if memory is not limited
+
+    """
+    if memory_budget is None:
+        return max_size
+    per_sample = activation_memory(fn, *sample)
+    if per_sample is None:
+        warnings.warn("Activation memory of TorchScript compiled models cannot be estimated on CPU, "
+                      "eval_memory_budget is kept by processing one sample at a time")
+        return 1
+    per_sample = max(per_sample, 1)
+    size = max(1, int(memory_budget * 2 ** 20 // per_sample))
+    return size if max_size is None else min(size, max_size)
+
+
+def micro_batches(batch: Sequence[Tensor], size: int = None) -> Iterator[Sequence[Tensor]]:
+    """Split batch of tensors into chunks of `size` samples."""
+    if size is None:
+        yield batch
+        return
+    yield from zip(*(tensor.split(size) for tensor in batch))
+
+
+def reset_peak_memory(device):
+    """Reset peak memory of CUDA device, no-op on CPU where the process peak cannot be reset."""
+    if torch.device(device).type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory(device) -> float:
+    """
+    Peak allocated memory of CUDA device since `reset_peak_memory`, Mb.
+
+    On CPU it is the peak resident memory over the whole process lifetime.
+
+    """
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    # Kb on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
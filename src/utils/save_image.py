@@ -4,10 +4,20 @@ import torch
 from torch import Tensor
 
 
-def save_image(path: str, image: Tensor, unnorm: bool = True) -> Tensor:
+def _to_bgr(image: Tensor, unnorm: bool) -> np.ndarray:
     if unnorm:
         image = image / 2 + 0.5
     image = image.clip(0, 1)
     image = torch.movedim(image, 0, -1)
     image = (image.cpu().numpy() * 255 + 0.5).astype(np.uint8)
-    cv2.imwrite(path, image[..., ::-1])
+    return np.ascontiguousarray(image[..., ::-1])
+
+
+def save_image(path: str, image: Tensor, unnorm: bool = True) -> Tensor:
+    cv2.imwrite(path, _to_bgr(image, unnorm))
+
+
+def encode_image(image: Tensor, extension: str, unnorm: bool = True) -> bytes:
+    """Encode image to the format of file extension, e.g. ".png"."""
+    _, encoded = cv2.imencode(extension, _to_bgr(image, unnorm))
+    return encoded.tobytes()
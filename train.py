@@ -2,14 +2,14 @@ import argparse
 
 import torch
 import wandb
-from torch.utils.data import DataLoader
 
 import sys
 sys.path.append(".")
 
 from src import config
+from src.dataset import DevicePrefetcher, data_loader
 from src.loops import train
-from src.utils import set_random_seed, checkpoint
+from src.utils import set_random_seed, checkpoint, distributed
 
 
 parser = argparse.ArgumentParser(description="Train pix2pix GAN model.")
@@ -27,6 +27,8 @@ parser.add_argument("--n_tries", metavar="INT", type=int, default=10,
                     help="Number of times to restart training in case of failure (default: %(default)s).")
 parser.add_argument("--progress", choices=["epochs", "samples"], default="epochs",
                     help="How to draw progressbars (default: %(default)s).")
+parser.add_argument("--backend", choices=["nccl", "gloo"], default=None,
+                    help="Distributed backend when launched with torchrun (default: nccl on GPU, gloo on CPU).")
 args = parser.parse_args()
 
 config_ = getattr(config, args.config)
@@ -37,22 +39,37 @@ train_config = config_.TrainConfig()
 
 resume = args.resume
 
+# Data parallel training in every process of a `torchrun` launch, batch size is per process
+rank, world_size, local_rank = distributed.init_distributed(args.backend)
+if world_size > 1 and train_config.device.startswith("cuda"):
+    train_config.device = f"cuda:{local_rank}"
+    torch.cuda.set_device(train_config.device)
 
-set_random_seed(args.seed)
+# Different augmentations in every process, weights are broadcast from the main process
+set_random_seed(args.seed + rank)
 
-train_loader = DataLoader(
-    data_config.train_dataset,
-    batch_size=train_config.train_batch,
-    shuffle=True,
-    num_workers=train_config.num_workers
-)
 
-valid_loader = DataLoader(
-    data_config.valid_dataset,
-    batch_size=train_config.valid_batch,
-    shuffle=False,
-    num_workers=train_config.num_workers
-)
+def make_loader(dataset, batch_size, shuffle):
+    loader = data_loader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=train_config.num_workers,
+        pin_memory=train_config.pin_memory,
+        persistent_workers=train_config.persistent_workers,
+        prefetch_factor=train_config.prefetch_factor
+    )
+    if train_config.prefetch_batches:
+        loader = DevicePrefetcher(loader, train_config.device, train_config.prefetch_batches,
+                                  torch.channels_last if train_config.channels_last else torch.preserve_format)
+    return loader
+
+
+train_loader = make_loader(data_config.train_dataset, train_config.train_batch, shuffle=True)
+valid_loader = make_loader(data_config.valid_dataset, train_config.valid_batch, shuffle=False)
+
+train_loader = data_config.edges_loader(train_loader, train_config.device)
+valid_loader = data_config.edges_loader(valid_loader, train_config.device)
 
 
 generator = model_config.generator
@@ -81,16 +98,20 @@ dis_optimizer = torch.optim.Adam(
 gen_scheduler = train_config.gen_scheduler(gen_optimizer)
 dis_scheduler = train_config.dis_scheduler(dis_optimizer)
 
-if resume:
-    try:
-        id = checkpoint.get_id(train_config.run_name)
-    except FileNotFoundError:
-        id = train_config.run_name
+if rank == 0:
+    if resume:
+        try:
+            id = checkpoint.get_id(train_config.run_name)
+        except FileNotFoundError:
+            id = train_config.run_name
+    else:
+        id = wandb.util.generate_id()
+        checkpoint.store_id(train_config.run_name, id)
+    wandb.init(config=train_config, project=train_config.wandb_project,
+               id=id, name=train_config.run_name, resume="allow")
 else:
-    id = wandb.util.generate_id()
-    checkpoint.store_id(train_config.run_name, id)
-wandb.init(config=train_config, project=train_config.wandb_project,
-           id=id, name=train_config.run_name, resume="allow")
+    # Only the main process logs
+    wandb.init(mode="disabled")
 
 for _ in range(args.n_tries):
     reply = train(train_config, train_loader, valid_loader,